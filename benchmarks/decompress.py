@@ -0,0 +1,66 @@
+"""Benchmark parallel bz2 decompression of frames against the serial decompression
+
+Decompresses a frame with `bz2.decompress`, then with `gmag._bz2_blocks.decompress` at each number of threads,
+checks the output is the same, and prints the throughput of each, in MB of decompressed data per second.
+The frame is a synthetic frame of the stand-in, or a real SDSS frame file.
+
+Usage, from the repository root::
+
+    python benchmarks/decompress.py --workers 1 2 4 8 --file frame-r-000756-1-0100.fits.bz2
+"""
+
+import argparse
+import bz2
+import json
+import pathlib
+import sys
+import time
+
+from stand_in import FIRST_FIELD, StandIn
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from gmag import _bz2_blocks  # noqa: E402
+
+
+def _best_time(func, repeat):
+    """Fastest of repeat calls of func, in seconds, and its return value"""
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="numbers of threads")
+    parser.add_argument('--file', default=None, help="bz2 compressed frame, default is a synthetic frame")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs of each, the fastest is kept")
+    args = parser.parse_args(argv)
+
+    if args.file is None:
+        content = StandIn(num_fields=1).frame(FIRST_FIELD, 'r')
+    else:
+        content = pathlib.Path(args.file).read_bytes()
+
+    serial_time, expected = _best_time(lambda: bz2.decompress(content), args.repeat)
+    split_time, streams = _best_time(lambda: _bz2_blocks.split_blocks(content), args.repeat)
+    megabytes = len(expected) / 1024 ** 2
+    print(json.dumps({'decoder': 'serial', 'compressed_mb': len(content) / 1024 ** 2, 'mb': megabytes,
+                      'blocks': len(streams or ()), 'split_s': split_time, 'seconds': serial_time,
+                      'mb_per_s': megabytes / serial_time}))
+
+    for num_workers in args.workers:
+        _bz2_blocks.WORKERS, _bz2_blocks._pool = num_workers, None
+        seconds, result = _best_time(lambda: _bz2_blocks.decompress(content), args.repeat)
+        if result != expected:
+            sys.exit(f"Parallel decompression with {num_workers} threads differs from serial decompression")
+        print(json.dumps({'decoder': 'parallel', 'workers': num_workers, 'seconds': seconds,
+                          'mb_per_s': megabytes / seconds, 'speedup': serial_time / seconds}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Benchmark gmag end-to-end against the local SkyServer and SAS stand-in
+
+Runs `gmag.sdss.download_images` at each catalog size and number of workers, `gmag.sdss.get_random_galaxy`
+and `gmag.sdss.get_random_galaxies`, each in a fresh process so its peak memory is its own, and appends one JSON
+line per run to the results file, to track throughput and memory across versions.
+
+Usage, from the repository root::
+
+    python benchmarks/run.py --sizes 100 1000 --workers 4 16 --latency 0.05 --bandwidth 5e6
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import pathlib
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from stand_in import StandIn
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import gmag  # noqa: E402
+from gmag import sdss  # noqa: E402
+
+
+def _peak_memory():
+    """Peak resident memory in MB of this process and of its waited-for children"""
+
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+def _run_download(urls, catalog_file, kwargs, results):
+    sdss._SKYSERVER_URL, sdss._SAS_URL = urls
+    with tempfile.TemporaryDirectory() as output_dir:
+        reports = []
+        start = time.perf_counter()
+        sdss.download_images(catalog_file, output_dir=output_dir, progress_bar=False, verbose=False,
+                             report_callback=reports.append, **kwargs)
+        wall_time = time.perf_counter() - start
+
+    report = reports[0]
+    results.put({'wall_time': wall_time, 'rows_per_s': report['rows'] / wall_time,
+                 'frames_per_s': report['frames'] / wall_time,
+                 'mb_per_s': report['counters'].get('bytes_downloaded', 0) / 1024 ** 2 / wall_time,
+                 'found': report['found'], 'failed': report['failed'], 'frames': report['frames'],
+                 'utilization': report['utilization'], 'http_retries': report['counters'].get('http_retries', 0),
+                 **{f"{name}_p50": report['histograms'][name]['p50']
+                    for name in ('search_query', 'frame_fetch', 'frame_decompress_cpu')
+                    if report['histograms'].get(name, {}).get('count')},
+                 **_peak_memory()})
+
+
+def _run_random_galaxy(urls, num_galaxies, kwargs, results):
+    sdss._SKYSERVER_URL, sdss._SAS_URL = urls
+    start = time.perf_counter()
+    for _ in range(num_galaxies):
+        sdss.get_random_galaxy(verbose=False, **kwargs)
+    wall_time = time.perf_counter() - start
+    results.put({'wall_time': wall_time, 'galaxies_per_s': num_galaxies / wall_time, **_peak_memory()})
+
+
+def _run_random_galaxies(urls, num_galaxies, kwargs, results):
+    sdss._SKYSERVER_URL, sdss._SAS_URL = urls
+    start = time.perf_counter()
+    galaxies = sdss.get_random_galaxies(num_galaxies, verbose=False, progress_bar=False, **kwargs)
+    wall_time = time.perf_counter() - start
+    results.put({'wall_time': wall_time, 'galaxies_per_s': len(galaxies) / wall_time, **_peak_memory()})
+
+
+def _in_process(target, *args):
+    """Run target in a fresh process, return what it puts in its results queue"""
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    # Not a pool worker, so the run can start its own process pools
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help="catalog sizes")
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 16], help="numbers of download workers")
+    parser.add_argument('--engine', default='thread', help="execution engine of download_images")
+    parser.add_argument('--cpu-workers', type=int, default=0, help="cpu_workers of download_images")
+    parser.add_argument('--output-format', default='files', help="output_format of download_images")
+    parser.add_argument('--no-cutout', action='store_true', help="download whole frames")
+    parser.add_argument('--random-galaxies', type=int, default=5, help="number of get_random_galaxy calls, "
+                        "and of galaxies drawn by get_random_galaxies")
+    parser.add_argument('--latency', type=float, default=0.05, help="SkyServer latency in seconds")
+    parser.add_argument('--frame-latency', type=float, default=0.05, help="SAS latency in seconds")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes per second per connection")
+    parser.add_argument('--error-rate', type=float, default=0., help="fraction of requests answered with 503")
+    parser.add_argument('--truncate-rate', type=float, default=0., help="fraction of frames cut short")
+    parser.add_argument('--fields', type=int, default=20, help="number of frames of each band")
+    parser.add_argument('--output', default='benchmarks/results.jsonl', help="results file, appended to")
+    args = parser.parse_args(argv)
+
+    common = {'version': gmag.__version__, 'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'latency': args.latency, 'frame_latency': args.frame_latency,
+              'bandwidth': args.bandwidth, 'error_rate': args.error_rate, 'truncate_rate': args.truncate_rate}
+    with StandIn(num_fields=args.fields, latency=args.latency, frame_latency=args.frame_latency,
+                 bandwidth=args.bandwidth, error_rate=args.error_rate, truncate_rate=args.truncate_rate) as stand_in, \
+            tempfile.TemporaryDirectory() as tmp_dir, open(args.output, 'a') as out:
+        urls = (stand_in.skyserver_url, stand_in.sas_url)
+
+        def record(result):
+            out.write(json.dumps({**common, **result}) + '\n')
+            out.flush()
+            print(json.dumps(result))
+
+        for size in args.sizes:
+            catalog_file = pathlib.Path(tmp_dir) / f"catalog_{size}.csv"
+            with open(catalog_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['ra', 'dec'])
+                writer.writerows(zip(*stand_in.make_catalog(size)))
+
+            for num_workers in args.workers:
+                kwargs = {'num_workers': num_workers, 'engine': args.engine, 'cpu_workers': args.cpu_workers,
+                          'cutout': not args.no_cutout, 'output_format': args.output_format}
+                result = _in_process(_run_download, urls, catalog_file, kwargs)
+                record({'benchmark': 'download_images', 'rows': size, **kwargs, **result})
+
+        if args.random_galaxies:
+            result = _in_process(_run_random_galaxy, urls, args.random_galaxies, {})
+            record({'benchmark': 'get_random_galaxy', 'galaxies': args.random_galaxies, **result})
+            for num_workers in args.workers:
+                result = _in_process(_run_random_galaxies, urls, args.random_galaxies, {'num_workers': num_workers})
+                record({'benchmark': 'get_random_galaxies', 'galaxies': args.random_galaxies,
+                        'num_workers': num_workers, **result})
+
+        print(f"Stand-in served {stand_in.stats['requests']} requests, {stand_in.stats['errors']} errors, "
+              f"{stand_in.stats['truncated']} truncated frames, "
+              f"{stand_in.stats['bytes'] / 1024 ** 2:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Local stand-in for the SDSS SkyServer and SAS servers, to benchmark gmag offline
+
+Serves the SkyServer SqlSearch and ImgCutout endpoints and the SAS frame paths used by `gmag.sdss`,
+from a synthetic catalog of galaxies on synthetic frames, with configurable latency, bandwidth and errors.
+"""
+
+import bz2
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+from astropy.io import fits
+from astropy.wcs import WCS
+
+FRAME_SHAPE = (1489, 2048)
+"""Shape (height, width) in pixels of an SDSS frame"""
+
+PIXEL_SCALE = 0.396
+"""SDSS pixel scale in arcsec"""
+
+RUN, CAMCOL, FIRST_FIELD = 756, 1, 100
+"""Run, camcol and first field number of the synthetic frames"""
+
+_FRAME_PATH = re.compile(r"/sas/dr17/eboss/photoObj/frames/301/(\d+)/(\d+)/frame-([ugriz])-\d+-\d+-(\d+)\.fits\.bz2")
+_NUMBER = r"(-?[\d.]+(?:e-?\d+)?)"
+
+
+class StandIn:
+    """SkyServer and SAS stand-in, serving in a background thread
+
+    Galaxies are placed at random on `num_fields` frames along the equator, frames of the same band share their
+    pixels and only differ by their header, so frames are cheap to make but as costly to decompress as real ones.
+
+    Parameters
+    ----------
+    num_fields : `int`, default=20
+        Number of frames of each band
+    galaxies_per_field : `int`, default=50
+        Number of galaxies on each frame
+    latency : `float`, default=0.
+        Seconds to wait before answering a SkyServer request
+    frame_latency : `float`, default=0.
+        Seconds to wait before answering a SAS request
+    bandwidth : `float`, default=None
+        Bytes per second sent on each connection, None for no limit
+    error_rate : `float`, default=0.
+        Probability of answering a request with a 503 error
+    truncate_rate : `float`, default=0.
+        Probability of cutting the body of a frame short, its Content-Length kept, and closing the connection
+    frame_shape : `tuple` of `int`, default=FRAME_SHAPE
+        Shape (height, width) of the frames
+    max_query_length : `int`, default=2048
+        Longest query string of a SkyServer request, longer ones are answered with 404 as IIS does,
+        None for no limit
+    seed : `int`, default=0
+        Random seed of the catalog and frames
+    """
+
+    def __init__(self, num_fields=20, galaxies_per_field=50, latency=0., frame_latency=0., bandwidth=None,
+                 error_rate=0., truncate_rate=0., frame_shape=FRAME_SHAPE, max_query_length=2048, seed=0):
+        self.latency = latency
+        self.frame_latency = frame_latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.frame_shape = frame_shape
+        self.max_query_length = max_query_length
+        self.stats = {'requests': 0, 'errors': 0, 'truncated': 0, 'bytes': 0}
+        """Number of requests answered, errors injected, bodies cut short and body bytes sent"""
+
+        # Frame centers are spaced by their width along the equator
+        width_deg = frame_shape[1] * PIXEL_SCALE / 3600
+        self.centers = [(150 + k * width_deg, 0.) for k in range(num_fields)]
+
+        # Galaxies stay a petrosian radius away from the frame edges
+        rng = np.random.default_rng(seed)
+        n = num_fields * galaxies_per_field
+        field_index = np.repeat(np.arange(num_fields), galaxies_per_field)
+        margin = 0.4
+        self.catalog = {
+            'objid': 1237645876861272064 + np.arange(n),
+            'field': FIRST_FIELD + field_index,
+            'ra': np.array([self.centers[k][0] for k in field_index]) +
+            rng.uniform(-margin, margin, n) * width_deg,
+            'dec': rng.uniform(-margin, margin, n) * frame_shape[0] * PIXEL_SCALE / 3600,
+            'petroRad_r': rng.uniform(2, 15, n),
+        }
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._frames = {}
+        self._frame_data = {}
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def url(self):
+        """Base url of the stand-in"""
+
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def skyserver_url(self):
+        """Url to use in place of `gmag.sdss._SKYSERVER_URL`"""
+
+        return f"{self.url}/dr17/SkyServerWS"
+
+    @property
+    def sas_url(self):
+        """Url to use in place of `gmag.sdss._SAS_URL`"""
+
+        return f"{self.url}/sas/dr17"
+
+    def start(self):
+        """Make the frames and start serving on a free local port"""
+
+        for field in range(FIRST_FIELD, FIRST_FIELD + len(self.centers)):
+            for band in 'ugriz':
+                self.frame(field, band)
+
+        stand_in = self
+
+        class Handler(_Handler):
+            server_stand_in = stand_in
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stop serving"""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def make_catalog(self, num_rows, found_fraction=0.9, seed=0):
+        """Positions to search, near galaxies of the catalog or where there is none
+
+        Parameters
+        ----------
+        num_rows : `int`
+            Number of positions
+        found_fraction : `float`, default=0.9
+            Fraction of positions near a galaxy, within 2 arcmin so some are found at a larger search radius
+        seed : `int`, default=0
+            Random seed
+
+        Returns
+        -------
+        ra : `numpy.ndarray`
+        dec : `numpy.ndarray`
+        """
+
+        rng = np.random.default_rng(seed)
+        index = rng.integers(0, len(self.catalog['ra']), num_rows)
+        offset = rng.uniform(0, 2, num_rows) / 60
+        angle = rng.uniform(0, 2 * np.pi, num_rows)
+        ra = self.catalog['ra'][index] + offset * np.cos(angle)
+        dec = self.catalog['dec'][index] + offset * np.sin(angle)
+        # Positions far from the equator have no galaxy
+        missed = rng.random(num_rows) >= found_fraction
+        dec[missed] = -30.
+        return ra, dec
+
+    def sql(self, cmd):
+        """Answer a SQL command sent by `gmag.sdss`
+
+        Parameters
+        ----------
+        cmd : `str`
+
+        Returns
+        -------
+        rows : `list` of `dict`
+
+        Raises
+        ------
+        ValueError
+            Raised if the command is not one sent by `gmag.sdss`
+        """
+
+        if 'NEWID()' in cmd:
+            num = int(re.search(r"TOP (\d+)", cmd).group(1))
+            with self._lock:
+                ks = self._rng.sample(range(len(self.catalog['objid'])), min(num, len(self.catalog['objid'])))
+            if 'g.run' not in cmd:
+                return [{'objid': int(self.catalog['objid'][k])} for k in ks]
+            return [{key: value for key, value in self._galaxy(k).items() if key != 'petroRadErr_r'} for k in ks]
+
+        match = re.search(r"WHERE objid = (\d+)", cmd)
+        if match:
+            k = int(np.searchsorted(self.catalog['objid'], int(match.group(1))))
+            return [{key: value for key, value in self._galaxy(k).items()
+                     if key in ('run', 'camcol', 'field', 'ra', 'dec', 'petroRad_r')}]
+
+        match = re.search(r"VALUES (.*)\) AS p\(id, ra, dec\).*fGetNearbyObjEq\(p\.ra, p\.dec, " + _NUMBER, cmd)
+        if match:
+            radius = float(match.group(2))
+            values = re.findall(rf"\((\d+), {_NUMBER}, {_NUMBER}\)", match.group(1))
+            # Anything else, e.g. nan, is taken as a column name by SQL Server
+            if ", ".join(f"({row_id}, {ra}, {dec})" for row_id, ra, dec in values) != match.group(1):
+                raise ValueError(f"Invalid column name in VALUES {match.group(1)}")
+            rows = []
+            for row_id, ra, dec in values:
+                k = self._nearest(float(ra), float(dec), radius)
+                if k is not None:
+                    rows.append({'id': int(row_id), **self._galaxy(k)})
+            return rows
+
+        match = re.search(rf"fGetNearbyObjEq\({_NUMBER}, {_NUMBER}, {_NUMBER}\)", cmd)
+        if match:
+            k = self._nearest(*map(float, match.groups()))
+            return [] if k is None else [self._galaxy(k)]
+
+        raise ValueError(f"Unknown command {cmd}")
+
+    def frame(self, field, band):
+        """Compressed frame of a field and band
+
+        Parameters
+        ----------
+        field : `int`
+        band : `str`
+
+        Returns
+        -------
+        content : `bytes`
+            bz2 compressed fits file, with one stream for the header and one for the data shared by the band
+        """
+
+        with self._lock:
+            if (field, band) not in self._frames:
+                if band not in self._frame_data:
+                    rng = np.random.default_rng('ugriz'.index(band))
+                    data = np.round(rng.normal(0, 0.05, self.frame_shape), 3).astype('>f4').tobytes()
+                    data += b'\0' * (-len(data) % 2880)
+                    self._frame_data[band] = bz2.compress(data)
+
+                ra, dec = self.centers[field - FIRST_FIELD]
+                wcs = WCS(naxis=2)
+                wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+                wcs.wcs.crval = [ra, dec]
+                wcs.wcs.crpix = [self.frame_shape[1] / 2 + 0.5, self.frame_shape[0] / 2 + 0.5]
+                wcs.wcs.cdelt = [-PIXEL_SCALE / 3600, PIXEL_SCALE / 3600]
+                header = fits.Header([('SIMPLE', True), ('BITPIX', -32), ('NAXIS', 2),
+                                      ('NAXIS1', self.frame_shape[1]), ('NAXIS2', self.frame_shape[0]),
+                                      ('FILTER', band)])
+                header.extend(wcs.to_header())
+                self._frames[(field, band)] = bz2.compress(header.tostring().encode()) + self._frame_data[band]
+            return self._frames[(field, band)]
+
+    def jpeg(self, width, height):
+        """Gray noise JPEG image
+
+        Parameters
+        ----------
+        width : `int`
+        height : `int`
+
+        Returns
+        -------
+        content : `bytes`
+        """
+
+        data = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(data).save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+    def _galaxy(self, k):
+        return {'objid': int(self.catalog['objid'][k]), 'run': RUN, 'camcol': CAMCOL,
+                'field': int(self.catalog['field'][k]), 'ra': float(self.catalog['ra'][k]),
+                'dec': float(self.catalog['dec'][k]), 'petroRad_r': float(self.catalog['petroRad_r'][k]),
+                'petroRadErr_r': 0.1}
+
+    def _nearest(self, ra, dec, radius):
+        distance = np.hypot((self.catalog['ra'] - ra) * np.cos(np.radians(dec)), self.catalog['dec'] - dec) * 60
+        k = int(np.argmin(distance))
+        return k if distance[k] <= radius else None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_stand_in = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stand_in = self.server_stand_in
+        url = urllib.parse.urlsplit(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        is_frame = url.path.startswith('/sas/')
+        if not is_frame and stand_in.max_query_length and len(url.query) > stand_in.max_query_length:
+            return self._send(404, b'Query String Too Long', 'text/plain')
+        time.sleep(stand_in.frame_latency if is_frame else stand_in.latency)
+
+        with stand_in._lock:
+            stand_in.stats['requests'] += 1
+            failed = stand_in._rng.random() < stand_in.error_rate
+            stand_in.stats['errors'] += failed
+            truncated = is_frame and not failed and stand_in._rng.random() < stand_in.truncate_rate
+            stand_in.stats['truncated'] += truncated
+        if failed:
+            return self._send(503, b'Service Unavailable', 'text/plain')
+
+        try:
+            if url.path.endswith('/SearchTools/SqlSearch'):
+                rows = stand_in.sql(query['cmd'])
+                body = json.dumps([{'TableName': 'Table1', 'Rows': rows}]).encode()
+                return self._send(200, body, 'application/json')
+            if url.path.endswith('/ImgCutout/getjpeg'):
+                return self._send(200, stand_in.jpeg(int(query['width']), int(query['height'])), 'image/jpeg')
+            match = _FRAME_PATH.fullmatch(url.path)
+            if match and int(match.group(4)) - FIRST_FIELD in range(len(stand_in.centers)):
+                return self._send(200, stand_in.frame(int(match.group(4)), match.group(3)),
+                                  'application/x-bzip2', truncated)
+        except (KeyError, ValueError) as e:
+            return self._send(400, str(e).encode(), 'text/plain')
+
+        self._send(404, b'Not Found', 'text/plain')
+
+    def _send(self, status, body, content_type, truncated=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if truncated:
+            # The client is left waiting for the rest of the body until the connection is closed
+            body = body[:len(body) // 2]
+            self.close_connection = True
+
+        bandwidth = self.server_stand_in.bandwidth
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start:start + chunk_size])
+            if bandwidth:
+                time.sleep(min(chunk_size, len(body) - start) / bandwidth)
+
+        with self.server_stand_in._lock:
+            self.server_stand_in.stats['bytes'] += len(body)
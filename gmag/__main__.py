@@ -0,0 +1,29 @@
+"""Command line of gmag
+
+Merge the partitions of a download run, run on many machines with `download_images(partition=(index, count))`::
+
+    python -m gmag merge merged_images images_part0 images_part1 images_part2
+"""
+
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gmag', description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    merge = commands.add_parser('merge', help="merge the partitions of a download run into one run")
+    merge.add_argument('output_dir', help="directory of the merged run")
+    merge.add_argument('part_dirs', nargs='+', help="output directories of all partitions")
+    merge.add_argument('--file', default=None, help="catalog file, if it moved since the partitions were run")
+    merge.add_argument('--quiet', action='store_true', help="do not print progress")
+    args = parser.parse_args(argv)
+
+    # Imported once the arguments are valid, so --help stays fast
+    from . import sdss
+
+    if args.command == 'merge':
+        sdss.merge_partitions(args.part_dirs, args.output_dir, file=args.file, verbose=not args.quiet)
+
+
+if __name__ == '__main__':
+    main()
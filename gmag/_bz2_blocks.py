@@ -0,0 +1,163 @@
+"""Parallel decompression of bz2 files, by splitting them into their independently compressed blocks
+
+A bz2 stream is a sequence of blocks of up to 900 kB of uncompressed data, each compressed on its own and starting
+with a 48-bit magic number, not aligned to bytes. Each block is cut out and wrapped into a stream of its own,
+and the streams are decompressed in a thread pool, `bz2` releases the GIL while decompressing.
+"""
+
+import bz2
+import multiprocessing
+import os
+import threading
+import time
+
+from . import _executor
+from . import _metrics
+
+BLOCK_MAGIC = 0x314159265359
+"""Magic number starting each block, the BCD digits of pi"""
+
+EOS_MAGIC = 0x177245385090
+"""Magic number starting the end of a stream, the BCD digits of sqrt(pi)"""
+
+WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+"""Number of threads decompressing blocks in the main process, the number of usable cores by default,
+1 to always decompress serially. Worker processes always decompress serially"""
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def split_blocks(data):
+    """Split bz2 compressed data into one standalone bz2 stream per block
+
+    Parameters
+    ----------
+    data : `bytes`
+        bz2 compressed data, may hold multiple streams
+
+    Returns
+    -------
+    streams : `list` of `bytes` or `None`
+        bz2 stream of each block, in order, None if data is not bz2 or can not be split
+    """
+
+    if data[:3] != b'BZh':
+        return None
+
+    blocks, ends = _find_magics(data)
+    # Each block ends where the next block or the end of its stream starts
+    boundaries = sorted(blocks + ends)
+    block_starts = set(blocks)
+    streams = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        if start in block_starts:
+            streams.append(_wrap_block(data, start, end))
+    if len(streams) != len(blocks):
+        return None
+
+    return streams
+
+
+def decompress(data):
+    """Decompress bz2 compressed data, its blocks in parallel
+
+    Falls back to `bz2.decompress` if data has a single block, can not be split or a block fails, e.g. if a magic
+    number is found by chance inside a block, or if running in a worker process, see `num_workers`.
+    The CPU time spent is recorded as 'frame_decompress_cpu' in the current `._metrics.capture`.
+
+    Parameters
+    ----------
+    data : `bytes`
+        bz2 compressed data, may hold multiple streams
+
+    Returns
+    -------
+    decompressed : `bytes`
+
+    Raises
+    ------
+    OSError
+        Raised if data is not valid bz2 data
+    EOFError
+        Raised if data ends before the end-of-stream marker
+    """
+
+    streams = split_blocks(data) if num_workers() > 1 else None
+    if streams is not None and len(streams) > 1:
+        try:
+            chunks, cpu_times = zip(*_get_pool().map(_decompress_block, streams))
+        except (OSError, EOFError, ValueError):
+            pass  # decompressed serially below, data is all in memory so nothing was written yet
+        else:
+            _metrics.observe('frame_decompress_cpu', sum(cpu_times))
+            return b''.join(chunks)
+
+    chunk, cpu_time = _decompress_block(data)
+    _metrics.observe('frame_decompress_cpu', cpu_time)
+    return chunk
+
+
+def num_workers():
+    """Number of threads decompressing blocks in the current process
+
+    `WORKERS` in the main process, 1 in worker processes, e.g. of `engine='process'` or `cpu_workers`,
+    as their parent already runs about one of them per core.
+    """
+
+    return WORKERS if multiprocessing.current_process().name == 'MainProcess' else 1
+
+
+def _get_pool():
+    """Thread pool of the current process, a new one is created after a fork"""
+
+    global _pool, _pool_pid
+
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool, _pool_pid = _executor.make_executor('thread', num_workers()), os.getpid()
+        return _pool
+
+
+def _decompress_block(stream):
+    start = time.thread_time()
+    chunk = bz2.decompress(stream)
+    return chunk, time.thread_time() - start
+
+
+def _find_magics(data):
+    """Bit offsets of the block and end-of-stream magic numbers in data
+
+    A magic number at bit offset 8 * p + shift fully covers bytes p + 1 to p + 5, which only depend on the shift,
+    so they are searched as bytes for each of the 8 shifts, and each match is checked against the whole number.
+    """
+
+    offsets = ([], [])
+    for magic, found in zip((BLOCK_MAGIC, EOS_MAGIC), offsets):
+        for shift in range(8):
+            middle = (magic << (8 - shift)).to_bytes(7, 'big')[1:6]
+            pos = data.find(middle, 1)
+            while pos != -1:
+                window = int.from_bytes(data[pos - 1:pos + 6].ljust(7, b'\0'), 'big')
+                if (window >> (8 - shift)) & 0xffffffffffff == magic:
+                    found.append(8 * (pos - 1) + shift)
+                pos = data.find(middle, pos + 1)
+
+    return offsets
+
+
+def _wrap_block(data, start, end):
+    """Standalone bz2 stream of the block at bits start to end of data"""
+
+    first_byte, last_byte = start // 8, (end + 7) // 8
+    num_bits = end - start
+    block = int.from_bytes(data[first_byte:last_byte], 'big')
+    block = (block >> (last_byte * 8 - end)) & ((1 << num_bits) - 1)
+
+    # The combined crc of a stream of one block is the crc of the block, which follows its magic number
+    crc = (block >> (num_bits - 80)) & 0xffffffff
+    stream = (((block << 48) | EOS_MAGIC) << 32) | crc
+    num_bits += 80
+    padding = -num_bits % 8
+    return b'BZh9' + (stream << padding).to_bytes((num_bits + padding) // 8, 'big')
@@ -0,0 +1,100 @@
+"""Offline nearest galaxy search against a local SDSS Galaxy table extract"""
+
+import numpy as np
+
+COLUMNS = ('objid', 'run', 'camcol', 'field', 'ra', 'dec', 'petroRad_r', 'petroRadErr_r')
+"""Columns a local catalog must have, matched case-insensitively"""
+
+_INT_COLUMNS = ('objid', 'run', 'camcol', 'field')
+
+
+class LocalCatalog:
+    """Local galaxy catalog indexed by a KD-tree on unit vectors
+
+    Parameters
+    ----------
+    catalog : `str`, `pathlib.Path` or `astropy.table.Table`
+        Catalog table, or file to read it from, with the columns in `COLUMNS`
+
+    Raises
+    ------
+    ImportError
+        Raised if scipy is not installed
+    OSError
+        Raised if can not read file
+    KeyError
+        Raised if a column is not found in the catalog
+    """
+
+    def __init__(self, catalog):
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError("scipy is required to search a local catalog, install it with `pip install gmag[local]`")
+        from astropy.table import Table as AstropyTable
+
+        if not isinstance(catalog, AstropyTable):
+            try:
+                catalog = AstropyTable.read(catalog)
+            except OSError:
+                raise OSError(f"Could not open catalog file {catalog}")
+
+        col_names = {name.lower(): name for name in catalog.colnames}
+        self.columns = {}
+        for col in COLUMNS:
+            if col.lower() not in col_names:
+                raise KeyError(f"Could not find column '{col}' in catalog")
+            dtype = np.int64 if col in _INT_COLUMNS else np.float64
+            self.columns[col] = np.asarray(catalog[col_names[col.lower()]], dtype=dtype)
+
+        self._tree = cKDTree(_unit_vectors(self.columns['ra'], self.columns['dec']))
+
+    def __len__(self):
+        return len(self.columns['objid'])
+
+    def search(self, ra, dec, max_search_radius):
+        """Search the nearest galaxy of many positions
+
+        Same result as searching SkyServer: the nearest galaxy within max_search_radius, or None.
+
+        Parameters
+        ----------
+        ra : array-like
+            right ascension in degrees
+        dec : array-like
+            declination in degrees
+        max_search_radius : `float`
+            maximum search radius in arcmin
+
+        Returns
+        -------
+        galaxies : `list` of `dict` or `None`
+            Galaxy data in order of positions, `None` if no galaxy found,
+            dictionary with keys 'objid', 'run', 'camcol', 'field', 'ra', 'dec', 'petroRad_r', 'petroRadErr_r'
+        """
+
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        valid = np.isfinite(ra) & np.isfinite(dec)
+
+        # Chord length between unit vectors at the maximum angular separation
+        max_chord = 2 * np.sin(np.radians(max_search_radius / 60) / 2)
+        indices = np.full(len(ra), len(self))
+        if valid.any():
+            _, indices[valid] = self._tree.query(_unit_vectors(ra[valid], dec[valid]),
+                                                 distance_upper_bound=max_chord)
+
+        found = indices < len(self)
+        rows = {col: values[indices[found]].tolist() for col, values in self.columns.items()}
+        galaxies = [None] * len(ra)
+        for n, i in enumerate(np.flatnonzero(found)):
+            galaxies[i] = {col: rows[col][n] for col in COLUMNS}
+
+        return galaxies
+
+
+def _unit_vectors(ra, dec):
+    """Convert ra dec in degrees to unit vectors, shape (N, 3)"""
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
@@ -0,0 +1,122 @@
+"""Cutout and resampling geometry of galaxies on SDSS frames"""
+
+import numpy as np
+
+SDSS_PIXEL_SCALE = 0.396
+"""Pixel scale of SDSS frames in arcsec"""
+
+TENSOR_FILE_NAME = 'cutouts.npy'
+"""Name of the file of the grids resampled by a download run, in the output directory"""
+
+
+def cutout_galaxies(data, wcs, ra, dec, petro_r):
+    """Cutout many galaxies from one frame, with vectorized wcs transforms
+
+    The cutout of each galaxy is centered on it, with a half size of 1.25 times its petrosian radius
+    in pixels, rounded up to the nearest 10 pixels. Cutouts crossing the frame edges are clipped.
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Frame image data
+    wcs : `astropy.wcs.WCS`
+        Frame wcs
+    ra : array-like
+        right ascension of each galaxy in degrees
+    dec : array-like
+        declination of each galaxy in degrees
+    petro_r : array-like
+        petrosian radius of each galaxy in arcsec
+
+    Returns
+    -------
+    cutouts : `list` of `numpy.ndarray`
+        Cutout image of each galaxy, as views into data
+    clipped : `numpy.ndarray`
+        Whether each cutout was clipped by the frame edges
+    """
+
+    ra, dec, petro_r = (np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (ra, dec, petro_r))
+    r = petro_r / 3600  # convert to degrees
+
+    # Compute cutout sizes, radius is max of x and y distances between the center and the edge coordinates
+    x, y = wcs.all_world2pix(ra, dec, 0)
+    x_edge, y_edge = wcs.all_world2pix(ra + r, dec + r, 0)
+    radius = np.maximum(np.abs(x - x_edge), np.abs(y - y_edge))
+    # cutout radius is 1.25*radius rounded up to nearest 10
+    cutout_radius = np.ceil(1.25 * radius / 10) * 10
+
+    # Get cutout bounds in integer, clip them to the frame
+    min_y, max_y = np.trunc(y - cutout_radius).astype(int), np.trunc(y + cutout_radius).astype(int)
+    min_x, max_x = np.trunc(x - cutout_radius).astype(int), np.trunc(x + cutout_radius).astype(int)
+    height, width = data.shape
+    clipped = (min_y < 0) | (min_x < 0) | (max_y > height) | (max_x > width)
+    min_y, max_y = np.clip(min_y, 0, height), np.clip(max_y, 0, height)
+    min_x, max_x = np.clip(min_x, 0, width), np.clip(max_x, 0, width)
+
+    cutouts = [data[y0:y1, x0:x1] for y0, y1, x0, x1 in zip(min_y, max_y, min_x, max_x)]
+    return cutouts, clipped
+
+
+def resample_galaxies(data, wcs, ra, dec, petro_r, size, scale=None):
+    """Resample many galaxies from one frame onto grids centered on them, with vectorized wcs transforms
+
+    Grids are aligned to the sky, north up and east left, so grids of the same galaxy in different bands are
+    pixel-aligned. Frame data is bilinearly interpolated, grid pixels off the frame are 0.
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Frame image data
+    wcs : `astropy.wcs.WCS`
+        Frame wcs
+    ra : array-like
+        right ascension of each galaxy in degrees
+    dec : array-like
+        declination of each galaxy in degrees
+    petro_r : array-like
+        petrosian radius of each galaxy in arcsec
+    size : `tuple` of `int`
+        Grid (height, width) in pixels
+    scale : `float`, default=None
+        Grid half size, along its longer side, in units of the petrosian radius.
+        None to use the SDSS pixel scale for every galaxy
+
+    Returns
+    -------
+    grids : `numpy.ndarray`
+        float32 array of shape (number of galaxies, height, width)
+    clipped : `numpy.ndarray`
+        Whether each grid extends beyond the frame edges
+    """
+
+    ra, dec, petro_r = (np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (ra, dec, petro_r))
+    height, width = size
+
+    # Pixel scale of each grid in degrees
+    if scale is None:
+        pixel_scale = np.full(len(ra), SDSS_PIXEL_SCALE / 3600)
+    else:
+        pixel_scale = 2 * scale * petro_r / max(height, width) / 3600
+
+    # Sky coordinates of all grid pixels, offsets from the center along x go to the east, along y to the north
+    grid_y, grid_x = np.mgrid[:height, :width]
+    offset_x = (grid_x - (width - 1) / 2)[None] * pixel_scale[:, None, None]
+    offset_y = (grid_y - (height - 1) / 2)[None] * pixel_scale[:, None, None]
+    grid_dec = dec[:, None, None] + offset_y
+    grid_ra = ra[:, None, None] - offset_x / np.cos(np.radians(grid_dec))
+    x, y = wcs.all_world2pix(grid_ra.ravel(), grid_dec.ravel(), 0)
+
+    # Bilinear interpolation, from the 4 frame pixels around each grid pixel
+    frame_height, frame_width = data.shape
+    x0, y0 = np.floor(x).astype(int), np.floor(y).astype(int)
+    inside = (x0 >= 0) & (y0 >= 0) & (x0 < frame_width - 1) & (y0 < frame_height - 1)
+    x0, y0 = np.clip(x0, 0, frame_width - 2), np.clip(y0, 0, frame_height - 2)
+    fx, fy = x - x0, y - y0
+    values = (data[y0, x0] * (1 - fx) * (1 - fy) + data[y0, x0 + 1] * fx * (1 - fy) +
+              data[y0 + 1, x0] * (1 - fx) * fy + data[y0 + 1, x0 + 1] * fx * fy)
+    values[~inside] = 0
+
+    grids = values.reshape(len(ra), height, width).astype(np.float32)
+    clipped = ~inside.reshape(len(ra), -1).all(axis=1)
+    return grids, clipped
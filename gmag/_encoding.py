@@ -0,0 +1,113 @@
+"""Encoding of images as FITS, optionally tile compressed and downcast, to cut the size of the outputs
+
+Both are lossy: quantized compression keeps a fraction of the noise of each tile, set by the quantize level,
+and int16 keeps 65536 steps between the minimum and the maximum of the image, so a bright star in the image
+leaves few steps for the rest of it.
+"""
+
+import io
+
+COMPRESSIONS = {'rice': 'RICE_1', 'gzip': 'GZIP_2'}
+"""FITS tile compression algorithm of each compression option, GZIP_2 shuffles bytes to compress floats better"""
+
+DTYPES = ('float32', 'float16', 'int16')
+"""Stored data types, float16 only for tensors, int16 only for FITS, scaled with BSCALE and BZERO"""
+
+
+def image_hdu(data, name=None, encoding=None, header=None):
+    """Image extension of an image, tile compressed and scaled as the encoding asks
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Image data
+    name : `str`, default=None
+        Extension name
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype), compression is a key of `COMPRESSIONS` or None, quantize_level is the
+        quantization level of floats, 0 for lossless gzip, None if dtype is 'int16', as integers are compressed
+        losslessly, dtype is 'float32' or 'int16'. None to store as is
+    header : `astropy.io.fits.Header`, default=None
+        Header of the image
+
+    Returns
+    -------
+    hdu : `astropy.io.fits.ImageHDU` or `astropy.io.fits.CompImageHDU`
+    """
+
+    from astropy.io import fits
+
+    compression, quantize_level, dtype = encoding or (None, None, 'float32')
+    if dtype == 'int16':
+        # Scaling casts the data in place, data may be a view of a frame other cutouts are taken from
+        data = data.copy()
+    if compression is None:
+        hdu = fits.ImageHDU(data, header=header, name=name)
+    else:
+        hdu = fits.CompImageHDU(data, header=header, name=name, compression_type=COMPRESSIONS[compression],
+                                quantize_level=quantize_level)
+    if dtype == 'int16':
+        hdu.scale('int16', 'minmax')
+    return hdu
+
+
+def encode_file(data, encoding=None, header=None, extra_hdus=()):
+    """Encode an image as a FITS file, in the primary HDU, or in the first extension if tile compressed
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Image data
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `image_hdu`, None to store as is
+    header : `astropy.io.fits.Header`, default=None
+        Header of the image
+    extra_hdus : iterable of HDU, default=()
+        HDUs to append after the image, e.g. the other HDUs of an SDSS frame
+
+    Returns
+    -------
+    content : `bytes`
+        FITS file
+    """
+
+    from astropy.io import fits
+
+    if encoding is None or encoding[0] is None:
+        scaled = encoding is not None and encoding[2] == 'int16'
+        hdu = fits.PrimaryHDU(data.copy() if scaled else data, header=header)
+        if scaled:
+            hdu.scale('int16', 'minmax')
+        hdus = [hdu]
+    else:
+        # A tile compressed image is a binary table, it can not be the primary HDU
+        hdus = [fits.PrimaryHDU(), image_hdu(data, encoding=encoding, header=header)]
+
+    buffer = io.BytesIO()
+    fits.HDUList(hdus + list(extra_hdus)).writeto(buffer)
+    return buffer.getvalue()
+
+
+def describe(encoding):
+    """Lines describing an encoding, for the info file
+
+    Parameters
+    ----------
+    encoding : `tuple`
+        (compression, quantize_level, dtype) as in `image_hdu`
+
+    Returns
+    -------
+    lines : `list` of `str`
+    """
+
+    compression, quantize_level, dtype = encoding
+    lines = []
+    if compression is not None:
+        lines.append(f"Tile compressed with {COMPRESSIONS[compression]}" +
+                     (f", quantized at level {quantize_level}" if quantize_level else ", lossless"))
+    if dtype == 'int16':
+        lines.append("Stored as int16, scaled with BSCALE and BZERO")
+    elif dtype != 'float32':
+        lines.append(f"Stored as {dtype}")
+    return lines
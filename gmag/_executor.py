@@ -0,0 +1,265 @@
+"""Execution engines used to run download tasks concurrently"""
+
+import collections
+import contextlib
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+ENGINES = ('thread', 'process')
+
+
+def make_executor(engine, num_workers):
+    """Create an executor for an engine
+
+    Parameters
+    ----------
+    engine : `str`
+        'thread' for a thread pool, suited to network-bound tasks,
+        'process' for a process pool, suited to CPU-bound tasks
+    num_workers : `int`
+        Number of workers
+
+    Returns
+    -------
+    executor : `concurrent.futures.Executor`
+
+    Raises
+    ------
+    ValueError
+        Raised if engine is invalid
+    """
+
+    if engine == 'thread':
+        return ThreadPoolExecutor(num_workers)
+    elif engine == 'process':
+        return ProcessPoolExecutor(num_workers)
+    else:
+        raise ValueError(f"Invalid engine {engine}, must be one of {', '.join(ENGINES)}")
+
+
+class Pools:
+    """Long-lived executors reused across runs, one per role, engine and number of workers
+
+    Executors are created on first use and kept until `close`, so worker threads and processes,
+    and the keep-alive connections of their processes, are not set up again for every run.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._executors = {}
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __repr__(self):
+        return f"Pools[{', '.join(f'{role}:{engine}x{num_workers}' for role, engine, num_workers in self._executors)}]"
+
+    def get(self, role, engine, num_workers):
+        """Get the executor of a role, created on first use
+
+        Parameters
+        ----------
+        role : `str`
+            What the executor runs, e.g. 'search' or 'download', so tasks of one role never wait for another's
+        engine : `str`
+            'thread' or 'process'
+        num_workers : `int`
+            Number of workers
+
+        Returns
+        -------
+        executor : `concurrent.futures.Executor`
+
+        Raises
+        ------
+        ValueError
+            Raised if engine is invalid
+        RuntimeError
+            Raised if the pools are closed
+        """
+
+        key = (role, engine, num_workers)
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Pools are closed")
+            if key not in self._executors:
+                self._executors[key] = make_executor(engine, num_workers)
+            return self._executors[key]
+
+    def close(self, wait=True):
+        """Shut down all executors
+
+        Parameters
+        ----------
+        wait : `bool`, default=True
+            Whether to wait for running tasks to finish
+        """
+
+        with self._lock:
+            self.closed = True
+            executors, self._executors = list(self._executors.values()), {}
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+
+def borrow(pools, role, engine, num_workers):
+    """Get an executor for a run, to use as a context manager
+
+    Parameters
+    ----------
+    pools : `Pools`
+        Long-lived executors, None to create a new executor, shut down when the context exits
+    role : `str`
+        Role of the executor in pools
+    engine : `str`
+        'thread' or 'process'
+    num_workers : `int`
+        Number of workers
+
+    Returns
+    -------
+    context : context manager
+        Context manager giving the executor
+    """
+
+    if pools is None:
+        return make_executor(engine, num_workers)
+    # Executors of pools outlive the run
+    return contextlib.nullcontext(pools.get(role, engine, num_workers))
+
+
+def imap(executor, func, iterable, max_in_flight):
+    """Lazily apply func to every item of iterable with an executor, yield results in order
+
+    Unlike `Executor.map`, items are only taken from iterable when there is room,
+    so at most max_in_flight tasks are submitted at a time.
+
+    Parameters
+    ----------
+    executor : `concurrent.futures.Executor`
+    func : callable
+        Function taking a single item
+    iterable : iterable
+    max_in_flight : `int`
+        Maximum number of submitted tasks not yet yielded
+
+    Yields
+    ------
+    result
+        Return value of func for each item, in order of iterable
+    """
+
+    futures = collections.deque()
+    try:
+        for item in iterable:
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+            futures.append(executor.submit(func, item))
+
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def pipeline(first_executor, first_func, first_items, second_executor, second_func, plan, second_args,
+             first_in_flight, second_in_flight, queue_size, initial=(), return_exceptions=False, metrics=None,
+             can_submit=None):
+    """Run two stages of tasks concurrently, second stage work is planned from first stage results
+
+    Second stage work is keyed, and work planned for a key that is still waiting in the queue is merged into it,
+    e.g. galaxies on the same frame found by different searches share one download task.
+    New first stage tasks are only submitted while the queue holds fewer than queue_size keys (backpressure).
+
+    Parameters
+    ----------
+    first_executor : `concurrent.futures.Executor`
+    first_func : callable
+        Function taking a single first stage item
+    first_items : iterable
+        First stage items, taken lazily
+    second_executor : `concurrent.futures.Executor`
+    second_func : callable
+        Function taking the return value of second_args
+    plan : callable
+        Function taking a first stage item and its result, returning an iterable of (key, work list)
+    second_args : callable
+        Function taking a key and its merged work list, returning the argument of second_func
+    first_in_flight : `int`
+        Maximum number of first stage tasks submitted at a time
+    second_in_flight : `int`
+        Maximum number of second stage tasks submitted at a time
+    queue_size : `int`
+        Maximum number of keys waiting in the queue before first stage submission pauses
+    initial : iterable, default=()
+        (key, work list) to queue before any first stage result
+    return_exceptions : `bool`, default=False
+        Whether to yield the exception raised by a task as its result, instead of raising it.
+        Nothing is planned from a failed first stage task
+    metrics : `._metrics.Metrics`, default=None
+        Metrics to record the time each key waits in the queue in, as 'queue_wait', None to not record it
+    can_submit : callable, default=None
+        Function taking no argument, returning whether new first stage tasks can be submitted, checked again
+        after every result is yielded, e.g. to bound the results the consumer holds. None to always submit
+
+    Yields
+    ------
+    stage : `int`
+        0 for a first stage result, 1 for a second stage result, in order of completion
+    item
+        First stage item, or (key, work list) for the second stage
+    result
+        Return value of the stage function, or exception raised by it if return_exceptions is True
+    """
+
+    queue = collections.OrderedDict()
+    queued_at = {}
+
+    def enqueue(planned):
+        for key, work in planned:
+            if key not in queue:
+                queued_at[key] = time.perf_counter()
+            queue.setdefault(key, []).extend(work)
+
+    enqueue(initial)
+    items = iter(first_items)
+    exhausted = False
+    first_pending, second_pending = {}, {}
+    try:
+        while True:
+            while queue and len(second_pending) < second_in_flight:
+                key, work = queue.popitem(last=False)
+                if metrics is not None:
+                    metrics.observe('queue_wait', time.perf_counter() - queued_at[key])
+                del queued_at[key]
+                second_pending[second_executor.submit(second_func, second_args(key, work))] = (key, work)
+
+            while not exhausted and len(first_pending) < first_in_flight and len(queue) < queue_size and \
+                    (can_submit is None or can_submit()):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                first_pending[first_executor.submit(first_func, item)] = item
+
+            if not first_pending and not second_pending:
+                break
+
+            done, _ = wait(list(first_pending) + list(second_pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception() if return_exceptions else None
+                if future in first_pending:
+                    item = first_pending.pop(future)
+                    if error is not None:
+                        yield 0, item, error
+                        continue
+                    result = future.result()
+                    yield 0, item, result
+                    enqueue(plan(item, result))
+                else:
+                    yield 1, second_pending.pop(future), error if error is not None else future.result()
+    finally:
+        for future in list(first_pending) + list(second_pending):
+            future.cancel()
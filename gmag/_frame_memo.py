@@ -0,0 +1,84 @@
+"""Frames fetched by the download tasks of a run, kept in memory so a frame needed by several tasks is fetched once
+
+Galaxies on the same frame found by different searches are downloaded by different tasks, unless they wait in the
+download queue together. Tasks of a run share a memo of the last frames fetched, and a task asking for a frame
+another task is still fetching waits for it instead of fetching it again.
+"""
+
+import collections
+import threading
+from concurrent.futures import Future
+
+
+class FrameMemo:
+    """Least recently used frames fetched by the tasks of a run, shared by its threads
+
+    A memo sent to another process starts empty there, frames are only shared by the threads of a process.
+
+    Parameters
+    ----------
+    max_frames : `int`
+        Maximum number of frames kept, frames still being fetched included
+    """
+
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self._frames = collections.OrderedDict()  # url -> Future of the frame
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"FrameMemo[{len(self._frames)}/{self.max_frames}]"
+
+    def __getstate__(self):
+        return {'max_frames': self.max_frames}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_frames'])
+
+    def get(self, url, fetch):
+        """Get the frame of an url, fetched once by the first task asking for it
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+        fetch : callable
+            Function taking no argument, returning the frame, called if the frame is not in the memo
+
+        Returns
+        -------
+        frame
+            Return value of fetch, of this task or of the task which fetched it first
+        reused : `bool`
+            Whether the frame was fetched by another task
+
+        Raises
+        ------
+        Exception
+            Raised if fetch raised it, here or in the task fetching the frame this task waited for.
+            A failed frame is not kept, the next task asking for it fetches it again
+        """
+
+        with self._lock:
+            future = self._frames.get(url)
+            reused = future is not None
+            if reused:
+                self._frames.move_to_end(url)
+            else:
+                future = self._frames[url] = Future()
+                while len(self._frames) > self.max_frames:
+                    self._frames.popitem(last=False)
+
+        if reused:
+            return future.result(), True
+
+        try:
+            frame = fetch()
+        except BaseException as e:
+            with self._lock:
+                if self._frames.get(url) is future:
+                    del self._frames[url]
+            future.set_exception(e)
+            raise
+        future.set_result(frame)
+        return frame, False
@@ -0,0 +1,329 @@
+"""Shared HTTP session with keep-alive connection pools, one per process
+
+Requests to each host are limited by an adaptive concurrency limit, and failed requests are retried
+with jittered exponential backoff, as are streamed bodies whose connection breaks while they are read.
+"""
+
+import contextlib
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from . import _metrics
+
+POOL_SIZE = 256
+"""Maximum number of kept-alive connections per host"""
+
+TIMEOUT = 60
+"""Timeout in seconds for connecting and for each read"""
+
+MAX_RETRIES = 5
+"""Maximum number of retries of a failed request"""
+
+BACKOFF_BASE = 0.5
+"""Backoff in seconds before the first retry, doubled at each retry"""
+
+BACKOFF_CAP = 30
+"""Maximum backoff in seconds"""
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+"""HTTP status codes of failed requests that are retried"""
+
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+"""Errors of failed requests that are retried, connection errors, timeouts and bodies cut short"""
+
+INITIAL_LIMIT = 8
+"""Initial number of requests in flight to each host"""
+
+LATENCY_FACTOR = 3
+"""Latency over this factor times the lowest recent latency of a host is a sign of congestion"""
+
+_session = None
+_session_pid = None
+_limiters = {}
+_limiters_pid = None
+_lock = threading.Lock()
+
+
+class HostLimiter:
+    """Adaptive limit of the number of requests in flight to one host, safe to share between threads
+
+    The limit grows additively, by about one per round of requests, while responses are fast, and
+    shrinks multiplicatively on congestion: halved on a failed request, by 10% on a slow response (AIMD).
+
+    Parameters
+    ----------
+    limit : `int`, default=INITIAL_LIMIT
+        Initial limit
+    max_limit : `int`, default=POOL_SIZE
+        Maximum limit
+    """
+
+    def __init__(self, limit=INITIAL_LIMIT, max_limit=POOL_SIZE):
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.min_latency = None
+        """Lowest recent latency in seconds, slowly forgotten so it can follow the host"""
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return f"HostLimiter[{self.in_flight}/{int(self.limit)}]"
+
+    def acquire(self):
+        """Wait until a request can be sent"""
+
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None):
+        """Record the end of a request and adapt the limit
+
+        Parameters
+        ----------
+        latency : `float`, default=None
+            Time in seconds to get the response, None if the request failed
+        """
+
+        with self._cond:
+            self.in_flight -= 1
+            if latency is None:
+                self.limit = max(1., self.limit / 2)
+            else:
+                self.min_latency = latency if self.min_latency is None else min(latency, self.min_latency * 1.05)
+                if latency > LATENCY_FACTOR * self.min_latency:
+                    self.limit = max(1., self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+def get_session():
+    """Get the HTTP session of the current process, shared by all threads
+
+    A new session is created after a fork, so processes never share connections.
+
+    Returns
+    -------
+    session : `requests.Session`
+    """
+
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session, _session_pid = session, os.getpid()
+
+    return _session
+
+
+def get_limiter(url):
+    """Get the limiter of the host of an url, in the current process
+
+    Parameters
+    ----------
+    url : `str`
+
+    Returns
+    -------
+    limiter : `HostLimiter`
+    """
+
+    global _limiters, _limiters_pid
+
+    host = urllib.parse.urlsplit(url).netloc
+    with _lock:
+        # Limiters are per process, like the session
+        if _limiters_pid != os.getpid():
+            _limiters, _limiters_pid = {}, os.getpid()
+        if host not in _limiters:
+            _limiters[host] = HostLimiter()
+        return _limiters[host]
+
+
+def get(url, **kwargs):
+    """Send a GET request with the shared session, within the limit of the host, retrying failures
+
+    `RETRY_ERRORS` and `RETRY_STATUS` responses are retried up to `MAX_RETRIES` times,
+    after a random backoff up to `BACKOFF_BASE` * 2 ** retry seconds, capped at `BACKOFF_CAP`,
+    or as long as the Retry-After header of the response asks, up to `BACKOFF_CAP`.
+
+    Parameters
+    ----------
+    url : `str`
+    **kwargs
+        Keyword arguments to pass to `requests.Session.get`
+
+    Returns
+    -------
+    response : `requests.Response`
+
+    Raises
+    ------
+    requests.HTTPError
+        Raised if the response status is an error
+    requests.ConnectionError
+        Raised if can not connect to the host
+    requests.Timeout
+        Raised if the request timed out
+    requests.RequestException
+        Raised if the body was cut short, or any other error of the request
+    """
+
+    kwargs.setdefault('timeout', TIMEOUT)
+    limiter = get_limiter(url)
+    for retry in range(MAX_RETRIES + 1):
+        retry_after = 0
+        latency = None  # only a response adapts the limit to its latency, any error halves it
+        limiter.acquire()
+        try:
+            response = get_session().get(url, **kwargs)
+            response.raise_for_status()
+            latency = response.elapsed.total_seconds()
+            return response
+        except RETRY_ERRORS:
+            if retry == MAX_RETRIES:
+                raise
+        except requests.HTTPError as e:
+            e.response.close()
+            if e.response.status_code not in RETRY_STATUS:
+                latency = e.response.elapsed.total_seconds()
+                raise
+            if retry == MAX_RETRIES:
+                raise
+            with contextlib.suppress(ValueError):
+                retry_after = float(e.response.headers.get('Retry-After', 0))
+        finally:
+            # Released on every exit, a slot held by a failed request would never be given back
+            limiter.release(latency)
+
+        _metrics.add('http_retries')
+        time.sleep(max(min(retry_after, BACKOFF_CAP), random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** retry))))
+
+
+def get_content(url, **kwargs):
+    """Download the content of an url with the shared session
+
+    Parameters
+    ----------
+    url : `str`
+    **kwargs
+        Keyword arguments to pass to `requests.Session.get`
+
+    Returns
+    -------
+    content : `bytes`
+    """
+
+    content = get(url, **kwargs).content
+    _metrics.add('bytes_downloaded', len(content))
+    return content
+
+
+@contextlib.contextmanager
+def open_url(url):
+    """Open an url as a readable binary stream with the shared session
+
+    If the connection breaks while the body is read, the url is requested again and read on from where it broke,
+    retried as in `get`, so errors of the connection are raised as `requests` exceptions like those of `get`.
+
+    Parameters
+    ----------
+    url : `str`
+
+    Yields
+    ------
+    stream : file-like
+        Binary stream of the response body
+    """
+
+    stream = _BodyStream(url)
+    try:
+        yield stream
+    finally:
+        stream.close()
+
+
+class _BodyStream:
+    """Binary stream of the body of an url, requested again and read on from where it broke if its connection breaks
+
+    Bytes already read are skipped in the body of the new response, so any server can resume it.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.position = 0
+        """Number of bytes of the body read"""
+        self.retries = 0
+        self._response = None
+        self._open()
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, all the rest if size is negative, b'' at the end"""
+
+        while True:
+            if self._response is None:
+                self._open()
+            try:
+                # Bytes of a new response already read from the broken one are skipped
+                while self._skip:
+                    skipped = len(self._read(min(self._skip, 1024 * 1024)))
+                    if not skipped:
+                        raise requests.exceptions.ChunkedEncodingError("Body is shorter than before")
+                    self._skip -= skipped
+                data = self._read(size)
+            except RETRY_ERRORS:
+                self._close_response()
+                if self.retries == MAX_RETRIES:
+                    raise
+                _metrics.add('http_retries')
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** self.retries)))
+                self.retries += 1
+                continue
+            self.position += len(data)
+            return data
+
+    def close(self):
+        """Close the connection"""
+
+        self._close_response()
+
+    def _open(self):
+        self._response = get(self.url, stream=True)
+        self._response.raw.decode_content = True
+        # A body shorter than its Content-Length is an error, not the end of the body
+        self._response.raw.enforce_content_length = True
+        self._skip = self.position
+
+    def _read(self, size):
+        # Errors of the connection are raised as requests exceptions, as `requests.Response.iter_content` does
+        try:
+            return self._response.raw.read(None if size is None or size < 0 else size)
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+
+    def _close_response(self):
+        if self._response is not None:
+            # Bytes read from the connection, before decoding
+            _metrics.add('bytes_downloaded', self._response.raw.tell())
+            self._response.close()
+            self._response = None
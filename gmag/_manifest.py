@@ -0,0 +1,204 @@
+"""Checkpoint manifest of a download run, used to resume interrupted runs"""
+
+import hashlib
+import json
+
+FILE_NAME = 'manifest.jsonl'
+"""Name of the manifest file in the output directory"""
+
+RESUME_PARAMS = ('num_rows', 'bands', 'ra_col', 'dec_col', 'name_col', 'max_search_radius', 'cutout', 'output_format',
+                 'grid_size', 'grid_scale', 'partition', 'partition_by', 'encoding')
+"""Run parameters that must not change when resuming a run"""
+
+
+class Manifest:
+    """Append-only JSON lines record of the completed searches and files of a download run
+
+    Parameters
+    ----------
+    path : `pathlib.Path`
+        Path of the manifest file, records already in it are loaded
+
+    Notes
+    -----
+    Each line is one record, with a 'type' key of 'params', 'search' or 'file'.
+    A line cut short by a crash is ignored, the work it recorded is simply redone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.params = None
+        self.searches = {}
+        """Galaxy dict or None for each searched row id"""
+        self.files = {}
+        """File record dict with keys 'path', 'size', 'sha256', 'shape' and, for cutouts, 'clipped'
+        for each (row id, band), path is relative to the directory of the manifest.
+        Records of cutouts in shards also have keys 'ext' and 'offset', locating them in the shard at path,
+        records of grids in a tensor have key 'offset'"""
+
+        for record in iter_records(path):
+            try:
+                self._load(record)
+            except KeyError:
+                continue
+
+        self._file = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the manifest file"""
+
+        self._file.close()
+
+    def check_params(self, params):
+        """Record the run parameters, or check them against the recorded ones when resuming
+
+        Parameters
+        ----------
+        params : `dict`
+            Run parameters, must be json serializable
+
+        Raises
+        ------
+        ValueError
+            Raised if a parameter in `RESUME_PARAMS` differs from the recorded run
+        """
+
+        if self.params is None:
+            self._append({'type': 'params', **params})
+            return
+
+        for key in RESUME_PARAMS:
+            if self.params.get(key) != params.get(key):
+                raise ValueError(f"Can not resume run in {self.path.parent}, {key} was {self.params.get(key)!r} "
+                                 f"but is now {params.get(key)!r}")
+
+    def add_search(self, row_id, galaxy):
+        """Record the search result of a row
+
+        Parameters
+        ----------
+        row_id : `int`
+        galaxy : `dict` or `None`
+        """
+
+        self._append({'type': 'search', 'row': row_id, 'galaxy': galaxy})
+
+    def add_file(self, row_id, band, record):
+        """Record a completed file of a row
+
+        Parameters
+        ----------
+        row_id : `int`
+        band : `str`
+        record : `dict`
+            File record with keys 'path', 'size', 'sha256', 'shape', path relative to the manifest directory
+        """
+
+        self._append({'type': 'file', 'row': row_id, 'band': band, **record})
+
+    def is_done(self, row_id, band, path):
+        """Whether a file is recorded as completed and still on disk with the recorded size and sha256
+
+        Files are read again to check their sha256, so a file changed or cut short after it was recorded is redone
+
+        Parameters
+        ----------
+        row_id : `int`
+        band : `str`
+        path : `str` or `None`
+            File path relative to the manifest directory, None for a cutout in any shard
+
+        Returns
+        -------
+        done : `bool`
+        """
+
+        record = self.files.get((row_id, band))
+        if record is None or (path is not None and record['path'] != path):
+            return False
+        try:
+            size = (self.path.parent / record['path']).stat().st_size
+        except FileNotFoundError:
+            return False
+        # A cutout in a shard, or a grid in a tensor, is done if the file still holds its byte range
+        offset = record.get('offset', 0)
+        if 'offset' in record:
+            if size < offset + record['size']:
+                return False
+        elif size != record['size']:
+            return False
+        return 'sha256' not in record or _sha256(self.path.parent / record['path'], offset,
+                                                 record['size']) == record['sha256']
+
+    def forget(self, row_id):
+        """Drop the records of a row from memory, once they are no longer needed, they stay in the file
+
+        Parameters
+        ----------
+        row_id : `int`
+        """
+
+        self.searches.pop(row_id, None)
+        for band in 'ugriz':
+            self.files.pop((row_id, band), None)
+
+    def _append(self, record):
+        self._load(record)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def _load(self, record):
+        if record['type'] == 'params':
+            self.params = {k: v for k, v in record.items() if k != 'type'}
+        elif record['type'] == 'search':
+            self.searches[record['row']] = record['galaxy']
+        elif record['type'] == 'file':
+            self.files[(record['row'], record['band'])] = {k: v for k, v in record.items()
+                                                           if k not in ('type', 'row', 'band')}
+
+
+def _sha256(path, offset, size, chunk_size=1024 * 1024):
+    """sha256 hex digest of a byte range of a file, read in chunks"""
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            chunk = f.read(min(size, chunk_size))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size -= len(chunk)
+    return sha256.hexdigest()
+
+
+def iter_records(path):
+    """Read the records of a manifest file one by one, without loading them all
+
+    Parameters
+    ----------
+    path : `pathlib.Path`
+        Path of the manifest file
+
+    Yields
+    ------
+    record : `dict`
+        Record of each valid line, lines cut short by a crash are skipped. Nothing if the file does not exist
+    """
+
+    if not path.exists():
+        return
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and 'type' in record:
+                yield record
@@ -0,0 +1,217 @@
+"""Performance metrics of the stages of a download run
+
+Workers record into the `Metrics` of the task they run, set with `capture`, and return it with the task result,
+so metrics of tasks run in other processes are merged in the main process. Recording outside of `capture` is a no-op.
+"""
+
+import contextlib
+import math
+import threading
+import time
+
+BUCKETS = tuple(1e-4 * 2 ** k for k in range(24))
+"""Upper bounds in seconds of the histogram buckets, from 0.1 ms to about 14 minutes"""
+
+_local = threading.local()
+
+
+class Histogram:
+    """Histogram of durations in seconds, with log spaced buckets"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = 0.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        """Record a duration
+
+        Parameters
+        ----------
+        seconds : `float`
+        """
+
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[next((k for k, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))] += 1
+
+    def merge(self, other):
+        """Add the durations recorded in another histogram
+
+        Parameters
+        ----------
+        other : `Histogram`
+        """
+
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q):
+        """Approximate quantile, as the upper bound of the bucket holding it
+
+        Parameters
+        ----------
+        q : `float`
+            Quantile between 0 and 1
+
+        Returns
+        -------
+        seconds : `float`
+        """
+
+        rank = q * self.count
+        total = 0
+        for k, count in enumerate(self.buckets):
+            total += count
+            if total >= rank and count:
+                return min(BUCKETS[k], self.max) if k < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        """Summary of the histogram, json serializable
+
+        Returns
+        -------
+        summary : `dict`
+            Dictionary with keys 'count', 'sum', 'mean', 'min', 'max', 'p50', 'p90', 'p99' and 'buckets',
+            a list of [upper bound, count] for non-empty buckets, the last upper bound is null
+        """
+
+        if not self.count:
+            return {'count': 0, 'sum': 0.}
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count, 'min': self.min, 'max': self.max,
+                'p50': self.quantile(.5), 'p90': self.quantile(.9), 'p99': self.quantile(.99),
+                'buckets': [[BUCKETS[k] if k < len(BUCKETS) else None, count]
+                            for k, count in enumerate(self.buckets) if count]}
+
+
+class Metrics:
+    """Counters, tallies and duration histograms, mergeable across tasks"""
+
+    def __init__(self):
+        self.counters = {}
+        self.tallies = {}
+        self.histograms = {}
+
+    def add(self, name, value=1):
+        """Add to a counter"""
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def tally(self, name, key):
+        """Count an occurrence of a key, e.g. the number of retries of a row"""
+
+        tally = self.tallies.setdefault(name, {})
+        tally[key] = tally.get(key, 0) + 1
+
+    def observe(self, name, seconds):
+        """Record a duration in a histogram"""
+
+        self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    def merge(self, other):
+        """Add everything recorded in other metrics
+
+        Parameters
+        ----------
+        other : `Metrics`
+        """
+
+        for name, value in other.counters.items():
+            self.add(name, value)
+        for name, tally in other.tallies.items():
+            for key, count in tally.items():
+                self.tallies.setdefault(name, {})
+                self.tallies[name][key] = self.tallies[name].get(key, 0) + count
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def to_dict(self):
+        """Everything recorded, json serializable
+
+        Returns
+        -------
+        metrics : `dict`
+            Dictionary with keys 'counters', 'tallies' and 'histograms'
+        """
+
+        return {'counters': dict(self.counters),
+                'tallies': {name: {str(key): count for key, count in sorted(tally.items())}
+                            for name, tally in self.tallies.items()},
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}}
+
+
+@contextlib.contextmanager
+def capture():
+    """Record the metrics of the current thread in new metrics
+
+    Yields
+    ------
+    metrics : `Metrics`
+    """
+
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = Metrics()
+    try:
+        yield _local.metrics
+    finally:
+        _local.metrics = previous
+
+
+def _current():
+    return getattr(_local, 'metrics', None)
+
+
+def add(name, value=1):
+    """Add to a counter of the current metrics"""
+
+    if _current() is not None:
+        _current().add(name, value)
+
+
+def tally(name, key):
+    """Count an occurrence of a key in the current metrics"""
+
+    if _current() is not None:
+        _current().tally(name, key)
+
+
+def observe(name, seconds):
+    """Record a duration in the current metrics"""
+
+    if _current() is not None:
+        _current().observe(name, seconds)
+
+
+def merge(metrics):
+    """Add metrics recorded elsewhere, e.g. in another process, to the current metrics"""
+
+    if _current() is not None:
+        _current().merge(metrics)
+
+
+@contextlib.contextmanager
+def timer(name, cpu=False):
+    """Record the duration of a block in the current metrics
+
+    Parameters
+    ----------
+    name : `str`
+        Histogram name
+    cpu : `bool`, default=False
+        Whether to record the CPU time of the current thread instead of the wall time
+    """
+
+    clock = time.thread_time if cpu else time.perf_counter
+    start = clock()
+    try:
+        yield
+    finally:
+        observe(name, clock() - start)
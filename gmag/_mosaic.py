@@ -0,0 +1,89 @@
+"""Contact sheets assembling many galaxy thumbnails into a few large mosaic images, in a single pass"""
+
+import csv
+
+SHEET_PREFIX = 'mosaic'
+"""Prefix of the contact sheet file names, in the thumbnail directory"""
+
+INDEX_FILE_NAME = 'mosaic.csv'
+"""Name of the index file of the contact sheets, in the thumbnail directory"""
+
+
+class ContactSheetWriter:
+    """Paste thumbnails into tiles of contact sheets, each sheet is saved as soon as it is full
+
+    Parameters
+    ----------
+    sheet_dir : `pathlib.Path`
+        Directory to save the sheets and their index in
+    tile_size : `int`
+        Size in pixels of the square tiles, thumbnails are resized to fit
+    shape : `tuple` of `int`, default=(8, 8)
+        Number of (rows, columns) of tiles of a sheet
+
+    Notes
+    -----
+    Only the current sheet is kept in memory. The index maps each tile to the row id and objid of its galaxy.
+    """
+
+    def __init__(self, sheet_dir, tile_size, shape=(8, 8)):
+        self.sheet_dir = sheet_dir
+        self.tile_size = tile_size
+        self.shape = shape
+        self.num_sheets = 0
+        self._sheet = None
+        self._num_tiles = 0
+        self._index_file = open(sheet_dir / INDEX_FILE_NAME, 'w', newline='')
+        self._index = csv.writer(self._index_file)
+        self._index.writerow(['sheet', 'tile_row', 'tile_col', 'row', 'objid'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, row_id, objid, path):
+        """Paste a thumbnail into the next tile
+
+        Parameters
+        ----------
+        row_id : `int`
+            Row id of the galaxy
+        objid : `int` or `str`
+            SDSS objid of the galaxy
+        path : `pathlib.Path`
+            Path of the jpg thumbnail
+        """
+
+        from PIL import Image
+
+        if self._sheet is None:
+            self._sheet = Image.new('RGB', (self.shape[1] * self.tile_size, self.shape[0] * self.tile_size))
+            self._num_tiles = 0
+
+        tile_row, tile_col = divmod(self._num_tiles, self.shape[1])
+        with Image.open(path) as thumbnail:
+            if thumbnail.size != (self.tile_size, self.tile_size):
+                thumbnail = thumbnail.resize((self.tile_size, self.tile_size))
+            self._sheet.paste(thumbnail.convert('RGB'), (tile_col * self.tile_size, tile_row * self.tile_size))
+        self._index.writerow([self._sheet_name(), tile_row, tile_col, row_id, objid])
+        self._num_tiles += 1
+
+        if self._num_tiles == self.shape[0] * self.shape[1]:
+            self._save()
+
+    def close(self):
+        """Save the last sheet, even if not full, and close the index"""
+
+        if self._sheet is not None:
+            self._save()
+        self._index_file.close()
+
+    def _sheet_name(self):
+        return f"{SHEET_PREFIX}-{self.num_sheets:05d}.jpg"
+
+    def _save(self):
+        self._sheet.save(self.sheet_dir / self._sheet_name(), quality=90)
+        self._sheet = None
+        self.num_sheets += 1
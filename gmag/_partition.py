@@ -0,0 +1,89 @@
+"""Deterministic split of the rows of a catalog into partitions, to download one catalog on many machines"""
+
+import numpy as np
+
+BY = ('rows', 'sky')
+"""Ways to split rows, into contiguous row ranges or into regions of the sky"""
+
+CELL_SIZE = 0.5
+"""Size in degrees of the sky cells kept in one partition, about twice the size of an SDSS frame"""
+
+
+def assign(rows, ra, dec, num_rows, count, by='rows'):
+    """Partition of each row of a catalog
+
+    Parameters
+    ----------
+    rows : array-like of `int`
+        Row ids
+    ra : array-like of `float`
+        Right ascension of each row in degrees
+    dec : array-like of `float`
+        Declination of each row in degrees
+    num_rows : `int`
+        Number of rows of the catalog
+    count : `int`
+        Number of partitions
+    by : `str`, default='rows'
+        'rows' to split into contiguous ranges of rows of nearly equal size,
+        'sky' to split into cells of the sky of `CELL_SIZE` degrees spread evenly over partitions,
+        so galaxies on the same frame are mostly in the same partition
+
+    Returns
+    -------
+    partitions : `numpy.ndarray`
+        Partition index of each row, from 0 to count - 1
+
+    Raises
+    ------
+    ValueError
+        Raised if by is invalid
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    if by == 'rows':
+        return rows * count // max(num_rows, 1)
+    if by != 'sky':
+        raise ValueError(f"Invalid partition_by {by}, must be one of {', '.join(BY)}")
+
+    # Cells of equal area, ra cells are wider away from the equator
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    dec_cell = np.floor((dec + 90) / CELL_SIZE)
+    ra_cell = np.floor(ra % 360 * np.cos(np.radians((dec_cell + 0.5) * CELL_SIZE - 90)) / CELL_SIZE)
+    cell = (dec_cell.astype(np.uint64) << np.uint64(32)) | ra_cell.astype(np.uint64)
+
+    # Fixed multiplicative hash, so every machine computes the same partitions
+    with np.errstate(over='ignore'):
+        hashed = (cell * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    return (hashed % np.uint64(count)).astype(np.int64)
+
+
+def rows_of(index, count, num_rows, by='rows', chunks=()):
+    """Row ids of one partition, in order
+
+    Parameters
+    ----------
+    index : `int`
+        Partition index
+    count : `int`
+        Number of partitions
+    num_rows : `int`
+        Number of rows of the catalog
+    by : `str`, default='rows'
+        How rows are split, as in `assign`
+    chunks : iterable of `tuple`, default=()
+        (start, ra, dec, names) of each chunk of rows of the catalog, as yielded by `._reader.CatalogReader.chunks`,
+        only read if by is 'sky'
+
+    Returns
+    -------
+    rows : `numpy.ndarray`
+        Row ids of the partition, in increasing order
+    """
+
+    if by == 'rows':
+        # Rows i with i * count // num_rows == index
+        return np.arange(-(-index * num_rows // count), -(-(index + 1) * num_rows // count), dtype=np.int64)
+    parts = [start + np.flatnonzero(assign(range(start, start + len(ra)), ra, dec, num_rows, count, by) == index)
+             for start, ra, dec, _ in chunks]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
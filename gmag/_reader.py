@@ -0,0 +1,169 @@
+"""Chunked reader of input catalogs, so large catalogs are never loaded at once"""
+
+import csv
+import itertools
+import pathlib
+
+import numpy as np
+
+FITS_SUFFIXES = ('.fits', '.fit', '.fts')
+"""Suffixes of fits files read in chunks"""
+
+CSV_SUFFIXES = ('.csv',)
+"""Suffixes of csv files read in chunks"""
+
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+"""Suffixes of parquet files read in chunks, requires pyarrow"""
+
+
+class CatalogReader:
+    """Read ra, dec and names of the rows of a catalog file, in chunks of rows
+
+    Parameters
+    ----------
+    file : `str` or `pathlib.Path`
+        Catalog file
+    ra_col : `str`
+        Name of ra column
+    dec_col : `str`
+        Name of dec column
+    name_col : `str`, default=None
+        Name of galaxy name column, None if there is none
+    chunk_size : `int`, default=None
+        Number of rows per chunk, None to read the whole file at once with `astropy.table.Table.read`.
+        Fits, csv and parquet files are read in chunks, other formats are read at once and split into chunks
+
+    Raises
+    ------
+    OSError
+        Raised if can not read file
+    KeyError
+        Raised if ra or dec column is not found in file
+    ImportError
+        Raised if file is parquet, chunk_size is not None and pyarrow is not installed
+
+    Notes
+    -----
+    If name_col is not found in file, `has_names` is False and chunks have no names.
+    """
+
+    def __init__(self, file, ra_col, dec_col, name_col=None, chunk_size=None):
+        self.file = file
+        self.chunk_size = chunk_size
+        self._table = None
+
+        suffix = pathlib.Path(file).suffix.lower()
+        if chunk_size is None or suffix not in FITS_SUFFIXES + CSV_SUFFIXES + PARQUET_SUFFIXES:
+            self._format = 'table'
+        elif suffix in FITS_SUFFIXES:
+            self._format = 'fits'
+        elif suffix in CSV_SUFFIXES:
+            self._format = 'csv'
+        else:
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise ImportError("pyarrow is required to read parquet files in chunks, "
+                                  "install it with `pip install gmag[parquet]`")
+            self._format = 'parquet'
+
+        try:
+            columns, self.num_rows = getattr(self, f"_inspect_{self._format}")()
+        except (OSError, ValueError, StopIteration):
+            raise OSError(f"Could not open file {file}")
+
+        if ra_col not in columns or dec_col not in columns:
+            raise KeyError(f"Could not find ra column '{ra_col}' or dec column '{dec_col}' in file {file}")
+        self.columns = [ra_col, dec_col]
+        self.has_names = name_col is not None and name_col in columns
+        if self.has_names:
+            self.columns.append(name_col)
+
+    def __len__(self):
+        return self.num_rows
+
+    def chunks(self):
+        """Read the catalog in chunks of rows
+
+        Yields
+        ------
+        start : `int`
+            Row id of the first row of the chunk
+        ra : `numpy.ndarray`
+            ra of each row of the chunk
+        dec : `numpy.ndarray`
+            dec of each row of the chunk
+        names : `list` of `str` or `None`
+            Name of each row of the chunk, None if the catalog has no names
+        """
+
+        start = 0
+        for chunk in getattr(self, f"_chunks_{self._format}")():
+            ra, dec = (np.asarray(col, dtype=np.float64) for col in chunk[:2])
+            names = [str(name) if name else '' for name in chunk[2]] if self.has_names else None
+            yield start, ra, dec, names
+            start += len(ra)
+
+    def _inspect_table(self):
+        from astropy.table import Table as AstropyTable
+
+        self._table = AstropyTable.read(self.file)
+        return self._table.colnames, len(self._table)
+
+    def _chunks_table(self):
+        size = self.chunk_size or max(len(self._table), 1)
+        for start in range(0, len(self._table), size):
+            yield [self._table[col][start:start + size] for col in self.columns]
+
+    def _inspect_fits(self):
+        from astropy.io import fits
+
+        with fits.open(self.file, memmap=True) as hdul:
+            hdu = next(hdu for hdu in hdul if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)))
+            return hdu.columns.names, hdu.header['NAXIS2']
+
+    def _chunks_fits(self):
+        from astropy.io import fits
+
+        with fits.open(self.file, memmap=True) as hdul:
+            hdu = next(hdu for hdu in hdul if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU)))
+            for start in range(0, self.num_rows, self.chunk_size):
+                rows = hdu.data[start:start + self.chunk_size]
+                yield [rows[col] for col in self.columns]
+
+    def _csv_rows(self, f):
+        # Comments and blank lines, e.g. a trailing empty line, are not rows, as with `astropy.table.Table.read`
+        return csv.reader(line for line in f if line.strip() and not line.startswith('#'))
+
+    def _inspect_csv(self):
+        with open(self.file, newline='') as f:
+            rows = self._csv_rows(f)
+            header = next(rows)
+            return header, sum(1 for _ in rows)
+
+    def _chunks_csv(self):
+        with open(self.file, newline='') as f:
+            rows = self._csv_rows(f)
+            header = next(rows)
+            indices = [header.index(col) for col in self.columns]
+            while True:
+                chunk = list(itertools.islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                ra, dec, *names = ([row[index] for row in chunk] for index in indices)
+                # Empty ra or dec is missing, like a masked value
+                yield [[float(value) if value else np.nan for value in ra],
+                       [float(value) if value else np.nan for value in dec], *names]
+
+    def _inspect_parquet(self):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(self.file)
+        return parquet_file.schema_arrow.names, parquet_file.metadata.num_rows
+
+    def _chunks_parquet(self):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(self.file)
+        for batch in parquet_file.iter_batches(batch_size=self.chunk_size, columns=self.columns):
+            yield [batch.column(col).to_pylist() for col in self.columns]
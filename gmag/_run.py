@@ -0,0 +1,416 @@
+"""State of a `.sdss.download_images` run, from reading rows of the catalog file to writing them to the info file
+
+Rows are read in chunks, those of other partitions are skipped, the others are searched, unless already resolved
+by an interrupted run, the local catalog or the search cache. Images of found galaxies not already done are
+grouped by frame into downloads, each downloaded image is stored in the output format, and rows are written to
+the info file in order once all their images are stored or failed.
+"""
+
+import collections
+import shutil
+import time
+
+import numpy as np
+
+from . import _cutout
+from . import _partition
+from . import _print_util as pu
+
+
+class Rows:
+    """Rows of a run from when they are read until they are written, in order, to the info file and shard index
+
+    Parameters
+    ----------
+    manifest : `._manifest.Manifest`
+        Manifest of the run, the search and files of a row are read from it when the row is written, then forgotten
+    bands : `list` of `str`
+        Bands of the run
+    cutout : `bool`
+        Whether images are cutouts
+    info_writer : `csv.writer`, default=None
+        Writer of the info file body, None to not write it
+    index_writer : `csv.writer`, default=None
+        Writer of the shard index, None to not write it
+
+    Attributes
+    ----------
+    counts : `collections.Counter`
+        Number of rows written ('rows'), 'found', 'failed' and 'clipped', and of 'duplicate_names', 'local_searches',
+        'cache_searches' and 'cache_hits' of the rows read
+    next_row : `int`
+        Row id of the next row to write
+    """
+
+    def __init__(self, manifest, bands, cutout, info_writer=None, index_writer=None):
+        self.manifest = manifest
+        self.bands = bands
+        self.cutout = cutout
+        self.info_writer = info_writer
+        self.index_writer = index_writer
+        self.counts = collections.Counter()
+        self.next_row = 0
+        self._inputs = {}  # (ra, dec, name) of each row read and not yet written, name can be None
+        self._remaining = {}  # number of images of a row still downloading
+        self._errors = {}  # first error of each failed row, failed rows are not recorded so a new run retries them
+        self._completed = set()
+        self._skipped = set()  # rows of other partitions, completed without being written
+        self._seen_names = set()
+
+    def read(self, i, ra, dec, name=None):
+        """Keep the inputs of a row until it is written
+
+        Parameters
+        ----------
+        i : `int`
+            Row id
+        ra : `float`
+        dec : `float`
+        name : `str`, default=None
+            Galaxy name, None to name it rowid_objid. A name already used by an earlier row is replaced with
+            rowid_objid
+        """
+
+        if name is not None:
+            if name in self._seen_names:
+                if not self.counts['duplicate_names']:
+                    print(pu.red(f"Names are not unique, using rowid_objid instead for repeated names"))
+                self.counts['duplicate_names'] += 1
+                name = None
+            else:
+                self._seen_names.add(name)
+        self._inputs[i] = (float(ra), float(dec), name)
+
+    def coords(self, row_ids):
+        """(row id, ra, dec) of each row read"""
+
+        return [(i, self._inputs[i][0], self._inputs[i][1]) for i in row_ids]
+
+    def name_of(self, i, gal):
+        """Directory name of the images of a row, its name or rowid_objid"""
+
+        return self._inputs[i][2] or f"{i}_{gal['objid']}"
+
+    def skip(self, i):
+        """Complete a row of another partition, it is not written"""
+
+        self._skipped.add(i)
+        self.complete(i)
+
+    def fail(self, i, error):
+        """Record an error of a row, only the first one is written"""
+
+        self._errors.setdefault(i, error)
+
+    def expect(self, i):
+        """Count one more image of a row to download"""
+
+        self._remaining[i] = self._remaining.get(i, 0) + 1
+
+    def is_expecting(self, i):
+        """Whether a row has images still downloading"""
+
+        return i in self._remaining
+
+    def image_done(self, i):
+        """Count an image of a row as stored or failed, the row is completed with its last image"""
+
+        self._remaining[i] -= 1
+        if not self._remaining[i]:
+            del self._remaining[i]
+            self.complete(i)
+
+    def complete(self, i):
+        """Mark a row as completed, and write the completed rows which follow the last row written"""
+
+        self._completed.add(i)
+        while self.next_row in self._completed:
+            self._completed.remove(self.next_row)
+            self._write(self.next_row)
+            self.next_row += 1
+
+    def _write(self, i):
+        if i in self._skipped:
+            self._skipped.remove(i)
+            return
+        self.counts['rows'] += 1
+        ra_orig, dec_orig, _ = self._inputs[i]
+        gal = self.manifest.searches.get(i)
+        error = self._errors.pop(i, None)
+        self.counts['failed'] += error is not None
+        if gal is None:
+            # Found is unknown if the search failed
+            if self.info_writer is not None:
+                self.info_writer.writerow([i, ra_orig, dec_orig, False if error is None else None, None, None, None,
+                                           None, None, None, error])
+        else:
+            # Same galaxy has one cutout shape for each band, keep the first band's, images of failed
+            # downloads are missing
+            records = {band: self.manifest.files[(i, band)] for band in self.bands
+                       if (i, band) in self.manifest.files}
+            record = records.get(self.bands[0])
+            cutout_shape = None if record is None else tuple(record['shape']) if self.cutout else record['shape']
+            # Galaxies near the frame edges have cutouts clipped in some band
+            clipped = any(record.get('clipped', False) for record in records.values()) if self.cutout else None
+            self.counts['found'] += 1
+            self.counts['clipped'] += bool(clipped)
+            if self.info_writer is not None:
+                self.info_writer.writerow([i, ra_orig, dec_orig, True, gal['ra'], gal['dec'], self.name_of(i, gal),
+                                           gal['objid'], cutout_shape, clipped, error])
+            if self.index_writer is not None:
+                for band, record in records.items():
+                    self.index_writer.writerow([i, band, record['path'], record['ext'], record['offset'],
+                                                record['size']])
+        del self._inputs[i]
+        self.manifest.forget(i)
+
+
+class ImageStore:
+    """Where the images of a run are stored, by output format
+
+    Parameters
+    ----------
+    parent_dir : `pathlib.Path`
+        Output directory of the run
+    bands : `list` of `str`
+        Bands of the run
+    output_format : `str`
+        'files', 'shards' or 'tensor'
+    shard_writer : `._shards.ShardWriter`, default=None
+        Writer of the shards, only used if output_format is 'shards'
+    tensor : `numpy.memmap`, default=None
+        Tensor of the grids, only used if output_format is 'tensor'
+    tensor_rows : `numpy.ndarray`, default=None
+        Sorted row ids of the tensor of a partition, row k of the tensor is row tensor_rows[k],
+        None if row i of the tensor is row i
+    """
+
+    def __init__(self, parent_dir, bands, output_format, shard_writer=None, tensor=None, tensor_rows=None):
+        self.parent_dir = parent_dir
+        self.bands = bands
+        self.output_format = output_format
+        self.shard_writer = shard_writer
+        self.tensor = tensor
+        self.tensor_rows = tensor_rows
+
+    def rel_paths(self, name):
+        """Path of each band of a galaxy relative to the output directory, creating its directory for files
+
+        Parameters
+        ----------
+        name : `str`
+            Directory name of the galaxy
+
+        Returns
+        -------
+        rel_paths : `dict`
+            Relative path of each band, None for shards, a cutout can be in any shard, known once written
+        """
+
+        if self.output_format == 'shards':
+            return {band: None for band in self.bands}
+        if self.output_format == 'tensor':
+            return {band: _cutout.TENSOR_FILE_NAME for band in self.bands}
+        (self.parent_dir / name).mkdir(exist_ok=True)
+        return {band: f"{name}/{band}.fits" for band in self.bands}
+
+    def store(self, i, band, rel_path, record, metrics):
+        """Store a downloaded image, if not already saved by its download task
+
+        Parameters
+        ----------
+        i : `int`
+            Row id
+        band : `str`
+        rel_path : `str` or `None`
+            Relative path of the image, from `rel_paths`
+        record : `dict`
+            Result of the download task, with key 'content' for shards, 'data' for the tensor
+        metrics : `._metrics.Metrics`
+            Metrics of the run, the write duration is observed in it
+
+        Returns
+        -------
+        record : `dict`
+            File record of the image, to add to the manifest
+        """
+
+        write_start = time.perf_counter()
+        if self.output_format == 'shards':
+            record = {**self.shard_writer.write(record.pop('content')), **record}
+            metrics.observe('write', time.perf_counter() - write_start)
+            return record
+        if self.output_format == 'tensor':
+            t = i if self.tensor_rows is None else int(np.searchsorted(self.tensor_rows, i))
+            b = self.bands.index(band)
+            self.tensor[t, b] = record.pop('data')
+            metrics.observe('write', time.perf_counter() - write_start)
+            # Record the byte range of the grid in the file, like a cutout in a shard
+            size = self.tensor[t, b].nbytes
+            return {'path': rel_path, 'offset': self.tensor.offset + size * (t * len(self.bands) + b), 'size': size,
+                    **record}
+        return {'path': rel_path, **record}
+
+
+def open_tensor(path, shape, dtype):
+    """Open the tensor of a run, created if it does not exist, rows not found are left as zeros
+
+    Parameters
+    ----------
+    path : `pathlib.Path`
+    shape : `tuple` of `int`
+    dtype : `str`
+
+    Returns
+    -------
+    tensor : `numpy.memmap`
+
+    Raises
+    ------
+    ValueError
+        Raised if the tensor of an interrupted run has another shape or dtype
+    """
+
+    if not path.exists():
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    tensor = np.load(path, mmap_mode='r+')
+    if tensor.shape != shape or tensor.dtype != np.dtype(dtype):
+        raise ValueError(f"Can not resume run in {path.parent}, {path.name} has shape {tensor.shape} and dtype "
+                         f"{tensor.dtype} but {shape} and {dtype} are needed")
+    return tensor
+
+
+def search_items(reader, rows, max_search_radius, search_batch_size, partition=None, partition_by='rows',
+                 local_catalog=None, search_cache=None, progress=None):
+    """Read rows from the catalog file, lazily in chunks, and yield them as search items
+
+    Parameters
+    ----------
+    reader : `._reader.CatalogReader`
+        Reader of the catalog file
+    rows : `Rows`
+        Rows of the run, rows read are kept there, and rows of other partitions are skipped
+    max_search_radius : `float`
+        Maximum search radius in arcmin
+    search_batch_size : `int`
+        Number of rows of an item
+    partition : `tuple` of `int`, default=None
+        (index, count) of the partition of the run, None to read all rows
+    partition_by : `str`, default='rows'
+        How rows are split into partitions, see `._partition.assign`
+    local_catalog : `._catalog.LocalCatalog`, default=None
+        Catalog to search rows in, instead of searching them in a task
+    search_cache : `.cache.SearchCache`, default=None
+        Cache of search results, rows found in it are not searched again
+    progress : `tqdm.tqdm`, default=None
+        Search progress bar, updated with the rows skipped
+
+    Yields
+    ------
+    item : `tuple`
+        (row ids, batched, coords, max_search_radius). Rows already resolved, by an interrupted run, the local
+        catalog or the search cache, are recorded in the manifest and yielded with batched None and their galaxies
+        in place of coords, the others are to be searched
+    """
+
+    manifest = rows.manifest
+    num_rows = len(reader)
+    for start, ra_list, dec_list, names in reader.chunks():
+        parts = None
+        if partition is not None:
+            parts = _partition.assign(range(start, start + len(ra_list)), ra_list, dec_list, num_rows, partition[1],
+                                      partition_by)
+        row_ids = []
+        for k, (ra, dec) in enumerate(zip(ra_list, dec_list)):
+            if parts is not None and parts[k] != partition[0]:
+                rows.skip(start + k)
+                if progress is not None:
+                    progress.update()
+                continue
+            # Empty names are replaced with rowid_unknown
+            rows.read(start + k, ra, dec, None if names is None else names[k] or f"{start + k}_unknown")
+            row_ids.append(start + k)
+
+        known = [i for i in row_ids if i in manifest.searches]
+        coords = rows.coords(i for i in row_ids if i not in manifest.searches)
+        if local_catalog is not None:
+            galaxies = local_catalog.search([ra for _, ra, _ in coords], [dec for _, _, dec in coords],
+                                            max_search_radius)
+            for (i, _, _), gal in zip(coords, galaxies):
+                manifest.add_search(i, gal)
+            rows.counts['local_searches'] += len(coords)
+            known, coords = row_ids, []
+        elif search_cache is not None:
+            cached = search_cache.get_many(coords, max_search_radius)
+            for i, gal in cached.items():
+                manifest.add_search(i, gal)
+            rows.counts['cache_searches'] += len(coords)
+            rows.counts['cache_hits'] += len(cached)
+            known = [i for i in row_ids if i in manifest.searches]
+            coords = [coord for coord in coords if coord[0] not in cached]
+
+        for b in range(0, len(known), search_batch_size):
+            batch = known[b:b + search_batch_size]
+            yield batch, None, [manifest.searches[i] for i in batch], max_search_radius
+        for b in range(0, len(coords), search_batch_size):
+            batch = coords[b:b + search_batch_size]
+            yield [i for i, _, _ in batch], search_batch_size > 1, batch, max_search_radius
+
+
+def plan_downloads(row_ids, rows, store):
+    """Group the images of searched rows by frame, so each frame is downloaded once for all galaxies on it
+
+    Images already done are skipped, rows not found or with all their images done are completed.
+
+    Parameters
+    ----------
+    row_ids : iterable of `int`
+        Rows searched
+    rows : `Rows`
+        Rows of the run, images planned are counted as expected there
+    store : `ImageStore`
+        Where images are stored
+
+    Returns
+    -------
+    frame_groups : `dict`
+        (run, camcol, field, band) of each frame to download, to the list of (row id, band, rel_path, galaxy)
+        of the images to cutout of it
+    """
+
+    manifest = rows.manifest
+    frame_groups = {}
+    for i in row_ids:
+        gal = manifest.searches[i]
+        if gal is None:
+            rows.complete(i)
+            continue
+
+        for band, rel_path in store.rel_paths(rows.name_of(i, gal)).items():
+            if not manifest.is_done(i, band, rel_path):
+                frame_groups.setdefault((gal['run'], gal['camcol'], gal['field'], band), []).append(
+                    (i, band, rel_path, gal))
+                rows.expect(i)
+        if not rows.is_expecting(i):
+            rows.complete(i)
+    return frame_groups
+
+
+def write_info_file(parent_dir, comments):
+    """Write the info file, its comments on top of the body written during the run in `info.csv.part`
+
+    Parameters
+    ----------
+    parent_dir : `pathlib.Path`
+        Output directory of the run
+    comments : `list` of `str`
+        Comment lines, without the leading '# '
+    """
+
+    with open(parent_dir / 'info.csv', 'w') as f:
+        f.writelines(f"# {line}\n" for line in comments)
+        f.write(f"{'-' * 40}\n")
+    with open(parent_dir / 'info.csv', 'ab') as f, open(parent_dir / 'info.csv.part', 'rb') as body:
+        shutil.copyfileobj(body, f)
+    (parent_dir / 'info.csv.part').unlink()
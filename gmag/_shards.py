@@ -0,0 +1,118 @@
+"""Multi-extension FITS shards holding the cutouts of a download run in a few large files"""
+
+import io
+import threading
+
+from . import _encoding
+
+DIR_NAME = 'shards'
+"""Name of the shard directory in the output directory"""
+
+INDEX_FILE_NAME = 'index.csv'
+"""Name of the index file of the shards in the output directory"""
+
+_PRIMARY_SIZE = 2880
+"""Size in bytes of an empty primary HDU, one FITS block"""
+
+
+def encode_extension(data, extname, encoding=None):
+    """Encode an image as a FITS image extension, ready to be appended to a shard
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Image data
+    extname : `str`
+        Extension name
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`, None to store as is
+
+    Returns
+    -------
+    content : `bytes`
+        Header and data blocks of the extension
+    """
+
+    from astropy.io import fits
+
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), _encoding.image_hdu(data, extname, encoding)]).writeto(buffer)
+    return buffer.getvalue()[_PRIMARY_SIZE:]
+
+
+class ShardWriter:
+    """Append FITS image extensions to shards of bounded size, safe to share between threads
+
+    Parameters
+    ----------
+    shard_dir : `pathlib.Path`
+        Directory of the shards, created if it does not exist
+    max_bytes : `int`, default=256 * 1024 ** 2
+        Size in bytes after which a new shard is started
+
+    Notes
+    -----
+    Shards already in the directory are never written again, so a resumed run can not append
+    after an extension cut short by a crash. Each shard is a valid FITS file after every write.
+    """
+
+    def __init__(self, shard_dir, max_bytes=256 * 1024 ** 2):
+        self.shard_dir = shard_dir
+        self.shard_dir.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._num = 0
+        self._num_ext = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the current shard"""
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, content):
+        """Append an encoded extension to the current shard
+
+        Parameters
+        ----------
+        content : `bytes`
+            Extension from `encode_extension`
+
+        Returns
+        -------
+        location : `dict`
+            Location of the extension with keys 'path' (shard path relative to the parent of the shard directory),
+            'ext' (HDU index in the shard), 'offset' (byte offset in the shard) and 'size' (in bytes)
+        """
+
+        with self._lock:
+            if self._file is None or (self._file.tell() > _PRIMARY_SIZE and
+                                      self._file.tell() + len(content) > self.max_bytes):
+                self._next_shard()
+
+            offset = self._file.tell()
+            self._file.write(content)
+            self._file.flush()
+            self._num_ext += 1
+
+            return {'path': f"{self.shard_dir.name}/{self._path.name}", 'ext': self._num_ext,
+                    'offset': offset, 'size': len(content)}
+
+    def _next_shard(self):
+        from astropy.io import fits
+
+        self.close()
+        while (self.shard_dir / f"shard-{self._num:05d}.fits").exists():
+            self._num += 1
+        self._path = self.shard_dir / f"shard-{self._num:05d}.fits"
+        self._file = open(self._path, 'wb')
+        fits.PrimaryHDU().writeto(self._file)
+        self._num_ext = 0
@@ -0,0 +1,386 @@
+"""This module contains the on-disk caches used to avoid downloading the same data twice"""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from . import _http
+
+
+class FrameCache:
+    """Size-bounded on-disk cache of SDSS frame files, keyed by frame url
+
+    Parameters
+    ----------
+    cache_dir : `str` or `pathlib.Path`, default=None
+        Directory to store cached frames, default is `~/.cache/gmag/frames`
+    max_bytes : `int`, default=10 * 1024 ** 3
+        Maximum total size of cached frames in bytes, least recently used frames are evicted first
+
+    Notes
+    -----
+    Frames are stored compressed, as served by SDSS. Files are written to a temporary file and renamed into
+    place, so the cache can be shared by multiple processes without torn files.
+    `hits` and `misses` count lookups made in the current process only.
+    The total size is counted once when the cache is opened, then kept up to date by `put`, and the directory is
+    only scanned again to evict frames once it goes over `max_bytes`. Frames put by other processes are only
+    counted by the next scan.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 1024 ** 3):
+        if cache_dir is None:
+            cache_dir = pathlib.Path.home() / '.cache' / 'gmag' / 'frames'
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = self.size
+
+    def __repr__(self):
+        return f"FrameCache[{self.cache_dir}]"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def path(self, url):
+        """Path of the cached file for a url, the file may not exist
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+
+        Returns
+        -------
+        path : `pathlib.Path`
+        """
+
+        suffix = ''.join(pathlib.PurePosixPath(url).suffixes[-2:])
+        return self.cache_dir / f"{hashlib.sha1(url.encode()).hexdigest()}{suffix}"
+
+    def get(self, url):
+        """Get cached file for a url, and mark it as recently used
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+
+        Returns
+        -------
+        path : `pathlib.Path` or `None` if not cached
+        """
+
+        path = self.path(url)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        self._count(hit=True)
+        return path
+
+    def put(self, url, fileobj):
+        """Store the content of a file object in the cache, then evict old frames if over budget
+
+        Only scans the cache directory if the total size, kept in memory, goes over `max_bytes`
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+        fileobj : file-like
+            Binary file object to copy from
+
+        Returns
+        -------
+        path : `pathlib.Path`
+            Path of the cached file
+        """
+
+        path = self.path(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                shutil.copyfileobj(fileobj, out_file)
+                added = out_file.tell()
+            try:
+                added -= path.stat().st_size  # replaced by the new file
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._size += added
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def download(self, url):
+        """Download a frame into the cache
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+
+        Returns
+        -------
+        path : `pathlib.Path`
+            Path of the cached file
+        """
+
+        with _http.open_url(url) as response:
+            return self.put(url, response)
+
+    def fetch(self, url):
+        """Get cached file for a url, download it into the cache if not cached
+
+        Parameters
+        ----------
+        url : `str`
+            Frame url
+
+        Returns
+        -------
+        path : `pathlib.Path`
+            Path of the cached file
+        """
+
+        path = self.get(url)
+        if path is None:
+            path = self.download(url)
+
+        return path
+
+    def evict(self):
+        """Remove least recently used frames until the cache is within `max_bytes`
+
+        Temporary files left over by interrupted writes are removed after an hour.
+        """
+
+        entries = []
+        for path in self.cache_dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            if path.name.startswith('.'):
+                if time.time() - stat.st_mtime > 3600:
+                    _unlink(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _unlink(path)
+            total -= size
+
+        with self._lock:
+            self._size = total
+
+    def clear(self):
+        """Remove all cached frames"""
+
+        for path in self.cache_dir.iterdir():
+            _unlink(path)
+
+        with self._lock:
+            self._size = 0
+
+    @property
+    def size(self):
+        """Total size of cached frames in bytes"""
+
+        total = 0
+        for path in self.cache_dir.iterdir():
+            try:
+                total += 0 if path.name.startswith('.') else path.stat().st_size
+            except FileNotFoundError:
+                continue
+        return total
+
+    def stats(self):
+        """Cache statistics of the current process
+
+        Returns
+        -------
+        stats : `dict`
+            Dictionary with keys 'hits', 'misses', 'hit_rate', 'size', 'max_bytes'
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class SearchCache:
+    """Persistent SQLite cache of nearby galaxy search results, keyed by position and search radius
+
+    Parameters
+    ----------
+    path : `str` or `pathlib.Path`, default=None
+        Path of the SQLite database, default is `~/.cache/gmag/search.sqlite`
+    ttl : `float`, default=30 * 24 * 3600
+        Time to live of cached results in seconds, None to never expire
+    release : `str`, default='dr17'
+        SDSS data release tag, results cached for another release are not used
+
+    Notes
+    -----
+    Positions are normalized to 6 decimal places in degrees (3.6 mas), and negative results
+    (no galaxy found within the search radius) are cached as well.
+    `hits` and `misses` count lookups made with this object.
+    """
+
+    def __init__(self, path=None, ttl=30 * 24 * 3600, release='dr17'):
+        if path is None:
+            path = pathlib.Path.home() / '.cache' / 'gmag' / 'search.sqlite'
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.release = release
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS searches ("
+                               "ra TEXT, dec TEXT, radius REAL, release TEXT, created REAL, galaxy TEXT, "
+                               "PRIMARY KEY (ra, dec, radius, release))")
+
+    def __repr__(self):
+        return f"SearchCache[{self.path}]"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database connection"""
+
+        self._conn.close()
+
+    def get_many(self, coords, max_search_radius):
+        """Get cached search results of many positions
+
+        Parameters
+        ----------
+        coords : iterable of `tuple`
+            (row_id, ra, dec), ra and dec in degrees
+        max_search_radius : `float`
+            Maximum search radius in arcmin
+
+        Returns
+        -------
+        results : `dict`
+            Galaxy dict, or None if no galaxy was found, for each cached row_id
+        """
+
+        created = 0 if self.ttl is None else time.time() - self.ttl
+        results = {}
+        with self._lock:
+            for row_id, ra, dec in coords:
+                row = self._conn.execute("SELECT galaxy FROM searches "
+                                         "WHERE ra = ? AND dec = ? AND radius = ? AND release = ? AND created >= ?",
+                                         (*_normalize(ra, dec), float(max_search_radius), self.release,
+                                          created)).fetchone()
+                if row is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    results[row_id] = json.loads(row[0])
+
+        return results
+
+    def put_many(self, results, max_search_radius):
+        """Store search results of many positions
+
+        Parameters
+        ----------
+        results : iterable of `tuple`
+            (ra, dec, galaxy), ra and dec in degrees, galaxy is a dict or None if no galaxy was found
+        max_search_radius : `float`
+            Maximum search radius in arcmin
+        """
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(*_normalize(ra, dec), float(max_search_radius), self.release, now,
+                                     json.dumps(galaxy)) for ra, dec, galaxy in results])
+
+    def clear(self):
+        """Remove all cached search results"""
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM searches")
+
+    def stats(self):
+        """Cache statistics of this object
+
+        Returns
+        -------
+        stats : `dict`
+            Dictionary with keys 'hits', 'misses', 'hit_rate', 'size' (number of cached results)
+        """
+
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': size,
+        }
+
+
+def _normalize(ra, dec):
+    """Normalize a position to the strings used as cache keys"""
+
+    return f"{float(ra) % 360:.6f}", f"{float(dec):.6f}"
+
+
+def _unlink(path):
+    """Remove a file, ignore if it was already removed (e.g. by another process)"""
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,188 @@
+"""This module contains the `Downloader`, which keeps worker pools, connections and caches alive across calls"""
+
+from . import _executor
+from . import _http
+from . import sdss
+from .cache import FrameCache, SearchCache
+
+
+class Downloader:
+    """Long-lived downloader, to call the functions of `.sdss` many times without setting them up every time
+
+    Every `.sdss` function called on its own creates its worker pools, and process workers import gmag and open
+    new connections. A downloader creates its pools on first use and keeps them, with the keep-alive connections
+    and the caches, until it is closed, so repeated small calls only cost their network time.
+
+    Parameters
+    ----------
+    num_workers: `int`, default=16
+        Number of download workers, also used for searches
+    engine: `str`, default='thread'
+        Execution engine of downloads, 'thread' or 'process'
+    cpu_workers: `int`, default=0
+        Number of processes to decompress frames and cutout galaxies when engine is 'thread',
+        0 to do it in the download threads
+    frame_cache: `.cache.FrameCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache directory, to reuse frames downloaded before, None to disable
+    search_cache: `.cache.SearchCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache database path, to reuse galaxy search results, None to disable.
+        A cache opened from a path is closed with the downloader
+
+    Raises
+    ------
+    ValueError
+        Raised if engine is invalid
+
+    Notes
+    -----
+    Methods can be called from several threads at once, their tasks share the pools.
+    Keyword arguments of the methods override the settings of the downloader.
+
+    Examples
+    --------
+    >>> with Downloader(num_workers=8, frame_cache='frames') as downloader:
+    ...     for file in catalogs:
+    ...         downloader.download(file, progress_bar=False)
+    """
+
+    def __init__(self, num_workers=16, engine='thread', cpu_workers=0, frame_cache=None, search_cache=None):
+        if engine not in _executor.ENGINES:
+            raise ValueError(f"Invalid engine {engine}, must be one of {', '.join(_executor.ENGINES)}")
+
+        self.num_workers = num_workers
+        self.engine = engine
+        self.cpu_workers = cpu_workers
+        if frame_cache is not None and not isinstance(frame_cache, FrameCache):
+            frame_cache = FrameCache(frame_cache)
+        self.frame_cache = frame_cache
+        self._owns_search_cache = search_cache is not None and not isinstance(search_cache, SearchCache)
+        if self._owns_search_cache:
+            search_cache = SearchCache(search_cache)
+        self.search_cache = search_cache
+        self._pools = _executor.Pools()
+
+        # Open the connection pools of this process now
+        _http.get_session()
+
+    def __repr__(self):
+        return f"Downloader[{self.engine}x{self.num_workers}{', closed' if self.closed else ''}]"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def closed(self):
+        """Whether the downloader is closed"""
+
+        return self._pools.closed
+
+    def close(self):
+        """Shut down the worker pools, waiting for running tasks, and close the search cache if opened from a path"""
+
+        self._pools.close()
+        if self._owns_search_cache:
+            self.search_cache.close()
+
+    def search(self, ra, dec, **kwargs):
+        """Search the nearest galaxy of many ra dec positions, see `.sdss.search_galaxies`
+
+        Parameters
+        ----------
+        ra: array_like of `float`
+            Right ascensions in degrees
+        dec: array_like of `float`
+            Declinations in degrees
+        **kwargs
+            Keyword arguments to pass to `.sdss.search_galaxies`
+
+        Returns
+        -------
+        galaxies: `list` of `dict` or `None`
+            Galaxy data in order of positions, `None` if no galaxy found
+        """
+
+        kwargs = {'num_workers': self.num_workers, 'search_cache': self.search_cache, **kwargs}
+        return sdss.search_galaxies(ra, dec, pools=self._get_pools(), **kwargs)
+
+    def iter_galaxies(self, ra, dec, **kwargs):
+        """Search and cutout galaxies of many ra dec positions in memory, see `.sdss.iter_galaxies`
+
+        Parameters
+        ----------
+        ra: iterable of `float`
+            Right ascensions in degrees
+        dec: iterable of `float`
+            Declinations in degrees
+        **kwargs
+            Keyword arguments to pass to `.sdss.iter_galaxies`
+
+        Yields
+        ------
+        row: `int`
+            Index of the position
+        galaxy: `.Galaxy` or `None`
+            Nearest galaxy with its cutouts, None if not found or failed
+        """
+
+        kwargs = {'num_workers': self.num_workers, 'engine': self.engine, 'cpu_workers': self.cpu_workers,
+                  'frame_cache': self.frame_cache, 'search_cache': self.search_cache, **kwargs}
+        return sdss.iter_galaxies(ra, dec, pools=self._get_pools(), **kwargs)
+
+    def download(self, file, **kwargs):
+        """Read ra dec from file and download galaxy fits images, see `.sdss.download_images`
+
+        Parameters
+        ----------
+        file: `str` or `pathlib.Path`
+            File to read ra dec from
+        **kwargs
+            Keyword arguments to pass to `.sdss.download_images`
+        """
+
+        kwargs = {'num_workers': self.num_workers, 'engine': self.engine, 'cpu_workers': self.cpu_workers,
+                  'frame_cache': self.frame_cache, 'search_cache': self.search_cache, **kwargs}
+        sdss.download_images(file, pools=self._get_pools(), **kwargs)
+
+    def random_galaxy(self, **kwargs):
+        """Get a random galaxy from SDSS, see `.sdss.get_random_galaxy`
+
+        Parameters
+        ----------
+        **kwargs
+            Keyword arguments to pass to `.sdss.get_random_galaxy`
+
+        Returns
+        -------
+        galaxy: `.Galaxy`
+            Galaxy object
+        """
+
+        kwargs = {'engine': self.engine, 'frame_cache': self.frame_cache, **kwargs}
+        return sdss.get_random_galaxy(pools=self._get_pools(), **kwargs)
+
+    def random_galaxies(self, n, **kwargs):
+        """Get many random galaxies from SDSS, see `.sdss.get_random_galaxies`
+
+        Parameters
+        ----------
+        n : `int`
+            Number of galaxies
+        **kwargs
+            Keyword arguments to pass to `.sdss.get_random_galaxies`
+
+        Returns
+        -------
+        galaxies: `list` of `.Galaxy`
+            Galaxy objects, galaxies whose jpg image or a band failed to download are left out
+        """
+
+        kwargs = {'num_workers': self.num_workers, 'engine': self.engine, 'frame_cache': self.frame_cache, **kwargs}
+        return sdss.get_random_galaxies(n, pools=self._get_pools(), **kwargs)
+
+    def _get_pools(self):
+        if self.closed:
+            raise RuntimeError("Downloader is closed")
+        return self._pools
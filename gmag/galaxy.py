@@ -1,54 +1,267 @@
-"""This module contains the Galaxy class, which is used to represent a galaxy"""
+"""This module contains the Galaxy class, which is used to represent a galaxy
 
-from dataclasses import dataclass
+The bands of a galaxy are held in one contiguous cube, and can be loaded lazily from the outputs of a download run,
+so many galaxies can be kept in memory without their pixels. matplotlib is only imported when a galaxy is shown.
+"""
+
+import csv
+import functools
+import json
+import pathlib
+from dataclasses import FrozenInstanceError
 
 import numpy as np
-from matplotlib import pyplot as plt
+
+from . import _cutout
+from . import _manifest
+from . import _shards
+
+BANDS = 'ugriz'
+"""Bands of a galaxy, in order of the cube"""
 
 
-@dataclass(frozen=True)
 class Galaxy:
     """Galaxy class
 
+    Parameters
+    ----------
+    objid : `str`
+        SDSS DR17 ObjID
+    u, g, r, i, z : `numpy.ndarray`, default=None
+        Band images, None if missing
+    jpg_data : `numpy.ndarray`, default=None
+        JPG image data
+    ra : `float`, default=None
+        Right Ascension (deg)
+    dec : `float`, default=None
+        Declination (deg)
+
     Notes
     -----
     This class is used to store the information of a galaxy. All the attributes are read-only.
+
+    Bands of the same shape are copied into one cube, and the band attributes are views into it.
+    Galaxies created with `lazy`, `from_files` or `from_tensor` load their bands on first access.
     """
 
-    objid: str
-    """SDSS DR17 ObjID"""
+    __slots__ = ('objid', 'jpg_data', 'ra', 'dec', '_bands', '_cube', '_loader', '_clims')
 
-    u: np.ndarray
-    """u-band image"""
+    def __init__(self, objid, u=None, g=None, r=None, i=None, z=None, jpg_data=None, ra=None, dec=None):
+        self._init(objid, jpg_data, ra, dec, None)
+        self._set_bands([u, g, r, i, z])
 
-    g: np.ndarray
-    """g-band image"""
+    def _init(self, objid, jpg_data, ra, dec, loader):
+        object.__setattr__(self, 'objid', objid)
+        object.__setattr__(self, 'jpg_data', jpg_data)
+        object.__setattr__(self, 'ra', ra)
+        object.__setattr__(self, 'dec', dec)
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_bands', None)
+        object.__setattr__(self, '_cube', None)
+        object.__setattr__(self, '_clims', {})
 
-    r: np.ndarray
-    """r-band image"""
+    @classmethod
+    def lazy(cls, objid, loader, jpg_data=None, ra=None, dec=None):
+        """Create a galaxy whose bands are loaded on first access
 
-    i: np.ndarray
-    """i-band image"""
+        Parameters
+        ----------
+        objid : `str`
+            SDSS DR17 ObjID
+        loader : callable
+            Function without arguments returning a cube of the five bands, or a list of the five band images
+            or None, in ugriz order. Must be picklable to pickle the galaxy, e.g. a `functools.partial`
+        jpg_data : `numpy.ndarray`, default=None
+            JPG image data
+        ra : `float`, default=None
+            Right Ascension (deg)
+        dec : `float`, default=None
+            Declination (deg)
+
+        Returns
+        -------
+        galaxy : `Galaxy`
+        """
 
-    z: np.ndarray
-    """z-band image"""
+        galaxy = cls.__new__(cls)
+        galaxy._init(objid, jpg_data, ra, dec, loader)
+        return galaxy
 
-    jpg_data: np.ndarray
-    """JPG image data"""
+    @classmethod
+    def from_files(cls, directory, objid=None, ra=None, dec=None):
+        """Create a galaxy loading its bands lazily from `<band>.fits` files, as saved by `.sdss.download_images`
 
-    ra: float
-    """Right Ascension (deg)"""
+        Parameters
+        ----------
+        directory : `str` or `pathlib.Path`
+            Directory of the fits files, missing bands are None
+        objid : `str`, default=None
+            SDSS DR17 ObjID, default is the directory name
+        ra : `float`, default=None
+            Right Ascension (deg)
+        dec : `float`, default=None
+            Declination (deg)
+
+        Returns
+        -------
+        galaxy : `Galaxy`
+        """
+
+        directory = pathlib.Path(directory)
+        return cls.lazy(objid or directory.name, functools.partial(_load_files, str(directory)), ra=ra, dec=dec)
 
-    dec: float
-    """Declination (deg)"""
+    @classmethod
+    def from_tensor(cls, tensor, row, bands=BANDS, objid=None, ra=None, dec=None):
+        """Create a galaxy reading its bands lazily from a row of a tensor, as saved by `.sdss.download_images`
+
+        Parameters
+        ----------
+        tensor : `str`, `pathlib.Path` or `numpy.ndarray`
+            Tensor of shape (rows, bands, height, width), or `.npy` file to memory map it from
+        row : `int`
+            Row of the galaxy
+        bands : `str` or `list` of `str`, default='ugriz'
+            Bands of the tensor, in order, missing bands are None
+        objid : `str`, default=None
+            SDSS DR17 ObjID, default is the row
+        ra : `float`, default=None
+            Right Ascension (deg)
+        dec : `float`, default=None
+            Declination (deg)
+
+        Returns
+        -------
+        galaxy : `Galaxy`
+        """
+
+        if not isinstance(tensor, np.ndarray):
+            tensor = str(tensor)
+        return cls.lazy(objid or str(row), functools.partial(_load_tensor, tensor, row, ''.join(bands)),
+                        ra=ra, dec=dec)
 
     def __repr__(self):
         return f"Galaxy[{self.objid}]"
 
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __getstate__(self):
+        # Lazy galaxies are pickled without their pixels
+        bands = self._bands if self._loader is None else None
+        return self.objid, self.jpg_data, self.ra, self.dec, self._loader, bands
+
+    def __setstate__(self, state):
+        *fields, bands = state
+        self._init(*fields)
+        if bands is not None:
+            self._set_bands(bands)
+
+    def _set_bands(self, bands):
+        if isinstance(bands, np.ndarray) and bands.ndim == 3:
+            # A read-only view, the caller's array is left writeable
+            cube = bands.view()
+            cube.flags.writeable = False
+            bands = list(cube)
+        else:
+            # Stack the bands present, if of the same shape, into one cube, keep them apart otherwise
+            present = [band for band in bands if band is not None]
+            cube = None
+            if present and len({np.shape(band) for band in present}) == 1:
+                cube = np.stack(present)
+                cube.flags.writeable = False
+                planes = iter(cube)
+                bands = [None if band is None else next(planes) for band in bands]
+        object.__setattr__(self, '_cube', cube)
+        object.__setattr__(self, '_bands', tuple(bands))
+
+    def _band(self, k):
+        if self._bands is None:
+            self._set_bands(self._loader())
+        return self._bands[k]
+
+    @property
+    def u(self):
+        """u-band image"""
+        return self._band(0)
+
+    @property
+    def g(self):
+        """g-band image"""
+        return self._band(1)
+
+    @property
+    def r(self):
+        """r-band image"""
+        return self._band(2)
+
+    @property
+    def i(self):
+        """i-band image"""
+        return self._band(3)
+
+    @property
+    def z(self):
+        """z-band image"""
+        return self._band(4)
+
     @property
     def data(self):
-        """The ugriz data of the galaxy (read-only)"""
-        return np.array([self.u, self.g, self.r, self.i, self.z])
+        """The data of the bands of the galaxy, in ugriz order, of shape (bands, height, width) (read-only)
+
+        All five bands if the galaxy has them, else only the bands it has, e.g. of a download of some bands
+
+        Raises
+        ------
+        ValueError
+            Raised if the galaxy has no band or bands have different shapes, e.g. cutouts clipped by the frame
+            edges
+        """
+
+        self._band(0)
+        if self._cube is None:
+            raise ValueError(f"Bands of galaxy {self.objid} are missing or have different shapes: "
+                             f"{[None if band is None else band.shape for band in self._bands]}")
+        return self._cube
+
+    @property
+    def is_loaded(self):
+        """Whether the bands are in memory, always True unless the galaxy is lazy"""
+        return self._bands is not None
+
+    def unload(self):
+        """Drop the bands of a lazy galaxy from memory, they are loaded again on next access"""
+
+        if self._loader is not None:
+            object.__setattr__(self, '_bands', None)
+            object.__setattr__(self, '_cube', None)
+            self._clims.clear()
+
+    def clim(self, band=None):
+        """Color limits of high contrast plots, the 1st and 99th percentiles, computed once
+
+        Parameters
+        ----------
+        band : `str`, default=None
+            Band, None for all bands
+
+        Returns
+        -------
+        clim : `tuple` of `float`
+        """
+
+        if band not in self._clims:
+            if band is not None:
+                values = getattr(self, band)
+            elif self._band(0) is not None and self._cube is not None:
+                values = self._cube
+            else:
+                # Bands of different shapes are pooled
+                values = np.concatenate([band.ravel() for band in self._bands if band is not None])
+            self._clims[band] = tuple(float(value) for value in np.nanpercentile(values, [1, 99]))
+        return self._clims[band]
 
     def info(self):
         """Print out the information of the galaxy"""
@@ -64,6 +277,8 @@ class Galaxy:
         show
         """
 
+        from matplotlib import pyplot as plt
+
         plt.figure(dpi=40)
         plt.axis('off')
         plt.imshow(self.jpg_data)
@@ -77,6 +292,8 @@ class Galaxy:
         preview
         """
 
+        from matplotlib import pyplot as plt
+
         plt.figure(dpi=100)
         plt.axis('off')
         plt.imshow(self.jpg_data)
@@ -102,11 +319,12 @@ class Galaxy:
             Raised if the band is not in ugriz
         """
 
+        from matplotlib import pyplot as plt
+
         if band not in ['u', 'g', 'r', 'i', 'z']:
             raise ValueError(f"{band} is not a valid band. Please choose from u, g, r, i, z.")
         else:
-            clim = None if not high_contrast else (np.percentile(getattr(self, band), 1),
-                                                   np.percentile(getattr(self, band), 99))
+            clim = None if not high_contrast else self.clim(band)
             plt.figure(figsize=(2.5, 2.5))
             plt.imshow(getattr(self, band), cmap=cmap, clim=clim)
             plt.title(f"{band}-band")
@@ -127,10 +345,11 @@ class Galaxy:
             Whether to show the colorbar
         """
 
+        from matplotlib import pyplot as plt
+
+        clim = None if not high_contrast else self.clim()
         fig, axs = plt.subplots(1, 5, figsize=(15, 3))
         for i, band in enumerate(['u', 'g', 'r', 'i', 'z']):
-            clim = None if not high_contrast else (np.percentile(self.data, 1),
-                                                   np.percentile(self.data, 99))
             axs[i].imshow(getattr(self, band), cmap=cmap, clim=clim)
             axs[i].set_title(f"{band}")
             axs[i].axis('off')
@@ -139,3 +358,90 @@ class Galaxy:
             fig.colorbar(axs[0].get_images()[0], ax=axs.ravel().tolist())
 
         plt.show()
+
+
+def load_galaxies(output_dir):
+    """Lazy galaxies of the rows found by a download run, whatever its output format
+
+    Parameters
+    ----------
+    output_dir : `str` or `pathlib.Path`
+        Output directory of `.sdss.download_images`, the run must have saved its info file
+
+    Returns
+    -------
+    galaxies : `dict` of `int` to `Galaxy`
+        Galaxy of each found row id, the row in the catalog also for partitions, with bands loaded on first
+        access
+
+    Raises
+    ------
+    OSError
+        Raised if the info file or the manifest of the run is not found
+    """
+
+    output_dir = pathlib.Path(output_dir)
+    with open(output_dir / _manifest.FILE_NAME) as f:
+        params = json.loads(f.readline())
+    bands = ''.join(params['bands'])
+
+    locations = {}
+    if params['output_format'] == 'shards':
+        with open(output_dir / _shards.INDEX_FILE_NAME, newline='') as f:
+            for row in csv.DictReader(f):
+                locations.setdefault(int(row['row']), []).append((row['band'], row['shard'], int(row['ext'])))
+
+    # The tensor of a partition only has the rows of the partition, row k of the tensor is line k of the info file
+    compact = params['output_format'] == 'tensor' and \
+        len(_open_tensor(str(output_dir / _cutout.TENSOR_FILE_NAME))) != params['num_rows']
+
+    galaxies = {}
+    with open(output_dir / 'info.csv', newline='') as f:
+        # Skip the comments and the separator line on top of the body
+        lines = (line for line in f if not line.startswith('#'))
+        next(lines)
+        for line, row in enumerate(csv.DictReader(lines)):
+            if row['found'] != 'True':
+                continue
+            # Row id in the catalog, info files of partitions only have some rows, older runs have no row column
+            i = int(row['row']) if 'row' in row else line
+            if params['output_format'] == 'tensor':
+                loader = functools.partial(_load_tensor, str(output_dir / _cutout.TENSOR_FILE_NAME),
+                                           line if compact else i, bands)
+            elif params['output_format'] == 'shards':
+                loader = functools.partial(_load_shards, str(output_dir), tuple(locations.get(i, ())))
+            else:
+                loader = functools.partial(_load_files, str(output_dir / row['dir_name']))
+            galaxies[i] = Galaxy.lazy(row['objid'], loader, ra=float(row['ra']), dec=float(row['dec']))
+
+    return galaxies
+
+
+def _load_files(directory):
+    from astropy.io import fits
+
+    paths = [pathlib.Path(directory) / f"{band}.fits" for band in BANDS]
+    return [fits.getdata(path) if path.exists() else None for path in paths]
+
+
+@functools.lru_cache(maxsize=8)
+def _open_tensor(path):
+    return np.load(path, mmap_mode='r')
+
+
+def _load_tensor(tensor, row, bands):
+    if not isinstance(tensor, np.ndarray):
+        tensor = _open_tensor(tensor)
+    # A row of all five bands is a view into the tensor, nothing is read until used
+    if bands == BANDS:
+        return tensor[row]
+    return [tensor[row, bands.index(band)] if band in bands else None for band in BANDS]
+
+
+def _load_shards(root, locations):
+    from astropy.io import fits
+
+    bands = dict.fromkeys(BANDS)
+    for band, shard, ext in locations:
+        bands[band] = fits.getdata(pathlib.Path(root) / shard, ext=ext)
+    return list(bands.values())
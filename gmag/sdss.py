@@ -1,39 +1,71 @@
 """This module provides the main functionality to interact with the SDSS servers.
 
-Two functions are provided: `get_random_galaxy` and `download_images`.
+Seven functions are provided: `get_random_galaxy`, `get_random_galaxies`, `search_galaxies`, `iter_galaxies`,
+`download_images`, `merge_partitions` and `download_thumbnails`.
 
+Heavy dependencies (astropy, matplotlib, PIL, tqdm) are imported by the code paths that need them,
+so importing this module, e.g. in every spawned worker process, stays fast.
 """
 
 import bz2
+import collections
+import contextlib
 import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
 import pathlib
 import shutil
+import time
+import urllib.parse
 import warnings
 from datetime import datetime
-from multiprocessing import Pool
-from urllib.request import urlopen
 
 import numpy as np
 import requests
-from PIL import Image
-from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.table import Table as AstropyTable
-from astropy.wcs import WCS, FITSFixedWarning
-from matplotlib import pyplot as plt
-from tqdm.auto import tqdm
 
+from . import _bz2_blocks
+from . import _catalog
+from . import _cutout
+from . import _encoding
+from . import _executor
+from . import _frame_memo
+from . import _http
+from . import _manifest
+from . import _metrics
+from . import _mosaic
+from . import _partition
 from . import _print_util as pu
+from . import _reader
+from . import _run
+from . import _shards
+from .cache import FrameCache, SearchCache
 from .galaxy import Galaxy
 
+_SKYSERVER_URL = "http://skyserver.sdss.org/dr17/SkyServerWS"
+_SAS_URL = "http://dr17.sdss.org/sas/dr17"
+_MAX_QUERY_LENGTH = 2048  # default maxQueryString of IIS, which serves SkyServer
+_REPORT_FILE_NAME = "report.json"
+_THUMBNAIL_DIR_NAME = "thumbnails"
 
-def get_random_galaxy(verbose=True):
+
+def get_random_galaxy(verbose=True, frame_cache=None, engine='thread', pools=None):
     """Get a random galaxy from SDSS
 
     Parameters
     ----------
     verbose: `bool`, default=True
         Whether to print progress
+    frame_cache: `.cache.FrameCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache directory, to reuse frames downloaded before, None to disable
+    engine: `str`, default='thread'
+        Execution engine to fetch the bands, 'thread' or 'process'
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
 
     Returns
     -------
@@ -42,7 +74,7 @@ def get_random_galaxy(verbose=True):
 
     Notes
     -----
-    If not running in a notebook, must run in `__main__` to avoid multiprocessing issues
+    If engine is 'process' and not running in a notebook, must run in `__main__` to avoid multiprocessing issues
     """
 
     # Get a random galaxy objid
@@ -57,6 +89,8 @@ def get_random_galaxy(verbose=True):
     jpg_data = __get_galaxy_jpg_image(imaging_data['ra'], imaging_data['dec'], imaging_data['petroRad_r'])
 
     if verbose:
+        from matplotlib import pyplot as plt
+
         print("\rStill fetching ugriz data..., here is a preview:")
         plt.figure(dpi=40)
         plt.axis('off')
@@ -67,11 +101,15 @@ def get_random_galaxy(verbose=True):
     fits_urls = [__get_url_from_imaging_data(imaging_data['run'], imaging_data['camcol'], imaging_data['field'], band)
                  for band in 'ugriz']
 
-    # Get cutout fits images data using multiprocessing
-    params = [(url, imaging_data['ra'], imaging_data['dec'], imaging_data['petroRad_r'])
+    # Get cutout fits images data concurrently
+    frame_cache = __as_frame_cache(frame_cache)
+    params = [(url, imaging_data['ra'], imaging_data['dec'], imaging_data['petroRad_r'], frame_cache)
               for url in fits_urls]
-    with Pool(5) as p:
-        cutout_images = p.starmap(__cutout_galaxy_fits_image, params)
+    with _executor.borrow(pools, 'random', engine, 5) as executor:
+        cutout_images, clipped = zip(*_executor.imap(executor, __cutout_galaxy_fits_image_wrapper, params, 5))
+
+    if any(clipped):
+        pu.verbose_print(verbose, pu.red("Galaxy is near the frame edge, its cutout is clipped"))
 
     galaxy = Galaxy(
         objid=str(objid),
@@ -90,8 +128,452 @@ def get_random_galaxy(verbose=True):
     return galaxy
 
 
+def get_random_galaxies(n, verbose=True, progress_bar=True, frame_cache=None, engine='thread', num_workers=16,
+                        pools=None):
+    """Get many random galaxies from SDSS
+
+    All galaxies are drawn with one SQL request, then their jpg images and the frames of their bands
+    are fetched concurrently, each frame once for all galaxies on it.
+
+    Parameters
+    ----------
+    n : `int`
+        Number of galaxies
+    verbose: `bool`, default=True
+        Whether to print progress
+    progress_bar: `bool`, default=True
+        Whether to show progress bar
+    frame_cache: `.cache.FrameCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache directory, to reuse frames downloaded before, None to disable
+    engine: `str`, default='thread'
+        Execution engine to fetch jpg images and frames, 'thread' or 'process'
+    num_workers: `int`, default=16
+        Number of workers
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
+
+    Returns
+    -------
+    galaxies: `list` of `.Galaxy`
+        Galaxy objects, galaxies whose jpg image or a band failed to download are left out
+
+    Raises
+    ------
+    ValueError
+        Raised if engine is invalid
+
+    Notes
+    -----
+    If engine is 'process' and not running in a notebook, must run in `__main__` to avoid multiprocessing issues
+    """
+
+    from tqdm.auto import tqdm
+
+    if engine not in _executor.ENGINES:
+        raise ValueError(f"Invalid engine {engine}, must be one of {', '.join(_executor.ENGINES)}")
+
+    # Get imaging data of random galaxies
+    rows = __sql_search(f"SELECT TOP {int(n)} g.objid, g.run, g.camcol, g.field, g.ra, g.dec, g.petroRad_r "
+                        f"FROM Galaxy AS g "
+                        f"JOIN ZooNoSpec as z ON g.objid = z.objid "
+                        f"WHERE g.clean = 1 AND g.petroRad_r>12 AND g.petroRadErr_r!=-1000 "
+                        f"ORDER BY NEWID()")
+    pu.verbose_print(verbose, f"...Drew {len(rows)} random galaxies")
+
+    # Group galaxies by frame, so each frame is fetched once
+    frame_groups = {}
+    for k, row in enumerate(rows):
+        for band in 'ugriz':
+            frame_groups.setdefault((row['run'], row['camcol'], row['field'], band), []).append(k)
+
+    frame_cache = __as_frame_cache(frame_cache)
+    tasks = [('jpg', k, (row['ra'], row['dec'], row['petroRad_r'])) for k, row in enumerate(rows)]
+    tasks += [('frame', (frame_key[3], group), (__get_url_from_imaging_data(*frame_key),
+                                [(rows[k]['ra'], rows[k]['dec'], rows[k]['petroRad_r']) for k in group],
+                                frame_cache))
+              for frame_key, group in frame_groups.items()]
+
+    jpg_images = {}
+    cutout_images = collections.defaultdict(dict)
+    failed = set()
+    clipped = 0
+    with _executor.borrow(pools, 'download', engine, num_workers) as executor, \
+            tqdm(total=len(tasks), disable=not progress_bar, desc="Fetching galaxies", unit="img") as pbar:
+        results = _executor.imap(executor, __fetch_random_galaxy_part_wrapper, [task[::2] for task in tasks],
+                                 2 * num_workers)
+        for (kind, key, _), result in zip(tasks, results):
+            pbar.update()
+            if isinstance(result, BaseException):
+                # A failed fetch only fails its galaxies
+                failed.update([key] if kind == 'jpg' else key[1])
+            elif kind == 'jpg':
+                jpg_images[key] = result
+            else:
+                band, group = key
+                for k, cutout_arr, is_clipped in zip(group, *result):
+                    cutout_images[k][band] = cutout_arr
+                    clipped += is_clipped
+
+    galaxies = [Galaxy(objid=str(row['objid']), **cutout_images[k], jpg_data=jpg_images[k],
+                       ra=row['ra'], dec=row['dec'])
+                for k, row in enumerate(rows) if k not in failed]
+
+    if failed:
+        print(pu.red(f"...{len(failed)} galaxies failed to download and are left out"))
+    if clipped:
+        pu.verbose_print(verbose, pu.red(f"...{clipped} cutouts of galaxies near the frame edges are clipped"))
+    pu.verbose_print(verbose, "Done!")
+
+    return galaxies
+
+
+def download_thumbnails(output_dir, size=256, num_workers=16, mosaic=False, mosaic_shape=(8, 8), progress_bar=True,
+                        verbose=True, pools=None):
+    """Fetch a jpg thumbnail of every galaxy found by a download run
+
+    Thumbnails are fetched concurrently from the SkyServer ImgCutout service, scaled to the galaxy's petrosian
+    radius as in `get_random_galaxy`, and saved as `thumbnails/<rowid>_<objid>.jpg` in the output directory.
+    Thumbnails already there are not fetched again.
+
+    Parameters
+    ----------
+    output_dir: `str` or `pathlib.Path`
+        Output directory of `download_images`
+    size: `int`, default=256
+        Thumbnail width and height in pixels
+    num_workers: `int`, default=16
+        Number of threads fetching thumbnails
+    mosaic: `bool`, default=False
+        Whether to also assemble the thumbnails, in row order, into contact sheets `thumbnails/mosaic-<n>.jpg`,
+        indexed by `thumbnails/mosaic.csv`
+    mosaic_shape: `tuple` of `int`, default=(8, 8)
+        Number of (rows, columns) of thumbnails of a contact sheet
+    progress_bar: `bool`, default=True
+        Whether to show progress bar
+    verbose: `bool`, default=True
+        Whether to print progress
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
+
+    Returns
+    -------
+    thumbnail_dir: `pathlib.Path`
+        Directory of the thumbnails
+    """
+
+    from tqdm.auto import tqdm
+
+    output_dir = pathlib.Path(output_dir)
+    thumbnail_dir = output_dir / _THUMBNAIL_DIR_NAME
+    thumbnail_dir.mkdir(exist_ok=True)
+
+    # Found galaxies are read from the search records of the manifest, in row order
+    galaxies = {}
+    for record in _manifest.iter_records(output_dir / _manifest.FILE_NAME):
+        if record['type'] == 'search' and record.get('galaxy') is not None:
+            galaxies[record['row']] = record['galaxy']
+    rows = sorted(galaxies)
+
+    def path_of(i):
+        return thumbnail_dir / f"{i}_{galaxies[i]['objid']}.jpg"
+
+    fetch_args = ((__get_jpg_url(galaxies[i]['ra'], galaxies[i]['dec'], galaxies[i]['petroRad_r'], size),
+                   path_of(i)) for i in rows)
+    counts = collections.Counter()
+    with _executor.borrow(pools, 'download', 'thread', num_workers) as executor, \
+            (_mosaic.ContactSheetWriter(thumbnail_dir, size, mosaic_shape) if mosaic
+             else contextlib.nullcontext()) as sheets, \
+            tqdm(total=len(rows), disable=not progress_bar, desc="Fetching thumbnails", unit="img") as pbar:
+        results = _executor.imap(executor, __fetch_thumbnail_wrapper, fetch_args, 2 * num_workers)
+        for i, result in zip(rows, results):
+            pbar.update()
+            if isinstance(result, BaseException):
+                counts['failed'] += 1
+                continue
+            counts['cached'] += result
+            if sheets is not None:
+                sheets.add(i, galaxies[i]['objid'], path_of(i))
+
+    pu.verbose_print(verbose, f"...Saved {len(rows) - counts['failed']} thumbnails at {pu.blue(thumbnail_dir)}, "
+                              f"{counts['cached']} were already there")
+    if mosaic:
+        pu.verbose_print(verbose, f"...Assembled them into {sheets.num_sheets} contact sheets")
+    if counts['failed']:
+        print(pu.red(f"...{counts['failed']} thumbnails failed, run again to retry them"))
+
+    return thumbnail_dir
+
+
+def search_galaxies(ra, dec, max_search_radius=8, search_batch_size=50, num_workers=16, search_cache=None,
+                    pools=None):
+    """Search the nearest galaxy of many ra dec positions, without downloading images
+
+    Parameters
+    ----------
+    ra: array_like of `float`
+        Right ascensions in degrees
+    dec: array_like of `float`
+        Declinations in degrees
+    max_search_radius: `float`, default=8
+        Maximum search radius in arcmin
+    search_batch_size: `int`, default=50
+        Number of galaxies searched by one task, in as few SkyServer requests as fit in a url (about 25 galaxies
+        each), use 1 to search galaxies one by one
+    num_workers: `int`, default=16
+        Number of threads searching
+    search_cache: `.cache.SearchCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache database path, to reuse galaxy search results across runs, None to disable
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
+
+    Returns
+    -------
+    galaxies: `list` of `dict` or `None`
+        Galaxy data in order of positions, `None` if no galaxy found, dictionary with keys 'objid', 'run', 'camcol',
+        'field', 'ra', 'dec', 'petroRad_r', 'petroRadErr_r'
+
+    Raises
+    ------
+    requests.RequestException
+        Raised if a search failed
+    """
+
+    coords = [(i, float(ra_i), float(dec_i)) for i, (ra_i, dec_i) in enumerate(zip(ra, dec))]
+    galaxies = [None] * len(coords)
+
+    with __open_search_cache(search_cache) as search_cache:
+        # Positions already in the search cache are not searched again
+        if search_cache is not None:
+            cached = search_cache.get_many(coords, max_search_radius)
+            for i, gal in cached.items():
+                galaxies[i] = gal
+            coords = [coord for coord in coords if coord[0] not in cached]
+
+        items = [([i for i, _, _ in batch], search_batch_size > 1, batch, max_search_radius)
+                 for batch in (coords[b:b + search_batch_size] for b in range(0, len(coords), search_batch_size))]
+        with _executor.borrow(pools, 'search', 'thread', num_workers) as executor:
+            for (row_ids, _, batch, _), (result, _) in zip(items, _executor.imap(executor, __search_rows_wrapper,
+                                                                                   items, 2 * num_workers)):
+                for i, gal in zip(row_ids, result):
+                    galaxies[i] = gal
+                if search_cache is not None:
+                    search_cache.put_many([(ra_i, dec_i, gal) for (_, ra_i, dec_i), gal in zip(batch, result)],
+                                          max_search_radius)
+
+    return galaxies
+
+
+def iter_galaxies(ra, dec, bands='ugriz', max_search_radius=8, ordered=False, buffer_size=None, grid_size=None,
+                  grid_scale=None, num_workers=16, search_batch_size=50, search_workers=None, frame_cache=None,
+                  search_cache=None, engine='thread', cpu_workers=0, pools=None):
+    """Search and cutout galaxies of many ra dec positions, yield each galaxy in memory as soon as it is done
+
+    Nothing is written to disk, positions are taken lazily and each frame is downloaded once for all galaxies on it,
+    as in `download_images`, so cutouts can be fed straight into further processing.
+
+    Parameters
+    ----------
+    ra: iterable of `float`
+        Right ascensions in degrees, e.g. a table column, taken lazily
+    dec: iterable of `float`
+        Declinations in degrees
+    bands: `str`, default='ugriz'
+        Bands to cutout
+    max_search_radius: `float`, default=8
+        Maximum search radius in arcmin
+    ordered: `bool`, default=False
+        Whether to yield galaxies in order of positions, else in order of completion
+    buffer_size: `int`, default=None
+        Maximum number of positions taken and not yet yielded, searching or downloading included, default is
+        4 * num_workers. When ordered, galaxies done before an earlier one are held back, and new searches pause
+        while the buffer is full. Search batches are made smaller to fit in the buffer
+    grid_size: `int` or `tuple` of `int`, default=None
+        Grid size, or (height, width), in pixels to resample every band onto, centered on the galaxy and aligned
+        across bands, as with `download_images(output_format='tensor')`. None to keep the cutouts as they are
+    grid_scale: `float`, default=None
+        Grid half size in units of galaxy's petrosian radius, None to use the SDSS pixel scale (0.396 arcsec),
+        only used if grid_size is given
+    num_workers: `int`, default=16
+        Number of workers downloading frames
+    search_batch_size: `int`, default=50
+        Number of galaxies searched by one task, in as few SkyServer requests as fit in a url (about 25 galaxies
+        each), use 1 to search galaxies one by one
+    search_workers: `int`, default=None
+        Number of workers to search galaxies, default is num_workers
+    frame_cache: `.cache.FrameCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache directory, to reuse frames downloaded before, None to disable
+    search_cache: `.cache.SearchCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache database path, to reuse galaxy search results across runs, None to disable
+    engine: `str`, default='thread'
+        Execution engine, 'thread' or 'process'
+    cpu_workers: `int`, default=0
+        Number of processes to decompress frames and cutout galaxies when engine is 'thread',
+        0 to do it in the download threads
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
+
+    Yields
+    ------
+    row: `int`
+        Index of the position
+    galaxy: `.Galaxy` or `None`
+        Nearest galaxy with its cutouts of bands, `galaxy.data` is their (len(bands), height, width) cube in ugriz
+        order, if all cutouts have the same shape, e.g. with grid_size. None if no galaxy was found, or its search
+        or a download failed
+
+    Raises
+    ------
+    ValueError
+        Raised if bands or engine is invalid
+
+    Notes
+    -----
+    If engine is 'process' or cpu_workers is not 0, and not running in a notebook,
+    must run in `__main__` to avoid multiprocessing issues.
+    """
+
+    for band in bands:
+        if band not in 'ugriz':
+            raise ValueError(f"Invalid band {band}")
+
+    if engine not in _executor.ENGINES:
+        raise ValueError(f"Invalid engine {engine}, must be one of {', '.join(_executor.ENGINES)}")
+
+    grid = None
+    if grid_size is not None:
+        grid = ((grid_size, grid_size) if isinstance(grid_size, int) else tuple(grid_size), grid_scale)
+    search_workers = search_workers or num_workers
+    buffer_size = buffer_size or 4 * num_workers
+    frame_cache = __as_frame_cache(frame_cache)
+    # Frames of galaxies found by different searches are fetched once
+    frame_memo = _frame_memo.FrameMemo(2 * num_workers)
+    use_cpu_pool = engine == 'thread' and cpu_workers > 0
+
+    # Positions are kept from when they are taken until their galaxy is yielded
+    positions = {}
+    galaxies = {}
+    cutouts = collections.defaultdict(dict)
+    remaining = {}  # number of bands of a galaxy still downloading
+    failed = set()
+    done = {}  # galaxies ready to be yielded
+    planned = []  # downloads planned from the last search, taken by the pipeline
+    next_row = 0
+
+    def search_items():
+        coords = ((i, float(ra_i), float(dec_i)) for i, (ra_i, dec_i) in enumerate(zip(ra, dec)))
+        while True:
+            # Taken only while the buffer has room, rows of the batch count against it from now on
+            batch = list(itertools.islice(coords, min(search_batch_size, buffer_size - len(positions))))
+            if not batch:
+                return
+            positions.update((i, (ra_i, dec_i)) for i, ra_i, dec_i in batch)
+            if search_cache is not None:
+                cached = search_cache.get_many(batch, max_search_radius)
+                if cached:
+                    yield list(cached), None, list(cached.values()), max_search_radius
+                batch = [coord for coord in batch if coord[0] not in cached]
+            if batch:
+                yield [i for i, _, _ in batch], search_batch_size > 1, batch, max_search_radius
+
+    def finish(i):
+        gal = galaxies.pop(i, None)
+        bands_data = cutouts.pop(i, {})
+        if gal is None or i in failed:
+            done[i] = None
+        else:
+            done[i] = Galaxy(objid=str(gal['objid']), **bands_data, ra=gal['ra'], dec=gal['dec'])
+
+    def ready():
+        nonlocal next_row
+        if ordered:
+            while next_row in done:
+                yield next_row, done.pop(next_row)
+                del positions[next_row]
+                next_row += 1
+        else:
+            while done:
+                i, galaxy = done.popitem()
+                del positions[i]
+                yield i, galaxy
+
+    def plan_downloads(rows):
+        # Group bands by frame, so each frame is downloaded once for all galaxies on it
+        frame_groups = {}
+        for i in rows:
+            gal = galaxies.get(i)
+            if gal is None:
+                finish(i)
+                continue
+            for band in bands:
+                frame_groups.setdefault((gal['run'], gal['camcol'], gal['field'], band), []).append((i, band, gal))
+            remaining[i] = len(bands)
+        return list(frame_groups.items())
+
+    def download_args(frame_key, group):
+        output_format = 'memory' if grid is None else 'tensor'
+        return (__get_url_from_imaging_data(*frame_key), [(None, gal['ra'], gal['dec'], gal['petroRad_r'])
+                                                          for _, _, gal in group],
+                frame_cache, cpu_executor, output_format, grid, None, frame_memo)
+
+    def band_done(i):
+        remaining[i] -= 1
+        if not remaining[i]:
+            del remaining[i]
+            finish(i)
+
+    # A search cache opened from a path is closed when the generator ends or is closed
+    with __open_search_cache(search_cache) as search_cache, \
+            _executor.borrow(pools, 'search', engine, search_workers) as search_executor, \
+            _executor.borrow(pools, 'download', engine, num_workers) as download_executor, \
+            (_executor.borrow(pools, 'cpu', 'process', cpu_workers) if use_cpu_pool
+             else contextlib.nullcontext()) as cpu_executor:
+        # Downloads are planned, and galaxies not found finished, while handling the search result,
+        # so they are yielded before the pipeline checks the buffer again
+        events = _executor.pipeline(search_executor, __search_rows_wrapper, search_items(),
+                                    download_executor, __download_frame_cutouts_wrapper,
+                                    lambda *_: planned.pop(), download_args, 2 * search_workers,
+                                    2 * num_workers, 4 * num_workers, return_exceptions=True,
+                                    can_submit=lambda: len(positions) < buffer_size)
+        # Closed if the caller stops early, so pending tasks are cancelled
+        with contextlib.closing(events):
+            for stage, item, result in events:
+                if isinstance(result, BaseException):
+                    # A failed search or download fails its galaxies, not the others
+                    if not isinstance(result, __row_errors()):
+                        raise result
+                    if stage == 0:
+                        for i in item[0]:
+                            finish(i)
+                        failed.update(item[0])
+                    else:
+                        for i, _, _ in item[1]:
+                            failed.add(i)
+                            band_done(i)
+                elif stage == 0:
+                    result, _ = result
+                    galaxies.update(zip(item[0], result))
+                    if item[1] is not None and search_cache is not None:
+                        search_cache.put_many([(ra_i, dec_i, gal) for (_, ra_i, dec_i), gal in zip(item[2], result)],
+                                              max_search_radius)
+                    planned.append(plan_downloads(item[0]))
+                else:
+                    (_, group), ((records, _), _) = item, result
+                    for (i, band, _), record in zip(group, records):
+                        cutouts[i][band] = record['data']
+                        band_done(i)
+                yield from ready()
+
+    if failed:
+        print(pu.red(f"...{len(failed)} galaxies failed to search or download, and were yielded as None"))
+
+
 def download_images(file, ra_col='ra', dec_col='dec', bands='ugriz', max_search_radius=8, cutout=True,
-                    name_col=None, num_workers=16, progress_bar=True, verbose=True, info_file=True):
+                    name_col=None, num_workers=16, progress_bar=True, verbose=True, info_file=True,
+                    search_batch_size=50, frame_cache=None, keep_compressed=False, engine='thread', cpu_workers=0,
+                    output_dir=None, pipeline=True, search_workers=None, queue_size=None, search_cache=None,
+                    catalog=None, output_format='files', shard_size=256 * 1024 ** 2, grid_size=64, grid_scale=None,
+                    chunk_size=None, report_callback=None, thumbnails=False, pools=None, partition=None,
+                    partition_by='rows', compression=None, quantize_level=16, dtype='float32'):
     """Read ra dec from file and download galaxy fits images
 
     Parameters
@@ -111,152 +593,534 @@ def download_images(file, ra_col='ra', dec_col='dec', bands='ugriz', max_search_
     name_col: `str`, default=None
         Name of galaxy name column
     num_workers: `int`, default=16
-        Number of workers to use
+        Number of workers to use. Requests in flight to each server are also limited by an adaptive limit,
+        which backs off when the server slows down or fails, and failed requests are retried with backoff
     progress_bar: `bool`, default=True
         Whether to show progress bar
     verbose: `bool`, default=True
         Whether to print progress
     info_file: `bool`, default=True
         Whether to save info file
+    search_batch_size: `int`, default=50
+        Number of galaxies searched by one task, in as few SkyServer requests as fit in a url (about 25 galaxies
+        each), use 1 to search galaxies one by one
+    frame_cache: `.cache.FrameCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache directory, to reuse frames downloaded before, None to disable
+    keep_compressed: `bool`, default=False
+        Whether to also save the compressed frame as `<band>.fits.bz2`, only used if cutout is False
+    engine: `str`, default='thread'
+        Execution engine, 'thread' to run network-bound tasks in threads sharing keep-alive connections,
+        'process' to run every task in a process pool
+    cpu_workers: `int`, default=0
+        Number of processes to decompress frames and cutout galaxies when engine is 'thread',
+        0 to do it in the download threads
+    output_dir: `str` or `pathlib.Path`, default=None
+        Directory to save images in, created if it does not exist. If it holds an interrupted run,
+        the run is resumed and only the missing searches and images are done, images changed since they were
+        saved, checked against their sha256, are done again.
+        If None, a new `images_<YYYY-MM-DD>_<Hr-Min-Sec>` directory is created in the current directory
+    pipeline: `bool`, default=True
+        Whether to start downloading the frames of a galaxy as soon as it is found. A frame needed again by a later
+        search is reused if it is one of the last 2 * num_workers frames, kept in memory, instead of downloaded
+        again, with engine 'thread'. If False, all galaxies are searched first, so galaxies on the same frame are
+        always grouped in one download
+    search_workers: `int`, default=None
+        Number of workers to search galaxies, default is num_workers, which is then used for downloads only
+    queue_size: `int`, default=None
+        Maximum number of frames waiting to be downloaded before searches pause, default is 4 * num_workers
+    search_cache: `.cache.SearchCache`, `str` or `pathlib.Path`, default=None
+        Cache, or cache database path, to reuse galaxy search results across runs, None to disable
+    catalog: `str`, `pathlib.Path` or `astropy.table.Table`, default=None
+        Local SDSS Galaxy table extract, or file to read it from, to search galaxies in instead of SkyServer.
+        Must have columns objid, run, camcol, field, ra, dec, petroRad_r, petroRadErr_r. Requires scipy
+    output_format: `str`, default='files'
+        'files' to save each image as `<galaxy_name>/<band>.fits`, 'shards' to append cutouts as image extensions
+        to a few large multi-extension fits files in `shards/`, indexed by `index.csv`, 'tensor' to resample
+        cutouts onto band-aligned grids saved in one array of dtype, shape (rows, bands, height, width),
+        in `cutouts.npy`, which can be loaded with `numpy.load(path, mmap_mode='r')`.
+        'shards' and 'tensor' require cutout
+    shard_size: `int`, default=256 * 1024 ** 2
+        Size in bytes after which a new shard is started, only used if output_format is 'shards'
+    grid_size: `int` or `tuple` of `int`, default=64
+        Grid size, or (height, width), in pixels, only used if output_format is 'tensor'
+    grid_scale: `float`, default=None
+        Grid half size in units of galaxy's petrosian radius, None to use the SDSS pixel scale (0.396 arcsec),
+        only used if output_format is 'tensor'
+    chunk_size: `int`, default=None
+        Number of rows of file to read at a time, None to read the whole file at once. Set it for very large
+        files, so memory use does not grow with the number of rows. Fits, csv and parquet (requires pyarrow)
+        files are read in chunks, other formats are read at once
+    report_callback: callable, default=None
+        Function called with the run report, a dict, at the end of the run. The report is also saved as
+        `report.json` in the output directory
+    thumbnails: `bool` or `str`, default=False
+        True to also fetch a jpg thumbnail of every found galaxy into `thumbnails/`, 'mosaic' to also assemble
+        them into contact sheets, see `download_thumbnails`
+    pools: `._executor.Pools`, default=None
+        Long-lived worker pools to run tasks in, None to create new ones for this call, see `.downloader.Downloader`
+    partition: `tuple` of `int`, default=None
+        (index, count) to only download the rows of partition index out of count, e.g. on one machine of many,
+        each with its own output_dir. The partitions are merged into one run with `merge_partitions`
+    partition_by: `str`, default='rows'
+        How rows are split into partitions, 'rows' for contiguous ranges of rows, 'sky' for regions of the sky,
+        so galaxies on the same frame are downloaded by the same machine
+    compression: `str`, default=None
+        FITS tile compression of the images, 'rice' or 'gzip', None to not compress. Not used if output_format
+        is 'tensor'. Frames not cut out are rewritten with their image compressed, their other HDUs kept
+    quantize_level: `float`, default=16
+        Quantization level of the compressed floats, higher keeps more precision, only used if compression is
+        given and dtype is 'float32'. 0 to compress losslessly, only with 'gzip'
+    dtype: `str`, default='float32'
+        Data type the images are stored as, 'int16' to store cutouts scaled with BSCALE and BZERO between their
+        minimum and maximum (fits outputs, requires cutout), 'float16' for a float16 tensor (output_format
+        'tensor'), FITS has no float16. Both are lossy, as is compression with a quantize_level other than 0
 
     Raises
     ------
     ValueError
-        Raised if bands is invalid
+        Raised if bands, engine, output_format, thumbnails, partition, compression or dtype is invalid
     OSError
         Raised if can not read file
     KeyError
-        Raised if ra or dec column is not found in file
+        Raised if ra or dec column is not found in file, or a column is not found in catalog
+    ImportError
+        Raised if catalog is given and scipy is not installed, or file is parquet, chunk_size is given
+        and pyarrow is not installed
 
     Notes
     -----
-    If not running in a notebook, must run in `__main__` to avoid multiprocessing issues
+    If engine is 'process' or cpu_workers is not 0, and not running in a notebook,
+    must run in `__main__` to avoid multiprocessing issues.
+
+    Rows are written to the info file in order as soon as they are done. If pipeline is False,
+    all rows are searched before any is done, so they are all kept in memory.
+    If a name of name_col is used by an earlier row, rowid_objid is used instead.
+
+    Row ids of a partition are the row ids in file, its info file only has the rows of the partition. If
+    output_format is 'tensor', the tensor of a partition only has the rows of the partition, row k of the tensor
+    is line k of the info file. Partitions split by sky read file once more to find their rows.
+
+    The run report has the counts of the run, the utilization of the search and download workers, and the
+    metrics of each stage: counters ('bytes_downloaded', 'http_retries', 'search_cache_hits' and
+    'search_cache_lookups' if search_cache is given, ...), tallies ('search_radius_retries',
+    the number of rows searched again at a larger radius that many times) and histograms of durations in seconds
+    ('search_query', 'frame_fetch', 'frame_decompress_cpu', 'frame_cutout_cpu', 'write', 'queue_wait', ...).
     """
 
-    # 1. Check if bands are valid
-    if isinstance(bands, str):
-        bands = list(bands)
-    elif not isinstance(bands, list):
-        raise ValueError("bands must be a string or a list")
+    start_time = time.perf_counter()
 
-    for band in bands:
-        if band not in 'ugriz':
-            raise ValueError(f"Invalid band {band}")
+    # 1. Check if bands, engine, output format, partition and encoding are valid
+    bands, grid_size, partition, encoding = __check_download_args(bands, engine, output_format, cutout, grid_size,
+                                                                  thumbnails, partition, partition_by, compression,
+                                                                  quantize_level, dtype)
 
-    # 2. Try to open fits file
-    try:
-        table = AstropyTable.read(file)
-    except OSError:
-        raise OSError(f"Could not open file {file}")
+    from tqdm.auto import tqdm
 
-    # 3. Try to get ra and dec columns
-    try:
-        orig_ra_list = table[ra_col]
-        orig_dec_list = table[dec_col]
-    except KeyError:
-        raise KeyError(f"Could not find ra column '{ra_col}' or dec column '{dec_col}' in file {file}")
-
-    pu.verbose_print(verbose, f"...Read {len(orig_ra_list)} galaxies from file {pu.blue(file)}")
-
-    # 4. Create search_args for multiprocessing, and search for galaxies, track progress by tqdm
-    search_args = list(zip(orig_ra_list, orig_dec_list, [max_search_radius] * len(orig_ra_list)))
-    with Pool(num_workers) as pool:
-        # galaxies is a list of dict (objid, run, camcol, field, ra, dec, petroRad_r, petroRadErr_r),
-        # can be None, in order of original table
-        galaxies = list(tqdm(pool.imap(__search_nearby_galaxy_wrapper, search_args),
-                             total=len(search_args), disable=not progress_bar,
-                             desc="Searching galaxies", unit="obj"))
-
-    found_gal_row_ids = [i for i, g in enumerate(galaxies) if g is not None]
-
-    pu.verbose_print(verbose, f"...Found {len(found_gal_row_ids)} out of {len(galaxies)} galaxies")
-
-    # 5. Try to get name column, if None, use rowid_objid
-    if name_col is not None:
-        try:
-            names = table[name_col]
-            # Replace empty names with rowid_unknown
-            names = [name if name else f"{i}_unknown" for i, name in enumerate(names)]
-            # Check if names are unique
-            if len(set(names)) != len(names):
-                raise ValueError()
-        except KeyError:
-            print(pu.red(f"Could not find name column '{name_col}' in file {file}, using rowid_objid instead"))
-            names = [f"{i}_{g['objid']}" if g is not None else None for i, g in enumerate(galaxies)]
-        except ValueError:
-            print(pu.red(f"Names are not unique, using rowid_objid instead"))
-            names = [f"{i}_{g['objid']}" if g is not None else None for i, g in enumerate(galaxies)]
-    else:
-        names = [f"{i}_{g['objid']}" if g is not None else None for i, g in enumerate(galaxies)]
+    # 2. Open file, it is read lazily in chunks of rows if chunk_size is given
+    reader = _reader.CatalogReader(file, ra_col, dec_col, name_col, chunk_size)
+    if name_col is not None and not reader.has_names:
+        print(pu.red(f"Could not find name column '{name_col}' in file {file}, using rowid_objid instead"))
+    num_rows = len(reader)
 
-    # 6. Create output parent directory
-    parent_dir = pathlib.Path.cwd() / f"images_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-    parent_dir.mkdir()
+    pu.verbose_print(verbose, f"...Read {num_rows} galaxies from file {pu.blue(file)}")
+
+    # 3. Create output parent directory, and open its manifest to resume an interrupted run
+    if output_dir is None:
+        parent_dir = pathlib.Path.cwd() / f"images_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        parent_dir.mkdir()
+    else:
+        parent_dir = pathlib.Path(output_dir)
+        parent_dir.mkdir(parents=True, exist_ok=True)
     pu.verbose_print(verbose, f"...Created directories for images at {pu.blue(parent_dir)}")
 
-    # 7. Prepare download args for multiprocessing, create output directories
-    download_args = []
-    for i, gal in enumerate(galaxies):
-        if gal is None:
-            continue
-
-        target_dir = parent_dir / names[i]
-        target_dir.mkdir()
-        for band in bands:
-            url = __get_url_from_imaging_data(gal['run'], gal['camcol'], gal['field'], band)
-            file_path = target_dir / f"{band}.fits"
-            if cutout:
-                download_args.append((url, target_dir / file_path, gal['ra'], gal['dec'], gal['petroRad_r']))
+    with _manifest.Manifest(parent_dir / _manifest.FILE_NAME) as manifest, contextlib.ExitStack() as outputs:
+        manifest.check_params({'file': str(file), 'num_rows': num_rows, 'bands': bands,
+                               'max_search_radius': max_search_radius, 'cutout': cutout,
+                               'output_format': output_format, 'grid_size': list(grid_size),
+                               'grid_scale': grid_scale, 'ra_col': ra_col, 'dec_col': dec_col, 'name_col': name_col,
+                               'partition': None if partition is None else list(partition),
+                               'partition_by': None if partition is None else partition_by,
+                               'encoding': None if encoding is None else list(encoding)})
+        if manifest.searches:
+            pu.verbose_print(verbose, f"...Resuming run, {len(manifest.searches)} searches and "
+                                      f"{len(manifest.files)} images already done")
+
+        # Preallocate the tensor, rows not found are left as zeros. The tensor of a partition only has the rows
+        # of the partition, in order, the grids of a row are at the line of the row in the info file
+        tensor = tensor_rows = None
+        if output_format == 'tensor':
+            if partition is not None:
+                tensor_rows = _partition.rows_of(*partition, num_rows, partition_by, reader.chunks())
+            tensor = _run.open_tensor(parent_dir / _cutout.TENSOR_FILE_NAME,
+                                      (num_rows if tensor_rows is None else len(tensor_rows), len(bands), *grid_size),
+                                      dtype)
+
+        # 4. Open info file and shard index, rows are written in order as soon as they are completed.
+        # The info file body is written first, the comments on top are only known at the end
+        info_writer = index_writer = None
+        if info_file:
+            info_writer = csv.writer(outputs.enter_context(open(parent_dir / 'info.csv.part', 'w')))
+            info_writer.writerow(['row', 'ra_orig', 'dec_orig', 'found', 'ra', 'dec', 'dir_name', 'objid',
+                                  'cutout_shape', 'clipped', 'error'])
+        if output_format == 'shards':
+            index_writer = csv.writer(outputs.enter_context(open(parent_dir / _shards.INDEX_FILE_NAME, 'w',
+                                                                 newline='')))
+            index_writer.writerow(['row', 'band', 'shard', 'ext', 'offset', 'size'])
+        # Rows are kept from when they are read until they are written, their records are then dropped from the
+        # manifest in memory
+        rows = _run.Rows(manifest, bands, cutout, info_writer, index_writer)
+        counts = rows.counts
+
+        # 5. Search items are created lazily from each chunk, each is a batch of rows resolved together.
+        # A search cache opened from a path is closed with the outputs
+        search_cache = outputs.enter_context(__open_search_cache(search_cache))
+        local_catalog = _catalog.LocalCatalog(catalog) if catalog is not None else None
+        frame_cache = __as_frame_cache(frame_cache)
+        # Galaxies on a frame found by different searches are downloaded by different tasks, which share the frame
+        frame_memo = _frame_memo.FrameMemo(2 * num_workers)
+        # Decompression and cutouts can be sent from the download threads to a small process pool
+        use_cpu_pool = cutout and engine == 'thread' and cpu_workers > 0
+
+        def plan_downloads(row_ids):
+            frame_groups = _run.plan_downloads(row_ids, rows, store)
+            download_pbar.total += sum(len(group) for group in frame_groups.values())
+            download_pbar.refresh()
+            return frame_groups.items()
+
+        def download_args(frame_key, group):
+            return __download_args(__get_url_from_imaging_data(*frame_key), group, parent_dir, output_format,
+                                   cutout, (grid_size, grid_scale), frame_cache, cpu_executor, keep_compressed,
+                                   encoding, frame_memo)
+
+        # 6. Search galaxies and download images # TODO: flag if petroRad_err is -1000
+        # Each search result is recorded and its images are queued for download, one task per frame
+        search_workers = search_workers or num_workers
+        queue_size = queue_size or 4 * num_workers
+        download_func = __download_frame_cutouts_wrapper if cutout else __download_frame_wrapper
+        num_frames = 0
+        cache_hits = 0
+        run_metrics = _metrics.Metrics()
+        loop_start = time.perf_counter()
+        with _executor.borrow(pools, 'search', engine, search_workers) as search_executor, \
+                _executor.borrow(pools, 'download', engine, num_workers) as download_executor, \
+                (_executor.borrow(pools, 'cpu', 'process', cpu_workers) if use_cpu_pool
+                 else contextlib.nullcontext()) as cpu_executor, \
+                (_shards.ShardWriter(parent_dir / _shards.DIR_NAME, shard_size) if output_format == 'shards'
+                 else contextlib.nullcontext()) as shard_writer, \
+                tqdm(total=num_rows, disable=not progress_bar,
+                     desc="Searching galaxies", unit="obj", position=0) as search_pbar, \
+                tqdm(total=0, disable=not progress_bar, desc="Downloading images", unit="img",
+                     position=1) as download_pbar:
+            store = _run.ImageStore(parent_dir, bands, output_format, shard_writer, tensor, tensor_rows)
+            search_items = _run.search_items(reader, rows, max_search_radius, search_batch_size, partition,
+                                             partition_by, local_catalog, search_cache, search_pbar)
+
+            if pipeline:
+                stages = [(search_items, lambda: ())]
             else:
-                download_args.append((url, target_dir / file_path))
+                # Search all galaxies first, then plan all downloads at once, failed searches are already done
+                stages = [(search_items, lambda: ()),
+                          ((), lambda: plan_downloads(i for i in range(num_rows) if i in manifest.searches))]
+
+            for stage_search_items, plan_initial in stages:
+                events = _executor.pipeline(search_executor, __search_rows_wrapper, stage_search_items,
+                                            download_executor, download_func,
+                                            lambda args, _: plan_downloads(args[0]) if pipeline else (),
+                                            download_args, 2 * search_workers, 2 * num_workers, queue_size,
+                                            plan_initial(), return_exceptions=True, metrics=run_metrics)
+                for stage, item, result in events:
+                    if isinstance(result, BaseException):
+                        # A failed search or download fails its rows, not the run
+                        if not isinstance(result, __row_errors()):
+                            raise result
+                        if stage == 0:
+                            for i in item[0]:
+                                rows.fail(i, f"search: {__summarize_error(result)}")
+                                rows.complete(i)
+                            run_metrics.add('failed_searches')
+                            search_pbar.update(len(item[0]))
+                        else:
+                            for i, band, _, _ in item[1]:
+                                rows.fail(i, f"{band}: {__summarize_error(result)}")
+                                rows.image_done(i)
+                            run_metrics.add('failed_downloads')
+                            download_pbar.update(len(item[1]))
+                        continue
+
+                    # Metrics recorded by the task, possibly in another process
+                    result, task_metrics = result
+                    run_metrics.merge(task_metrics)
+                    if stage == 0:
+                        # Known rows are already recorded
+                        if item[1] is not None:
+                            for i, gal in zip(item[0], result):
+                                manifest.add_search(i, gal)
+                            if search_cache is not None:
+                                search_cache.put_many([(ra, dec, gal) for (_, ra, dec), gal in zip(item[2], result)],
+                                                      max_search_radius)
+                        search_pbar.update(len(result))
+                    else:
+                        (_, group), (records, cache_hit) = item, result
+                        for (i, band, rel_path, _), record in zip(group, records):
+                            manifest.add_file(i, band, store.store(i, band, rel_path, record, run_metrics))
+                            rows.image_done(i)
+                        num_frames += 1
+                        cache_hits += cache_hit
+                        download_pbar.update(len(records))
+
+        loop_time = time.perf_counter() - loop_start
+        # Tasks sharing a frame fetched by another task did not fetch it
+        num_frames -= run_metrics.counters.get('frames_reused', 0)
+        if search_cache is not None and local_catalog is None:
+            run_metrics.add('search_cache_lookups', counts['cache_searches'])
+            run_metrics.add('search_cache_hits', counts['cache_hits'])
+        if tensor is not None:
+            tensor.flush()
+
+        # 7. Print summary
+        if local_catalog is not None:
+            pu.verbose_print(verbose, f"...Searched {counts['local_searches']} galaxies in local catalog "
+                                      f"of {len(local_catalog)} galaxies")
+        elif search_cache is not None:
+            pu.verbose_print(verbose, f"...Search cache hits: {counts['cache_hits']} out of "
+                                      f"{counts['cache_searches']} searches")
+        if frame_cache is not None:
+            pu.verbose_print(verbose, f"...Frame cache hits: {cache_hits} out of {num_frames} frames")
+
+        pu.verbose_print(verbose, f"...Found {counts['found']} out of {counts['rows']} galaxies")
+
+        if counts['failed']:
+            print(pu.red(f"...{counts['failed']} rows failed, see the error column of the info file, "
+                         f"run again with the same output_dir to retry them"))
+
+        if counts['clipped']:
+            pu.verbose_print(verbose, pu.red(f"...{counts['clipped']} galaxies are near the frame edges, "
+                                             f"their cutouts are clipped"))
+
+    # 8. Save info file, comments are written on top of the body written during the run
+    if info_file:
+        pu.verbose_print(verbose, f"...Saving info file at {pu.blue(parent_dir / 'info.csv')}")
+        comments = [f"Found {counts['found']} out of {counts['rows']} galaxies in {file}"]
+        if partition is not None:
+            comments.append(f"Partition {partition[0]} of {partition[1]}, split by {partition_by}")
+        if cutout:
+            comments.append(f"Images are cutout based on galaxy's petrosian radius")
+        else:
+            comments.append(f"Images are standard SDSS frame (not cropped)")
+        comments.append(f"-- Bands: {' '.join(bands)}")
+        comments.append(f"-- Max search radius: {max_search_radius} arcmin")
+        if output_format == 'tensor':
+            comments.append(f"-- Resampled onto {grid_size[0]}x{grid_size[1]} grids in {_cutout.TENSOR_FILE_NAME}, "
+                            f"indexed by row and band")
+        if encoding is not None:
+            comments.extend(f"-- {line}" for line in _encoding.describe(encoding))
+        _run.write_info_file(parent_dir, comments)
+
+    if output_format == 'shards':
+        pu.verbose_print(verbose, f"...Saved shard index at {pu.blue(parent_dir / _shards.INDEX_FILE_NAME)}")
+
+    # 9. Fetch thumbnails of the found galaxies
+    if thumbnails:
+        download_thumbnails(parent_dir, num_workers=num_workers, mosaic=thumbnails == 'mosaic',
+                            progress_bar=progress_bar, verbose=verbose, pools=pools)
+
+    # 10. Save run report, worker utilization is the share of the search and download time spent in tasks
+    histograms = run_metrics.histograms
+    busy = {name: histograms[name].sum if name in histograms else 0. for name in ('search_task', 'download_task')}
+    report = {'file': str(file), 'output_dir': str(parent_dir), 'rows': counts['rows'], 'found': counts['found'],
+              'failed': counts['failed'], 'clipped': counts['clipped'], 'frames': num_frames,
+              'frame_cache_hits': cache_hits, 'partition': None if partition is None else list(partition),
+              'wall_time': time.perf_counter() - start_time,
+              'workers': {'search': search_workers, 'download': num_workers,
+                          'cpu': cpu_workers if use_cpu_pool else 0},
+              'utilization': {'search': busy['search_task'] / (search_workers * loop_time) if loop_time else 0.,
+                              'download': busy['download_task'] / (num_workers * loop_time) if loop_time else 0.},
+              **run_metrics.to_dict()}
+    with open(parent_dir / _REPORT_FILE_NAME, 'w') as f:
+        json.dump(report, f, indent=2)
+    pu.verbose_print(verbose, f"...Saved run report at {pu.blue(parent_dir / _REPORT_FILE_NAME)}")
+    if report_callback is not None:
+        report_callback(report)
 
-    # 8. Download images # TODO: flag if petroRad_err is -1000
-    download_func = __download_fits_image_with_cutout_wrapper if cutout else __download_fits_image_wrapper
-    with Pool(num_workers) as pool:
-        return_val = list(tqdm(pool.imap(download_func, download_args),
-                               total=len(download_args), disable=not progress_bar,
-                               desc="Downloading images", unit="img"))
+    pu.verbose_print(verbose, pu.green(pu.bold(f"ALL DONE!")))  # TODO: refactor to use class method chaining
 
-    # 9. Create cutout shape column based on return value
-    if cutout:
-        # return_val is list of shapes in order, same galaxy will have duplicate shapes for each band, only keep one
-        found_cutout_shapes = [shape for i, shape in enumerate(return_val) if i % len(bands) == 0]
-        # Create column for cutout shape including not found galaxies
-        cutout_shapes = [None] * len(galaxies)
-        for i, shape in zip(found_gal_row_ids, found_cutout_shapes):
-            cutout_shapes[i] = shape
-    else:
-        cutout_shapes = ['Uncut'] * len(galaxies)
 
-    # 10. Save info file
-    if info_file:
-        pu.verbose_print(verbose, f"...Saving info file at {pu.blue(parent_dir / 'info.csv')}")
-        with open(parent_dir / 'info.csv', 'w') as f:
-            # Write comments on top
-            f.write(f"# Found {len(found_gal_row_ids)} out of {len(galaxies)} galaxies in {file}\n")
-            if cutout:
-                f.write(f"# Images are cutout based on galaxy's petrosian radius\n")
-            else:
-                f.write(f"# Images are standard SDSS frame (not cropped)\n")
-            f.write(f"# -- Bands: {' '.join(bands)}\n")
-            f.write(f"# -- Max search radius: {max_search_radius} arcmin\n")
-            f.write(f"{'-' * 40}\n")
+def merge_partitions(part_dirs, output_dir, file=None, verbose=True):
+    """Merge the output directories of the partitions of a download run into one run
 
-            writer = csv.writer(f)
+    The info file, shard index, tensor and manifest of the partitions are merged in `output_dir`, rows in the
+    order of the catalog file, as if the whole file had been downloaded there. Images stay in the partition
+    directories, paths in the merged run point to them, except grids of a tensor which are copied.
 
-            # Write header
-            writer.writerow(['ra_orig', 'dec_orig', 'found', 'ra', 'dec', 'dir_name', 'objid', 'cutout_shape'])
+    Parameters
+    ----------
+    part_dirs: iterable of `str` or `pathlib.Path`
+        Output directories of all partitions, run by `download_images` with the same file and parameters
+        and a different partition index each
+    output_dir: `str` or `pathlib.Path`
+        Directory of the merged run, created if it does not exist
+    file: `str` or `pathlib.Path`, default=None
+        Catalog file, only read if partitions are split by sky, default is the file recorded by the partitions
+    verbose: `bool`, default=True
+        Whether to print progress
 
-            # Write data
-            for i, gal in enumerate(galaxies):
-                if gal is None:
-                    writer.writerow([orig_ra_list[i], orig_dec_list[i], False, None, None, None, None, None])
-                else:
-                    writer.writerow(
-                        [orig_ra_list[i], orig_dec_list[i], True, gal['ra'], gal['dec'], names[i], gal['objid'],
-                         cutout_shapes[i]])
+    Raises
+    ------
+    ValueError
+        Raised if a directory is not a finished partition, a partition is missing or given twice,
+        or partitions were run with different parameters
+    OSError
+        Raised if can not read the catalog file
+    """
 
-    pu.verbose_print(verbose, pu.green(pu.bold(f"ALL DONE!")))  # TODO: refactor to use class method chaining
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # 1. Read the parameters of each partition, all must be finished and run with the same parameters
+    parts = {}
+    for part_dir in map(pathlib.Path, part_dirs):
+        params = next(_manifest.iter_records(part_dir / _manifest.FILE_NAME), None)
+        if params is None or params['type'] != 'params' or params.get('partition') is None:
+            raise ValueError(f"{part_dir} is not the output directory of a partition of a download run")
+        if not (part_dir / 'info.csv').exists():
+            raise ValueError(f"Partition in {part_dir} is not finished, it has no info file")
+        index, count = params['partition']
+        if index in parts:
+            raise ValueError(f"Partition {index} is in both {parts[index][0]} and {part_dir}")
+        parts[index] = (part_dir, params)
+
+    first = parts[min(parts)][1]
+    count = first['partition'][1]
+    missing = sorted(set(range(count)) - set(parts))
+    if missing:
+        raise ValueError(f"Partitions {', '.join(map(str, missing))} of {count} are missing")
+    for part_dir, params in parts.values():
+        if params['partition'][1] != count:
+            raise ValueError(f"Partition in {part_dir} is one of {params['partition'][1]}, not {count} partitions")
+        for key in params.keys() | first.keys():
+            if key not in ('type', 'file', 'partition') and params.get(key) != first.get(key):
+                raise ValueError(f"Partition in {part_dir} was run with {key} {params.get(key)!r}, "
+                                 f"not {first.get(key)!r}")
+
+    num_rows, output_format, partition_by = first['num_rows'], first['output_format'], first['partition_by']
+    file = first['file'] if file is None else file
+    # Paths in the merged run are relative to it
+    prefixes = {index: pathlib.Path(os.path.relpath(part_dir, output_dir)).as_posix()
+                for index, (part_dir, _) in parts.items()}
+
+    def row_parts():
+        # Partition of each row, computed again as the partitions did, in chunks of rows
+        if partition_by == 'rows':
+            for start in range(0, num_rows, 100_000):
+                rows = range(start, min(start + 100_000, num_rows))
+                yield start, _partition.assign(rows, None, None, num_rows, count, partition_by)
+            return
+        reader = _reader.CatalogReader(file, first['ra_col'], first['dec_col'], chunk_size=100_000)
+        if len(reader) != num_rows:
+            raise ValueError(f"File {file} has {len(reader)} rows, but partitions were run on {num_rows} rows")
+        for start, ra_list, dec_list, _ in reader.chunks():
+            yield start, _partition.assign(range(start, start + len(ra_list)), ra_list, dec_list, num_rows, count,
+                                           partition_by)
+
+    # 2. Merge info files, taking the next row of the partition of each row
+    counts = collections.Counter()
+    with contextlib.ExitStack() as stack:
+        readers = {}
+        for index, (part_dir, _) in parts.items():
+            lines = (line for line in stack.enter_context(open(part_dir / 'info.csv', newline=''))
+                     if not line.startswith('#'))
+            next(lines)  # separator line
+            readers[index] = csv.reader(lines)
+            header = next(readers[index])
+        found_col, dir_col = header.index('found'), header.index('dir_name')
+
+        with open(output_dir / 'info.csv.part', 'w') as body:
+            writer = csv.writer(body)
+            writer.writerow(header)
+            for start, row_part in row_parts():
+                for k, index in enumerate(row_part):
+                    row = next(readers[index], None)
+                    if row is None:
+                        raise ValueError(f"Partition in {parts[index][0]} has fewer rows than assigned to it")
+                    if header[0] == 'row' and int(row[0]) != start + k:
+                        raise ValueError(f"Partition in {parts[index][0]} has row {row[0]} where row {start + k} "
+                                         f"is assigned to it")
+                    if row[found_col] == 'True':
+                        counts['found'] += 1
+                        if output_format == 'files':
+                            row[dir_col] = f"{prefixes[index]}/{row[dir_col]}"
+                    writer.writerow(row)
+
+    # Comments of the partitions, except their counts and partition
+    with open(parts[min(parts)][0] / 'info.csv') as f:
+        comments = [line for line in itertools.takewhile(lambda line: line.startswith('#'), f)
+                    if not line.startswith(('# Found', '# Partition'))]
+    with open(output_dir / 'info.csv', 'w') as f:
+        f.write(f"# Found {counts['found']} out of {num_rows} galaxies in {file}\n")
+        f.write(f"# Merged from {count} partitions, split by {partition_by}\n")
+        f.writelines(comments)
+        f.write(f"{'-' * 40}\n")
+    with open(output_dir / 'info.csv', 'ab') as f, open(output_dir / 'info.csv.part', 'rb') as body:
+        shutil.copyfileobj(body, f)
+    (output_dir / 'info.csv.part').unlink()
+
+    # 3. Merge shard indexes, each is in row order
+    def prefix_shards(rows, prefix):
+        for row, band, shard, *rest in rows:
+            yield [row, band, f"{prefix}/{shard}", *rest]
+
+    if output_format == 'shards':
+        with contextlib.ExitStack() as stack:
+            indexes = []
+            for index, (part_dir, _) in sorted(parts.items()):
+                rows = csv.reader(stack.enter_context(open(part_dir / _shards.INDEX_FILE_NAME, newline='')))
+                header = next(rows)
+                indexes.append(prefix_shards(rows, prefixes[index]))
+            with open(output_dir / _shards.INDEX_FILE_NAME, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(heapq.merge(*indexes, key=lambda row: int(row[0])))
+
+    # 4. Copy the grids of each partition into one tensor. Row k of the tensor of a partition is its k-th row,
+    # partitions of older runs have tensors of all rows
+    tensor = None
+    if output_format == 'tensor':
+        tensors = {index: np.load(part_dir / _cutout.TENSOR_FILE_NAME, mmap_mode='r')
+                   for index, (part_dir, _) in parts.items()}
+        tensor = np.lib.format.open_memmap(output_dir / _cutout.TENSOR_FILE_NAME, mode='w+',
+                                           dtype=tensors[0].dtype, shape=(num_rows, *tensors[0].shape[1:]))
+        taken = collections.Counter()  # rows of each partition copied so far
+        for start, row_part in row_parts():
+            for index in np.unique(row_part):
+                rows = start + np.flatnonzero(row_part == index)
+                if len(tensors[index]) == num_rows:
+                    sources = rows
+                else:
+                    sources = np.arange(taken[index], taken[index] + len(rows))
+                taken[index] += len(rows)
+                # Copied in slices, so only a few grids are in memory at a time
+                for k in range(0, len(rows), 1024):
+                    tensor[rows[k:k + 1024]] = tensors[index][sources[k:k + 1024]]
+        tensor.flush()
+
+    # 5. Merge manifests, so the merged run can be loaded like any other
+    with open(output_dir / _manifest.FILE_NAME, 'w') as f:
+        params = {**first, 'file': str(file), 'partition': None, 'partition_by': None}
+        f.write(json.dumps(params) + '\n')
+        for index, (part_dir, _) in sorted(parts.items()):
+            for record in _manifest.iter_records(part_dir / _manifest.FILE_NAME):
+                if record['type'] == 'params':
+                    continue
+                if record['type'] == 'file' and output_format != 'tensor':
+                    record['path'] = f"{prefixes[index]}/{record['path']}"
+                elif record['type'] == 'file':
+                    # Byte range of the grid in the merged tensor
+                    grid = record['row'] * len(first['bands']) + first['bands'].index(record['band'])
+                    record['offset'] = tensor.offset + record['size'] * grid
+                f.write(json.dumps(record) + '\n')
+
+    pu.verbose_print(verbose, f"...Merged {count} partitions into {pu.blue(output_dir)}, "
+                              f"found {counts['found']} out of {num_rows} galaxies")
 
 
 def __get_random_galaxy_objid():
@@ -268,13 +1132,12 @@ def __get_random_galaxy_objid():
     """
 
     # Get random objid
-    req = requests.get(f"http://skyserver.sdss.org/dr17/SkyServerWS/SearchTools/SqlSearch?cmd="
-                       f"SELECT TOP 1 g.objid FROM Galaxy AS g "
-                       f"JOIN ZooNoSpec as z ON g.objid = z.objid "
-                       f"WHERE g.clean = 1 AND g.petroRad_r>12 AND g.petroRadErr_r!=-1000 "
-                       f"ORDER BY NEWID()")
+    rows = __sql_search("SELECT TOP 1 g.objid FROM Galaxy AS g "
+                        "JOIN ZooNoSpec as z ON g.objid = z.objid "
+                        "WHERE g.clean = 1 AND g.petroRad_r>12 AND g.petroRadErr_r!=-1000 "
+                        "ORDER BY NEWID()")
 
-    return req.json()[0]['Rows'][0]['objid']
+    return rows[0]['objid']
 
 
 def __get_galaxy_imaging_data(objid):
@@ -291,11 +1154,10 @@ def __get_galaxy_imaging_data(objid):
     """
 
     # Get imaging data
-    req = requests.get(f"http://skyserver.sdss.org/dr17/SkyServerWS/SearchTools/SqlSearch?cmd="
-                       f"SELECT run, camcol, field, ra, dec, petroRad_r FROM Galaxy "
-                       f"WHERE objid = {objid}")
+    rows = __sql_search(f"SELECT run, camcol, field, ra, dec, petroRad_r FROM Galaxy "
+                        f"WHERE objid = {objid}")
 
-    return req.json()[0]['Rows'][0]
+    return rows[0]
 
 
 def __get_galaxy_jpg_image(ra, dec, petro_r):
@@ -316,17 +1178,61 @@ def __get_galaxy_jpg_image(ra, dec, petro_r):
         Image data as numpy array
     """
 
+    from PIL import Image
+
+    # Read jpg image url into numpy array
+    jpg_data = np.asarray(Image.open(io.BytesIO(_http.get_content(__get_jpg_url(ra, dec, petro_r)))))
+    return jpg_data
+
+
+def __get_jpg_url(ra, dec, petro_r, img_size=256):
+    """Get the ImgCutout url of a jpg image of a galaxy
+
+    Parameters
+    ----------
+    ra : `float`
+        right ascension in degrees
+    dec : `float`
+        declination in degrees
+    petro_r : `float`
+        petrosian radius in arcsec
+    img_size : `int`, default=256
+        Image width and height in pixels
+
+    Returns
+    -------
+    url : `str`
+    """
+
     # Compute scale, defined as "/pix
     # Fix image size 2*1.25*radius arcsec
-    img_size = 256
     scale = 2 * 1.25 * petro_r / img_size
 
-    url = f"http://skyserver.sdss.org/dr17/SkyServerWS/ImgCutout/getjpeg?" \
+    url = f"{_SKYSERVER_URL}/ImgCutout/getjpeg?" \
           f"ra={ra}&dec={dec}&scale={scale}&width={img_size}&height={img_size}"
+    return url
 
-    # Read jpg image url into numpy array
-    jpg_data = np.asarray(Image.open(urlopen(url)))
-    return jpg_data
+
+def __fetch_thumbnail_wrapper(args):
+    """Wrapper to fetch a jpg thumbnail into a file for multiprocessing
+
+    args is (url, path). Returns whether the thumbnail was already on disk,
+    or the error if the fetch failed, so it only fails its galaxy.
+    """
+
+    url, path = args
+    if path.exists():
+        return True
+    try:
+        content = _http.get_content(url)
+    except __row_errors() as e:
+        return e
+
+    # Write to a temporary file first, so a partial thumbnail is never taken as cached
+    part_path = path.with_suffix('.part')
+    part_path.write_bytes(content)
+    part_path.replace(path)
+    return False
 
 
 def __get_url_from_imaging_data(run, camcol, field, band):
@@ -345,67 +1251,267 @@ def __get_url_from_imaging_data(run, camcol, field, band):
     url : `str`
     """
 
-    url = f"http://dr17.sdss.org/sas/dr17/eboss/photoObj/frames/301/" \
+    url = f"{_SAS_URL}/eboss/photoObj/frames/301/" \
           f"{run}/{camcol}/frame-{band}-{run:06d}-{camcol}-{field:04d}.fits.bz2"
     return url
 
 
-def __cutout_galaxy_fits_image(fits_file, ra, dec, petro_r):
+def __cutout_galaxy_fits_image_wrapper(args):
+    """Wrapper for __cutout_galaxy_fits_image for multiprocessing"""
+
+    return __cutout_galaxy_fits_image(*args)
+
+
+def __cutout_galaxy_fits_image(fits_url, ra, dec, petro_r, frame_cache=None):
     """Cutout galaxy fits image
 
     Parameters
     ----------
-    fits_file : `str`
-        Path to fits file, can be url or local path
+    fits_url : `str`
+        url to fits image
     ra : `float`
         right ascension in degrees
     dec : `float`
         declination in degrees
     petro_r : `float`
         petrosian radius in arcsec
+    frame_cache : `.cache.FrameCache`, default=None
+        Cache to read the frame from
 
     Returns
     -------
     cutout : `numpy.ndarray`
         Cutout image data as numpy array
+    clipped : `bool`
+        Whether the cutout was clipped by the frame edges
     """
 
-    r = petro_r / 3600  # convert to degrees
+    cutouts, clipped = __cutout_frame_galaxies(fits_url, [(ra, dec, petro_r)], frame_cache)
+    return cutouts[0], clipped[0]
 
-    hdu = None
-    while True:
-        try:  # Read fits file
-            hdu = fits.open(fits_file, cache=False)
-            break
-        except TimeoutError:
-            continue
+
+def __fetch_random_galaxy_part_wrapper(args):
+    """Wrapper to fetch a jpg image or the cutouts of a frame for multiprocessing
+
+    args is ('jpg', (ra, dec, petro_r)) to return `__get_galaxy_jpg_image`, or ('frame', (fits_url, positions,
+    frame_cache)) to return `__cutout_frame_galaxies`. A failed fetch returns its error instead of raising it.
+    """
+
+    kind, params = args
+    try:
+        if kind == 'jpg':
+            return __get_galaxy_jpg_image(*params)
+        return __cutout_frame_galaxies(*params)
+    except __row_errors() as e:
+        return e
+
+
+def __cutout_frame_galaxies(fits_url, positions, frame_cache=None):
+    """Cutout every galaxy on a frame
+
+    Parameters
+    ----------
+    fits_url : `str`
+        url to fits image
+    positions : `list` of `tuple`
+        List of (ra, dec, petro_r) for each galaxy on the frame, ra and dec in degrees, petro_r in arcsec
+    frame_cache : `.cache.FrameCache`, default=None
+        Cache to read the frame from
+
+    Returns
+    -------
+    cutouts : `list` of `numpy.ndarray`
+        Cutout image data of each galaxy, in order of positions
+    clipped : `list` of `bool`
+        Whether each cutout was clipped by the frame edges
+    """
+
+    content, _ = __fetch_frame_content(fits_url, frame_cache)
+    data, wcs = __open_fits_frame(content)
+    cutouts, clipped = _cutout.cutout_galaxies(data, wcs, *zip(*positions))
+    # Copy the cutouts so the frame is not kept alive by the views
+    return [cutout_arr.copy() for cutout_arr in cutouts], [bool(is_clipped) for is_clipped in clipped]
+
+
+def __as_frame_cache(frame_cache):
+    """Get a FrameCache from a FrameCache or a cache directory
+
+    Parameters
+    ----------
+    frame_cache : `.cache.FrameCache`, `str`, `pathlib.Path` or `None`
+
+    Returns
+    -------
+    frame_cache : `.cache.FrameCache` or `None`
+    """
+
+    if frame_cache is None or isinstance(frame_cache, FrameCache):
+        return frame_cache
+    return FrameCache(frame_cache)
+
+
+def __open_search_cache(search_cache):
+    """Get a SearchCache from a SearchCache or a cache database path, as a context manager
+
+    A cache opened from a path is closed on exit, a cache given as is is left open for the caller
+
+    Parameters
+    ----------
+    search_cache : `.cache.SearchCache`, `str`, `pathlib.Path` or `None`
+
+    Returns
+    -------
+    context : context manager of `.cache.SearchCache` or `None`
+    """
+
+    if search_cache is None or isinstance(search_cache, SearchCache):
+        return contextlib.nullcontext(search_cache)
+    return SearchCache(search_cache)
+
+
+def __row_errors():
+    """Errors of a search or download that fail its rows instead of the whole run
+
+    Network errors, responses that are not JSON, and corrupt, truncated or unreadable frames.
+    Other errors are bugs and propagate.
+    """
+
+    from astropy.io.fits.verify import VerifyError
+    from astropy.wcs import WcsError
+
+    return requests.RequestException, json.JSONDecodeError, OSError, EOFError, VerifyError, WcsError
+
+
+def __summarize_error(error, max_length=80):
+    """Short description of an error for the info file, its type and HTTP status code or first message line
+
+    Messages of network errors are left out, they hold the whole url, which has the SQL query of a search.
+    """
+
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return f"{type(error).__name__} {response.status_code}"
+    if isinstance(error, requests.RequestException):
+        return type(error).__name__
+    message = str(error).split('\n')[0]
+    if len(message) > max_length:
+        message = message[:max_length - 3] + '...'
+    return f"{type(error).__name__}: {message}" if message else type(error).__name__
+
+
+def __fetch_frame(fits_url, frame_cache):
+    """Get the source to read a frame from, downloading it into the cache if needed
+
+    Parameters
+    ----------
+    fits_url : `str`
+        url to fits image
+    frame_cache : `.cache.FrameCache` or `None`
+        Frame cache, if None the url is returned as is
+
+    Returns
+    -------
+    source : `str` or `pathlib.Path`
+        url or path of cached file
+    cache_hit : `bool`
+        Whether the frame was found in the cache
+    """
+
+    if frame_cache is None:
+        return fits_url, False
+
+    path = frame_cache.get(fits_url)
+    if path is not None:
+        return path, True
+
+    return frame_cache.download(fits_url), False
+
+
+def __fetch_frame_content(fits_url, frame_cache, frame_memo=None):
+    """Get the compressed content of a frame, from the cache if possible
+
+    Parameters
+    ----------
+    fits_url : `str`
+        url to fits image
+    frame_cache : `.cache.FrameCache` or `None`
+        Frame cache, if None the frame is downloaded
+    frame_memo : `._frame_memo.FrameMemo`, default=None
+        Frames fetched by other tasks of the run, to reuse, None to always fetch the frame
+
+    Returns
+    -------
+    content : `bytes`
+        bz2 compressed fits file
+    cache_hit : `bool`
+        Whether the frame was found in the cache, False if it was fetched by another task
+    """
+
+    if frame_memo is not None:
+        (content, cache_hit), reused = frame_memo.get(fits_url, lambda: __fetch_frame_content(fits_url, frame_cache))
+        if reused:
+            _metrics.add('frames_reused')
+        return content, cache_hit and not reused
+
+    with _metrics.timer('frame_fetch'):
+        if frame_cache is not None:
+            path, cache_hit = __fetch_frame(fits_url, frame_cache)
+            return pathlib.Path(path).read_bytes(), cache_hit
+
+        return _http.get_content(fits_url), False
+
+
+def __open_fits_frame(content):
+    """Decompress fits frame and read its data and wcs
+
+    Parameters
+    ----------
+    content : `bytes`
+        bz2 compressed fits file
+
+    Returns
+    -------
+    data : `numpy.ndarray`
+        Frame image data
+    wcs : `astropy.wcs.WCS`
+        Frame wcs
+    """
+
+    from astropy.io import fits
+    from astropy.wcs import WCS, FITSFixedWarning
+
+    # Blocks are decompressed in parallel, the CPU time is recorded as frame_decompress_cpu
+    hdu = fits.open(io.BytesIO(_bz2_blocks.decompress(content)))
 
     # Read wcs, ignore warnings
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=FITSFixedWarning)
         wcs = WCS(hdu[0].header)
 
-    # Compute cutout size
-    coord = SkyCoord(ra, dec, unit='deg')
-    edge_coord = SkyCoord(ra + r, dec + r, unit='deg')
-    x, y = wcs.world_to_pixel(coord)
-    x_edge, y_edge = wcs.world_to_pixel(edge_coord)
-    # radius is max of x and y, cutout radius is 1.25*radius rounded up to nearest 10
-    radius = max(abs(x - x_edge), abs(y - y_edge))
-    cutout_radius = int(np.ceil(1.25 * radius / 10) * 10)
+    return hdu[0].data, wcs
 
-    # Get cutout, indices in integer
-    min_y, max_y = int(y - cutout_radius), int(y + cutout_radius)
-    min_x, max_x = int(x - cutout_radius), int(x + cutout_radius)
-    cutout_image = hdu[0].data[min_y:max_y, min_x:max_x]
 
-    return cutout_image
+def __search_rows_wrapper(args):
+    """Wrapper to search a batch of rows for multiprocessing
 
+    args is (row_ids, batched, coords, max_search_radius), coords is a list of (row_id, ra, dec).
+    If batched, all rows are searched with `__search_nearby_galaxies`, else the single row with
+    `__search_nearby_galaxy`. If batched is None, the rows are already resolved and coords is their list of
+    galaxy dict or None, returned as is. Always returns a list of galaxy dict or None, in order of row_ids,
+    and the `._metrics.Metrics` of the task.
+    """
 
-def __search_nearby_galaxy_wrapper(args):
-    """Wrapper for __search_nearby_galaxy for multiprocessing"""
+    _, batched, coords, max_search_radius = args
+    with _metrics.capture() as metrics:
+        if batched is None:
+            return coords, metrics
+        with _metrics.timer('search_task'):
+            if batched:
+                galaxies = __search_nearby_galaxies(coords, max_search_radius)
+            else:
+                galaxies = [__search_nearby_galaxy(ra, dec, max_search_radius) for _, ra, dec in coords]
 
-    return __search_nearby_galaxy(*args)
+    return galaxies, metrics
 
 
 def __search_nearby_galaxy(ra, dec, max_search_radius, verbose=False):
@@ -428,96 +1534,575 @@ def __search_nearby_galaxy(ra, dec, max_search_radius, verbose=False):
 
     Returns
     -------
-    gal : `dict` or `None` if no galaxy found
+    gal : `dict` or `None` if no galaxy found, or ra or dec is not finite
         Dictionary with keys 'objid', 'run', 'camcol', 'field', 'ra', 'dec', 'petroRad_r', 'petroRadErr_r'
     """
 
-    url = "http://skyserver.sdss.org/dr17/SkyServerWS/SearchTools/SqlSearch?cmd=" \
-          "SELECT TOP 1 G.objid, G.run, G.camcol, G.field, G.ra, G.dec, G.petroRad_r, G.petroRadErr_r " \
+    # nan or inf would be sent as a column name, which SkyServer rejects
+    if not (math.isfinite(ra) and math.isfinite(dec)):
+        return None
+
+    cmd = "SELECT TOP 1 G.objid, G.run, G.camcol, G.field, G.ra, G.dec, G.petroRad_r, G.petroRadErr_r " \
           "FROM Galaxy as G JOIN dbo.fGetNearbyObjEq({}, {}, {}) AS GN " \
           "ON G.objID = GN.objID " \
           "ORDER BY GN.distance"
 
+    radii = __search_radii(max_search_radius)
+    for retries, search_radius in enumerate(radii):
+        rows = __sql_search(cmd.format(ra, dec, search_radius))
+        if rows:
+            _metrics.tally('search_radius_retries', retries)
+            return rows[0]
+
+    _metrics.tally('search_radius_retries', len(radii) - 1)
+    pu.verbose_print(verbose, f"No nearby galaxy found within {max_search_radius} arcmin")
+
+    return None
+
+
+def __search_nearby_galaxies(coords, max_search_radius):
+    """Search for the nearest galaxy of many ra dec positions with one SQL request per search radius
+
+    Same search strategy as `__search_nearby_galaxy`, but all positions are sent in a single query,
+    joined to fGetNearbyObjEq with CROSS APPLY, so each radius costs one request for the whole batch.
+    Only positions without a galaxy found are searched again at the next radius.
+    Queries are sent as GET requests, so positions are split into as few queries as fit in `_MAX_QUERY_LENGTH`.
+
+    Parameters
+    ----------
+    coords : `list` of `tuple`
+        List of (row_id, ra, dec), ra and dec in degrees, row_id must be unique integers within the batch
+    max_search_radius : `float`
+        maximum search radius in arcmin
+
+    Returns
+    -------
+    galaxies : `list` of `dict` or `None`
+        Galaxy data in order of coords, `None` if no galaxy found or ra or dec is not finite,
+        dictionary with keys 'objid', 'run', 'camcol', 'field', 'ra', 'dec', 'petroRad_r', 'petroRadErr_r'
+    """
+
+    cmd = "SELECT p.id, G.objid, G.run, G.camcol, G.field, G.ra, G.dec, G.petroRad_r, G.petroRadErr_r " \
+          "FROM (VALUES {}) AS p(id, ra, dec) " \
+          "CROSS APPLY (SELECT TOP 1 G.objid, G.run, G.camcol, G.field, G.ra, G.dec, G.petroRad_r, G.petroRadErr_r " \
+          "FROM Galaxy as G JOIN dbo.fGetNearbyObjEq(p.ra, p.dec, {}) AS GN " \
+          "ON G.objID = GN.objID " \
+          "ORDER BY GN.distance) AS G"
+
+    found = {}
+    # nan or inf would be sent as a column name, which SkyServer rejects, failing the whole batch
+    remaining = [(int(row_id), float(ra), float(dec)) for row_id, ra, dec in coords
+                 if math.isfinite(ra) and math.isfinite(dec)]
+    retries = 0
+    for retries, search_radius in enumerate(__search_radii(max_search_radius)):
+        if not remaining:
+            break
+        for values in __split_values(cmd, search_radius, [f"({row_id}, {ra!r}, {dec!r})"
+                                                          for row_id, ra, dec in remaining]):
+            for row in __sql_search(cmd.format(values, search_radius)):
+                found[row.pop('id')] = row
+                _metrics.tally('search_radius_retries', retries)
+        remaining = [coord for coord in remaining if coord[0] not in found]
+
+    for _ in remaining:
+        _metrics.tally('search_radius_retries', retries)
+
+    return [found.get(int(row_id)) for row_id, _, _ in coords]
+
+
+def __split_values(cmd, search_radius, rows):
+    """Split the rows of a VALUES list into lists whose query fits in the query string of a GET request
+
+    Parameters
+    ----------
+    cmd : `str`
+        SQL command, formatted with the VALUES list and the search radius
+    search_radius : `float`
+        search radius in arcmin
+    rows : `list` of `str`
+        Rows of the VALUES list
+
+    Yields
+    ------
+    values : `str`
+        VALUES list of as many rows as fit in `_MAX_QUERY_LENGTH`, at least one
+    """
+
+    # Each row adds its own encoded length and a separator
+    length = len(urllib.parse.urlencode({'cmd': cmd.format('', search_radius)}))
+    separator = len(urllib.parse.quote_plus(", "))
+    batch, batch_length = [], length
+    for row in rows:
+        row_length = len(urllib.parse.quote_plus(row)) + (separator if batch else 0)
+        if batch and batch_length + row_length > _MAX_QUERY_LENGTH:
+            yield ", ".join(batch)
+            batch, batch_length = [], length
+            row_length -= separator
+        batch.append(row)
+        batch_length += row_length
+    if batch:
+        yield ", ".join(batch)
+
+
+def __search_radii(max_search_radius):
+    """Search radii used to find the nearest galaxy
+
+    Start with 1 arcmin and double the radius until over the max_search_radius,
+    then one last search at max_search_radius.
+
+    Parameters
+    ----------
+    max_search_radius : `float`
+        maximum search radius in arcmin
+
+    Returns
+    -------
+    radii : `list` of `float`
+        Search radii in arcmin, in increasing order
+    """
+
+    radii = []
     search_radius = 1
     while search_radius < max_search_radius:
-        req = requests.get(url.format(ra, dec, search_radius))
-        if req.json()[0]['Rows']:
-            return req.json()[0]['Rows'][0]
+        radii.append(search_radius)
         search_radius *= 2
 
     # Try one last search at max_search_radius
     if search_radius * 2 != max_search_radius:
-        req = requests.get(url.format(ra, dec, max_search_radius))
-        if req.json()[0]['Rows']:
-            return req.json()[0]['Rows'][0]
+        radii.append(max_search_radius)
 
-    pu.verbose_print(verbose, f"No nearby galaxy found within {max_search_radius} arcmin")
+    return radii
 
-    return None
 
+def __sql_search(cmd):
+    """Run a SQL command on the SDSS SkyServer SqlSearch service
+
+    Parameters
+    ----------
+    cmd : `str`
+        SQL command
 
-def __download_fits_image_wrapper(args):
-    """Wrapper for __download_fits_image for multiprocessing"""
+    Returns
+    -------
+    rows : `list` of `dict`
+        Rows of the first result table
+    """
 
-    return __download_fits_image(*args)
+    with _metrics.timer('search_query'):
+        req = _http.get(f"{_SKYSERVER_URL}/SearchTools/SqlSearch", params={'cmd': cmd})
+        return req.json()[0]['Rows']
 
 
-def __download_fits_image(fits_url, file_path):
+def __download_fits_image(fits_url, file_path, frame_cache=None, keep_compressed=False, encoding=None):
     """Download fits image from url to file_path
 
+    The compressed frame is decompressed while it is streamed, without writing a temporary file.
+    If an encoding is given, the frame is downloaded and decompressed in memory and its image encoded instead.
+
     Parameters
     ----------
     fits_url : `str`
         url to fits image
     file_path : `str`
         path to save fits image
+    frame_cache : `.cache.FrameCache`, default=None
+        Cache to read the frame from
+    keep_compressed : `bool`, default=False
+        Whether to also save the compressed frame to `<file_path>.bz2`
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`, None to save the frame as is
+
+    Returns
+    -------
+    sha256 : `str`
+        sha256 hex digest of the saved fits image
+    cache_hit : `bool`
+        Whether the frame was found in the cache
     """
 
-    # Download fits image
-    with urlopen(fits_url) as response, open(f"{file_path}.bz2", 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
+    compressed_path = f"{file_path}.bz2" if keep_compressed else None
+    if encoding is not None:
+        content, cache_hit = __fetch_frame_content(fits_url, frame_cache)
+        return __write_encoded(content, file_path, encoding, compressed_path), cache_hit
 
-    # Decompress
-    with bz2.open(f"{file_path}.bz2", 'rb') as in_file, open(file_path, 'wb') as out_file:
-        shutil.copyfileobj(in_file, out_file)
+    source, cache_hit = __fetch_frame(fits_url, frame_cache)
+    with (open(source, 'rb') if frame_cache is not None else _http.open_url(fits_url)) as in_file:
+        sha256 = __stream_decompress(in_file, file_path, compressed_path)
 
-    # Remove tmp file
-    pathlib.Path(f"{file_path}.bz2").unlink()
+    return sha256, cache_hit
 
 
-def __download_fits_image_with_cutout_wrapper(args):
-    """Wrapper for __download_fits_image_with_cutout for multiprocessing"""
+def __stream_decompress(in_file, file_path, compressed_path=None, chunk_size=1024 * 1024):
+    """Decompress a bz2 stream chunk by chunk into a file
 
-    return __download_fits_image_with_cutout(*args)
+    Parameters
+    ----------
+    in_file : file-like
+        Binary file object of bz2 compressed data, e.g. http response
+    file_path : `str`
+        path to save decompressed data
+    compressed_path : `str`, default=None
+        path to also save the compressed data, None to not save it
+    chunk_size : `int`, default=1024 * 1024
+        Number of compressed bytes read at a time
 
+    Returns
+    -------
+    sha256 : `str`
+        sha256 hex digest of the decompressed data
+    """
 
-def __download_fits_image_with_cutout(fits_url, file_path, ra, dec, petro_r):
-    """Download fits image from url to file_path and cutout galaxy
+    sha256 = hashlib.sha256()
+    decompressor = bz2.BZ2Decompressor()
+    # Reading, decompressing and writing are interleaved, their times are summed over the frame
+    fetch_time = decompress_time = write_time = 0.
+    with open(file_path, 'wb') as out_file, \
+            (open(compressed_path, 'wb') if compressed_path else contextlib.nullcontext()) as compressed_file:
+        while True:
+            start = time.perf_counter()
+            chunk = in_file.read(chunk_size)
+            fetch_time += time.perf_counter() - start
+            if not chunk:
+                break
+            if compressed_file is not None:
+                start = time.perf_counter()
+                compressed_file.write(chunk)
+                write_time += time.perf_counter() - start
+
+            # A bz2 file can hold multiple streams, start a new decompressor at the end of each stream
+            while chunk:
+                if decompressor.eof:
+                    decompressor = bz2.BZ2Decompressor()
+                start = time.thread_time()
+                data = decompressor.decompress(chunk)
+                sha256.update(data)
+                decompress_time += time.thread_time() - start
+                start = time.perf_counter()
+                out_file.write(data)
+                write_time += time.perf_counter() - start
+                chunk = decompressor.unused_data if decompressor.eof else b''
+
+    _metrics.observe('frame_fetch', fetch_time)
+    _metrics.observe('frame_decompress_cpu', decompress_time)
+    _metrics.observe('write', write_time)
+
+    if not decompressor.eof:
+        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {file_path}")
+
+    return sha256.hexdigest()
+
+
+def __write_encoded(content, file_path, encoding, compressed_path=None):
+    """Decompress a bz2 compressed fits frame and save it with its image encoded, its other HDUs as they are
+
+    Parameters
+    ----------
+    content : `bytes`
+        bz2 compressed fits file
+    file_path : `str`
+        path to save encoded fits file
+    encoding : `tuple`
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`
+    compressed_path : `str`, default=None
+        path to also save the compressed data, None to not save it
+
+    Returns
+    -------
+    sha256 : `str`
+        sha256 hex digest of the encoded fits file
+    """
+
+    from astropy.io import fits
+
+    with fits.open(io.BytesIO(_bz2_blocks.decompress(content))) as hdul:
+        with _metrics.timer('frame_encode_cpu', cpu=True):
+            encoded = _encoding.encode_file(hdul[0].data, encoding, hdul[0].header, hdul[1:])
+
+    with _metrics.timer('write'):
+        pathlib.Path(file_path).write_bytes(encoded)
+        if compressed_path is not None:
+            pathlib.Path(compressed_path).write_bytes(content)
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def __check_download_args(bands, engine, output_format, cutout, grid_size, thumbnails, partition, partition_by,
+                          compression, quantize_level, dtype):
+    """Check the arguments of `download_images`
+
+    Returns
+    -------
+    bands : `list` of `str`
+    grid_size : `tuple` of `int`
+        (height, width)
+    partition : `tuple` of `int` or `None`
+    encoding : `tuple` or `None`
+        (compression, quantize_level, dtype), None if images are stored as downloaded
+
+    Raises
+    ------
+    ValueError
+        Raised if bands, engine, output_format, thumbnails, partition, compression or dtype is invalid
+    """
+
+    if isinstance(bands, str):
+        bands = list(bands)
+    elif not isinstance(bands, list):
+        raise ValueError("bands must be a string or a list")
+
+    for band in bands:
+        if band not in 'ugriz':
+            raise ValueError(f"Invalid band {band}")
+
+    if engine not in _executor.ENGINES:
+        raise ValueError(f"Invalid engine {engine}, must be one of {', '.join(_executor.ENGINES)}")
+
+    if output_format not in ('files', 'shards', 'tensor'):
+        raise ValueError(f"Invalid output_format {output_format}, must be one of files, shards, tensor")
+    elif output_format != 'files' and not cutout:
+        raise ValueError(f"output_format '{output_format}' requires cutout")
+    grid_size = (grid_size, grid_size) if isinstance(grid_size, int) else tuple(grid_size)
+
+    if thumbnails not in (False, True, 'mosaic'):
+        raise ValueError(f"Invalid thumbnails {thumbnails}, must be False, True or 'mosaic'")
+
+    if partition is not None:
+        partition = tuple(partition)
+        if len(partition) != 2 or not 0 <= partition[0] < partition[1]:
+            raise ValueError(f"Invalid partition {partition}, must be (index, count) with 0 <= index < count")
+    if partition_by not in _partition.BY:
+        raise ValueError(f"Invalid partition_by {partition_by}, must be one of {', '.join(_partition.BY)}")
+
+    if compression is not None and compression not in _encoding.COMPRESSIONS:
+        raise ValueError(f"Invalid compression {compression}, must be None or one of "
+                         f"{', '.join(_encoding.COMPRESSIONS)}")
+    elif compression is not None and output_format == 'tensor':
+        raise ValueError("compression can not be used with output_format 'tensor'")
+    elif compression == 'rice' and quantize_level == 0 and dtype != 'int16':
+        raise ValueError("Lossless compression (quantize_level 0) requires compression 'gzip'")
+    if dtype not in _encoding.DTYPES:
+        raise ValueError(f"Invalid dtype {dtype}, must be one of {', '.join(_encoding.DTYPES)}")
+    elif dtype == 'float16' and output_format != 'tensor':
+        raise ValueError("dtype 'float16' requires output_format 'tensor', FITS has no float16")
+    elif dtype == 'int16' and output_format == 'tensor':
+        raise ValueError("dtype 'int16' can not be used with output_format 'tensor'")
+    elif dtype == 'int16' and not cutout:
+        # The range of a whole frame is set by its brightest stars, its sky and faint galaxies would be left
+        # with a few steps of 65536
+        raise ValueError("dtype 'int16' requires cutout")
+    encoding = (compression, quantize_level if compression and dtype != 'int16' else None, dtype)
+    encoding = None if encoding == (None, None, 'float32') else encoding
+
+    return bands, grid_size, partition, encoding
+
+
+def __download_args(fits_url, group, parent_dir, output_format, cutout, grid, frame_cache, cpu_executor,
+                    keep_compressed, encoding, frame_memo):
+    """Arguments of the download task of a frame of `download_images`
+
+    group is the list of (row id, band, rel_path, galaxy) of the images to cutout of the frame,
+    see `._run.plan_downloads`. Returns the args of `__download_frame_cutouts_wrapper` if cutout,
+    else of `__download_frame_wrapper`.
+    """
+
+    if output_format == 'shards':
+        return (fits_url, [(f"{i}_{band}", gal['ra'], gal['dec'], gal['petroRad_r']) for i, band, _, gal in group],
+                frame_cache, cpu_executor, output_format, None, encoding, frame_memo)
+    if output_format == 'tensor':
+        return (fits_url, [(None, gal['ra'], gal['dec'], gal['petroRad_r']) for _, _, _, gal in group],
+                frame_cache, cpu_executor, output_format, grid, encoding, frame_memo)
+    if cutout:
+        return (fits_url, [(parent_dir / rel_path, gal['ra'], gal['dec'], gal['petroRad_r'])
+                           for _, _, rel_path, gal in group], frame_cache, cpu_executor, 'files', None, encoding,
+                frame_memo)
+    return (fits_url, [parent_dir / rel_path for _, _, rel_path, _ in group], frame_cache, keep_compressed, encoding,
+            frame_memo)
+
+
+def __download_frame_wrapper(args):
+    """Wrapper for __download_frame for multiprocessing, also returns the `._metrics.Metrics` of the task"""
+
+    with _metrics.capture() as metrics:
+        with _metrics.timer('download_task'):
+            result = __download_frame(*args)
+
+    return result, metrics
+
+
+def __download_frame(fits_url, file_paths, frame_cache=None, keep_compressed=False, encoding=None, frame_memo=None):
+    """Download fits image from url once and save it to every file path
 
     Parameters
     ----------
     fits_url : `str`
         url to fits image
-    file_path : `str`
-        path to save fits image
-    ra : `float`
-        right ascension in degrees
-    dec : `float`
-        declination in degrees
-    petro_r : `float`
-        petrosian radius in arcsec
+    file_paths : `list` of `str`
+        paths to save fits image, one for each galaxy on the frame
+    frame_cache : `.cache.FrameCache`, default=None
+        Cache to read the frame from
+    keep_compressed : `bool`, default=False
+        Whether to also save the compressed frame to `<file_path>.bz2`
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`, None to save the frame as is
+    frame_memo : `._frame_memo.FrameMemo`, default=None
+        Frames saved by other tasks of the run, to copy instead of downloading them again, None to always download
+
+    Returns
+    -------
+    records : `list` of `dict`
+        File record for each file path, with keys 'size', 'sha256' and 'shape' ('Uncut')
+    cache_hit : `bool`
+        Whether the frame was found in the cache, False if it was saved by another task
+    """
+
+    def save():
+        return (*__download_fits_image(fits_url, file_paths[0], frame_cache, keep_compressed, encoding),
+                file_paths[0])
+
+    # The memo keeps the file a frame was first saved to, later tasks copy it
+    if frame_memo is None:
+        (sha256, cache_hit, source), reused = save(), False
+    else:
+        (sha256, cache_hit, source), reused = frame_memo.get(fits_url, save)
+        if reused:
+            _metrics.add('frames_reused')
+    with _metrics.timer('write'):
+        for file_path in file_paths:
+            if file_path != source:
+                shutil.copyfile(source, file_path)
+                if keep_compressed:
+                    shutil.copyfile(f"{source}.bz2", f"{file_path}.bz2")
+
+    record = {'size': pathlib.Path(source).stat().st_size, 'sha256': sha256, 'shape': 'Uncut'}
+    return [record] * len(file_paths), cache_hit and not reused
+
+
+def __download_frame_cutouts_wrapper(args):
+    """Wrapper for __download_frame_cutouts for multiprocessing, also returns the `._metrics.Metrics` of the task"""
+
+    with _metrics.capture() as metrics:
+        with _metrics.timer('download_task'):
+            result = __download_frame_cutouts(*args)
+
+    return result, metrics
+
+
+def __download_frame_cutouts(fits_url, targets, frame_cache=None, cpu_executor=None, output_format='files',
+                             grid=None, encoding=None, frame_memo=None):
+    """Download fits image from url once and cutout every galaxy on it
+
+    Parameters
+    ----------
+    fits_url : `str`
+        url to fits image
+    targets : `list` of `tuple`
+        List of (file_path, ra, dec, petro_r) for each galaxy on the frame, ra and dec in degrees,
+        petro_r in arcsec. file_path is the extension name if output_format is 'shards', unused if 'tensor'
+    frame_cache : `.cache.FrameCache`, default=None
+        Cache to read the frame from
+    cpu_executor : `concurrent.futures.Executor`, default=None
+        Executor to decompress the frame and cutout galaxies in, None to do it in the calling worker
+    output_format : `str`, default='files'
+        'files' to save the cutouts, 'shards' to return them encoded as fits extensions for a shard,
+        'tensor' to return them resampled onto grids, 'memory' to return them as arrays
+    grid : `tuple`, default=None
+        (size, scale) of the grids, as in `._cutout.resample_galaxies`, only used if output_format is 'tensor'
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`, None to store the cutouts as float32.
+        Only the dtype is used if output_format is 'tensor'
+    frame_memo : `._frame_memo.FrameMemo`, default=None
+        Frames fetched by other tasks of the run, to reuse, None to always fetch the frame
 
     Returns
     -------
-    cutout : `tuple`
-        2d cutout shape
+    records : `list` of `dict`
+        File record for each galaxy, in order of targets, as returned by `__save_frame_cutouts`
+    cache_hit : `bool`
+        Whether the frame was found in the cache, False if it was fetched by another task
     """
 
-    # Get cutout image np array
-    cutout_arr = __cutout_galaxy_fits_image(fits_url, ra, dec, petro_r)
+    content, cache_hit = __fetch_frame_content(fits_url, frame_cache, frame_memo)
+    if cpu_executor is not None:
+        records, metrics = cpu_executor.submit(__save_frame_cutouts_wrapper, content, targets, output_format,
+                                               grid, encoding).result()
+        _metrics.merge(metrics)
+    else:
+        records = __save_frame_cutouts(content, targets, output_format, grid, encoding)
+
+    return records, cache_hit
+
 
-    # Save cutout image as fits
-    hdu = fits.PrimaryHDU(cutout_arr)
-    hdu.writeto(file_path)
+def __save_frame_cutouts_wrapper(*args):
+    """Wrapper for __save_frame_cutouts for multiprocessing, also returns the `._metrics.Metrics` recorded"""
 
-    return cutout_arr.shape
+    with _metrics.capture() as metrics:
+        records = __save_frame_cutouts(*args)
+
+    return records, metrics
+
+
+def __save_frame_cutouts(content, targets, output_format='files', grid=None, encoding=None):
+    """Cutout every galaxy on a frame and save them as fits
+
+    Parameters
+    ----------
+    content : `bytes`
+        bz2 compressed fits file
+    targets : `list` of `tuple`
+        List of (file_path, ra, dec, petro_r) for each galaxy on the frame, ra and dec in degrees,
+        petro_r in arcsec. file_path is the extension name if output_format is 'shards', unused if 'tensor'
+    output_format : `str`, default='files'
+        'files' to save the cutouts, 'shards' to return them encoded as fits extensions for a shard,
+        'tensor' to return them resampled onto grids, 'memory' to return them as arrays
+    grid : `tuple`, default=None
+        (size, scale) of the grids, as in `._cutout.resample_galaxies`, only used if output_format is 'tensor'
+    encoding : `tuple`, default=None
+        (compression, quantize_level, dtype) as in `._encoding.image_hdu`, None to store the cutouts as float32.
+        Only the dtype is used if output_format is 'tensor'
+
+    Returns
+    -------
+    records : `list` of `dict`
+        File record for each galaxy, in order of targets, with keys 'size', 'sha256', 'shape' (2d cutout shape)
+        and 'clipped' (whether the cutout was clipped by the frame edges). 'size' is replaced by
+        'content' (the encoded extension) if output_format is 'shards', by 'data' (the grid) if 'tensor',
+        by 'data' (the cutout) if 'memory', which has no 'sha256'
+    """
+
+    data, wcs = __open_fits_frame(content)
+    file_paths, ra, dec, petro_r = zip(*targets)
+    records = []
+    files = []
+    with _metrics.timer('frame_cutout_cpu', cpu=True):
+        if output_format == 'tensor':
+            cutouts, clipped = _cutout.resample_galaxies(data, wcs, ra, dec, petro_r, *grid)
+        else:
+            cutouts, clipped = _cutout.cutout_galaxies(data, wcs, ra, dec, petro_r)
+
+        for file_path, cutout_arr, is_clipped in zip(file_paths, cutouts, clipped):
+            if output_format == 'tensor':
+                if encoding is not None:
+                    # Downcast here, so only the smaller grids are sent back from a cpu worker
+                    cutout_arr = cutout_arr.astype(encoding[2])
+                records.append({'data': cutout_arr, 'sha256': hashlib.sha256(cutout_arr.tobytes()).hexdigest(),
+                                'shape': cutout_arr.shape, 'clipped': bool(is_clipped)})
+            elif output_format == 'memory':
+                # Copy, so the frame is freed once all its cutouts are done
+                records.append({'data': cutout_arr.copy(), 'shape': cutout_arr.shape, 'clipped': bool(is_clipped)})
+            elif output_format == 'shards':
+                ext_content = _shards.encode_extension(cutout_arr, file_path, encoding)
+                records.append({'content': ext_content, 'sha256': hashlib.sha256(ext_content).hexdigest(),
+                                'shape': cutout_arr.shape, 'clipped': bool(is_clipped)})
+            else:
+                file_content = _encoding.encode_file(cutout_arr, encoding)
+                files.append((file_path, file_content))
+                records.append({'size': len(file_content), 'sha256': hashlib.sha256(file_content).hexdigest(),
+                                'shape': cutout_arr.shape, 'clipped': bool(is_clipped)})
+
+    # Shards and tensor are written by the caller
+    if files:
+        with _metrics.timer('write'):
+            for file_path, file_content in files:
+                pathlib.Path(file_path).write_bytes(file_content)
+
+    return records
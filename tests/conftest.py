@@ -0,0 +1,22 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+
+@pytest.fixture(scope='module')
+def stand_in():
+    """Stand-in SkyServer and SAS servers with small frames, gmag.sdss is pointed at them"""
+
+    from stand_in import StandIn
+    from gmag import sdss
+
+    urls = sdss._SKYSERVER_URL, sdss._SAS_URL
+    with StandIn(num_fields=3, galaxies_per_field=20, frame_shape=(400, 600)) as server:
+        sdss._SKYSERVER_URL, sdss._SAS_URL = server.skyserver_url, server.sas_url
+        try:
+            yield server
+        finally:
+            sdss._SKYSERVER_URL, sdss._SAS_URL = urls
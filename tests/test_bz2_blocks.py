@@ -0,0 +1,32 @@
+import bz2
+
+import numpy as np
+import pytest
+
+from gmag import _bz2_blocks
+
+
+@pytest.fixture
+def parallel(monkeypatch):
+    monkeypatch.setattr(_bz2_blocks, 'WORKERS', 2)
+    monkeypatch.setattr(_bz2_blocks, '_pool', None)
+
+
+@pytest.fixture(scope='module')
+def data():
+    # A few 900 kB blocks, compressible like a frame
+    return np.random.default_rng(0).integers(0, 16, 3_000_000, dtype=np.uint8).tobytes()
+
+
+def test_blocks_decompress_to_data(parallel, data):
+    content = bz2.compress(data) + bz2.compress(data[:1000])
+    assert len(_bz2_blocks.split_blocks(content)) == 5
+    assert _bz2_blocks.decompress(content) == data + data[:1000]
+
+
+def test_bad_split_falls_back_to_serial(parallel, data, monkeypatch):
+    content = bz2.compress(data)
+    streams = _bz2_blocks.split_blocks(content)
+    # As if a magic number was found by chance in the last block
+    monkeypatch.setattr(_bz2_blocks, 'split_blocks', lambda _: streams[:-1] + [streams[-1][:-20], streams[-1]])
+    assert _bz2_blocks.decompress(content) == data
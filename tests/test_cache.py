@@ -0,0 +1,30 @@
+import io
+
+from gmag import cache
+
+
+def test_put_only_scans_when_over_budget(tmp_path, monkeypatch):
+    frame_cache = cache.FrameCache(tmp_path, max_bytes=250)
+    scans = []
+    evict = frame_cache.evict
+    monkeypatch.setattr(frame_cache, 'evict', lambda: scans.append(1) or evict())
+
+    for k in range(2):
+        frame_cache.put(f"http://sas/frame-{k}.fits.bz2", io.BytesIO(b'x' * 100))
+    assert not scans
+    frame_cache.put("http://sas/frame-0.fits.bz2", io.BytesIO(b'x' * 100))  # replaced, same size
+    assert not scans
+
+    frame_cache.put("http://sas/frame-2.fits.bz2", io.BytesIO(b'x' * 100))
+    assert len(scans) == 1
+    assert frame_cache.size <= 250
+    assert frame_cache.get("http://sas/frame-2.fits.bz2") is not None
+
+
+def test_size_counted_at_open(tmp_path):
+    frame_cache = cache.FrameCache(tmp_path, max_bytes=150)
+    frame_cache.put("http://sas/frame-0.fits.bz2", io.BytesIO(b'x' * 100))
+
+    reopened = cache.FrameCache(tmp_path, max_bytes=150)
+    reopened.put("http://sas/frame-1.fits.bz2", io.BytesIO(b'x' * 100))
+    assert reopened.size == 100
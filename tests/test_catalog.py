@@ -0,0 +1,72 @@
+import csv
+
+import numpy as np
+import pytest
+
+from gmag import sdss
+
+pytest.importorskip('scipy')
+
+from gmag import _catalog  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def table(stand_in):
+    from astropy.table import Table
+
+    num = len(stand_in.catalog['objid'])
+    return Table({'objID': stand_in.catalog['objid'], 'run': np.full(num, 756), 'camcol': np.full(num, 1),
+                  'field': stand_in.catalog['field'], 'ra': stand_in.catalog['ra'], 'dec': stand_in.catalog['dec'],
+                  'petroRad_r': stand_in.catalog['petroRad_r'], 'petroRadErr_r': np.full(num, 0.1)})
+
+
+def test_local_search_matches_skyserver(stand_in, table):
+    ra, dec = stand_in.make_catalog(40, found_fraction=0.7)
+
+    local = _catalog.LocalCatalog(table).search(ra, dec, 1)
+    remote = sdss.search_galaxies(ra, dec, max_search_radius=1, num_workers=2)
+
+    assert [gal and gal['objid'] for gal in local] == [gal and gal['objid'] for gal in remote]
+    assert 0 < sum(gal is not None for gal in local) < 40
+
+
+def test_local_search_misses_positions_not_finite(table):
+    galaxies = _catalog.LocalCatalog(table).search([table['ra'][0], np.nan, np.inf],
+                                                   [table['dec'][0], 0., 0.], 1)
+
+    assert galaxies[0]['objid'] == table['objID'][0]
+    assert galaxies[1:] == [None, None]
+
+
+def test_missing_column_raises(table):
+    with pytest.raises(KeyError, match='petroRadErr_r'):
+        _catalog.LocalCatalog(table[[name for name in table.colnames if name != 'petroRadErr_r']])
+
+
+def test_download_with_catalog_does_not_search_skyserver(stand_in, table, tmp_path, monkeypatch):
+    ra, dec = stand_in.make_catalog(12, found_fraction=0.75)
+    path = tmp_path / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(ra, dec))
+    table_path = tmp_path / 'galaxies.ecsv'
+    table.write(table_path)
+
+    def sql_search(cmd):
+        raise AssertionError(f"SkyServer searched: {cmd}")
+
+    monkeypatch.setattr(sdss, '__sql_search', sql_search)
+    sdss.download_images(path, bands='r', max_search_radius=1, catalog=table_path, output_dir=tmp_path / 'images',
+                         num_workers=2, progress_bar=False, verbose=False)
+
+    with open(tmp_path / 'images' / 'info.csv', newline='') as f:
+        lines = [line for line in f if not line.startswith('#')]
+    rows = list(csv.DictReader(lines[1:]))
+    expected = _catalog.LocalCatalog(table).search(ra, dec, 1)
+    assert [row['found'] == 'True' for row in rows] == [gal is not None for gal in expected]
+    assert not any(row['error'] for row in rows)
+    for row, gal in zip(rows, expected):
+        if gal is not None:
+            assert row['objid'] == str(gal['objid'])
+            assert (tmp_path / 'images' / row['dir_name'] / 'r.fits').exists()
@@ -0,0 +1,96 @@
+import csv
+import sqlite3
+
+import pytest
+
+from gmag import _executor
+from gmag import sdss
+from gmag.cache import SearchCache
+from gmag.downloader import Downloader
+
+
+@pytest.fixture
+def catalog(stand_in, tmp_path):
+    path = tmp_path / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(*stand_in.make_catalog(10, found_fraction=1.)))
+    return path
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    """Keys of the executors created"""
+
+    executors = []
+    make_executor = _executor.make_executor
+    monkeypatch.setattr(_executor, 'make_executor', lambda engine, num_workers: executors.append(
+        (engine, num_workers)) or make_executor(engine, num_workers))
+    return executors
+
+
+def test_calls_share_the_pools(stand_in, executors):
+    ra, dec = stand_in.make_catalog(10, found_fraction=1.)
+    with Downloader(num_workers=3) as downloader:
+        first = downloader.search(ra, dec)
+        second = downloader.search(ra, dec)
+        galaxies = dict(downloader.iter_galaxies(ra[:4], dec[:4], bands='r'))
+        list(downloader.iter_galaxies(ra[4:], dec[4:], bands='r'))
+    # One search and one download pool, each created once
+    assert executors == [('thread', 3), ('thread', 3)]
+
+    assert first == second == sdss.search_galaxies(ra, dec, num_workers=3)
+    assert [galaxies[i].objid for i in range(4)] == [str(gal['objid']) for gal in first[:4]]
+
+
+def test_keyword_arguments_override_settings(stand_in, executors):
+    ra, dec = stand_in.make_catalog(4)
+    with Downloader(num_workers=3) as downloader:
+        downloader.search(ra, dec, num_workers=2)
+
+    assert executors == [('thread', 2)]
+
+
+def test_downloads_reuse_the_frame_cache(catalog, tmp_path):
+    reports = []
+    with Downloader(num_workers=4, frame_cache=tmp_path / 'frames') as downloader:
+        for k in range(2):
+            downloader.download(catalog, bands='r', output_dir=tmp_path / f'images{k}', progress_bar=False,
+                                verbose=False, report_callback=reports.append)
+
+    assert reports[0]['frames'] > 0 and reports[0]['frame_cache_hits'] == 0
+    assert reports[1]['frame_cache_hits'] == reports[1]['frames'] == reports[0]['frames']
+
+
+def test_closed_downloader_raises(stand_in):
+    downloader = Downloader(num_workers=2)
+    with downloader:
+        assert not downloader.closed
+    assert downloader.closed
+    assert 'closed' in repr(downloader)
+
+    with pytest.raises(RuntimeError, match='closed'):
+        downloader.search([150.], [0.])
+    with pytest.raises(RuntimeError, match='closed'):
+        downloader.random_galaxies(2, verbose=False, progress_bar=False)
+
+
+def test_search_cache_opened_from_path_is_closed(stand_in, tmp_path):
+    ra, dec = stand_in.make_catalog(4)
+    with Downloader(num_workers=2, search_cache=tmp_path / 'searches.sqlite') as downloader:
+        downloader.search(ra, dec)
+        search_cache = downloader.search_cache
+    with pytest.raises(sqlite3.ProgrammingError):
+        search_cache.get_many([(0, ra[0], dec[0])], 8)
+
+    # A cache given as an object belongs to the caller and stays open
+    with SearchCache(tmp_path / 'searches.sqlite') as search_cache:
+        with Downloader(num_workers=2, search_cache=search_cache) as downloader:
+            galaxies = downloader.search(ra, dec)
+        assert search_cache.get_many([(i, ra[i], dec[i]) for i in range(4)], 8) == dict(enumerate(galaxies))
+
+
+def test_invalid_engine_raises():
+    with pytest.raises(ValueError, match='engine'):
+        Downloader(engine='gpu')
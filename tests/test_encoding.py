@@ -0,0 +1,39 @@
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from gmag import _encoding
+from gmag import sdss
+
+
+@pytest.mark.parametrize('encoding, tolerance', [
+    (None, 0),
+    ((None, None, 'int16'), 1e-4),
+    (('rice', 16, 'float32'), 0.1),
+    (('gzip', 0, 'float32'), 0),
+    (('rice', None, 'int16'), 1e-4),
+])
+def test_encoded_file_reads_back(encoding, tolerance):
+    frame = np.random.default_rng(0).normal(size=(200, 200)).astype(np.float32)
+    original = frame.copy()
+    cutout = frame[10:110, 20:120]
+
+    data = fits.getdata(io.BytesIO(_encoding.encode_file(cutout, encoding)))
+
+    np.testing.assert_allclose(data, cutout, rtol=0, atol=tolerance)
+    # Other cutouts are taken from the same frame
+    np.testing.assert_array_equal(frame, original)
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(dtype='int16', cutout=False),
+    dict(dtype='float16'),
+    dict(dtype='int16', output_format='tensor'),
+    dict(compression='rice', output_format='tensor'),
+    dict(compression='rice', quantize_level=0),
+])
+def test_invalid_encoding_raises(tmp_path, kwargs):
+    with pytest.raises(ValueError):
+        sdss.download_images(tmp_path / 'catalog.csv', output_dir=tmp_path, **kwargs)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from gmag.galaxy import Galaxy
+
+
+def test_data_of_some_bands():
+    g, r = np.zeros((4, 5)), np.ones((4, 5))
+    galaxy = Galaxy(objid='1', g=g, r=r)
+
+    assert galaxy.data.shape == (2, 4, 5)
+    np.testing.assert_array_equal(galaxy.data[1], r)
+    assert galaxy.u is None
+    assert np.shares_memory(galaxy.r, galaxy.data)
+
+
+def test_data_of_bands_of_different_shapes_raises():
+    galaxy = Galaxy(objid='1', g=np.zeros((4, 5)), r=np.zeros((4, 6)))
+    with pytest.raises(ValueError):
+        galaxy.data
+
+
+def test_cube_is_read_only_view():
+    cube = np.zeros((5, 4, 5))
+    galaxy = Galaxy.lazy('1', lambda: cube)
+
+    assert not galaxy.data.flags.writeable
+    assert np.shares_memory(galaxy.data, cube)
+    assert cube.flags.writeable
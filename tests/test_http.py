@@ -0,0 +1,96 @@
+import bz2
+import csv
+import threading
+
+import pytest
+
+from gmag import _http
+from gmag import sdss
+
+
+@pytest.fixture
+def catalog(stand_in, tmp_path):
+    path = tmp_path / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(*stand_in.make_catalog(8, found_fraction=1.)))
+    return path
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(_http, 'BACKOFF_BASE', 0.001)
+
+
+def read_info(output_dir):
+    with open(output_dir / 'info.csv', newline='') as f:
+        lines = [line for line in f if not line.startswith('#')]
+    return list(csv.DictReader(lines[1:]))
+
+
+def download(catalog, output_dir, **kwargs):
+    """Run download_images in a thread, a run blocked on the host limiter fails the test instead of hanging"""
+
+    errors = []
+
+    def run():
+        try:
+            sdss.download_images(catalog, bands='gr', output_dir=output_dir, num_workers=4, progress_bar=False,
+                                 verbose=False, **kwargs)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(120)
+    assert not thread.is_alive(), "download_images is blocked"
+    if errors:
+        raise errors[0]
+    return read_info(output_dir)
+
+
+def frames(stand_in, band):
+    """Compressed frames of a band served by the stand-in"""
+
+    return {stand_in.frame(field, band) for field in range(100, 100 + len(stand_in.centers))}
+
+
+# Frames are read whole for cutouts, streamed for uncut frames and into the frame cache
+KWARGS = [{}, {'cutout': False}, {'frame_cache': 'frames'}]
+
+
+@pytest.mark.parametrize('kwargs', KWARGS)
+def test_truncated_frames_fail_their_rows_and_release_the_limiter(stand_in, catalog, tmp_path, monkeypatch,
+                                                                 fast_retries, kwargs):
+    monkeypatch.setattr(stand_in, 'truncate_rate', 1.)
+    if 'frame_cache' in kwargs:
+        kwargs = {'frame_cache': tmp_path / kwargs['frame_cache']}
+    # More frames fail than the host limiter has slots
+    for k in range(3):
+        rows = download(catalog, tmp_path / f'images{k}', **kwargs)
+        assert rows and all(row['error'] for row in rows)
+
+    assert _http.get_limiter(stand_in.sas_url).in_flight == 0
+
+
+@pytest.mark.parametrize('kwargs', KWARGS)
+def test_truncated_frames_are_retried(stand_in, catalog, tmp_path, monkeypatch, fast_retries, kwargs):
+    monkeypatch.setattr(stand_in, 'truncate_rate', 0.3)
+    monkeypatch.setattr(_http, 'MAX_RETRIES', 10)
+    if 'frame_cache' in kwargs:
+        kwargs = {'frame_cache': tmp_path / kwargs['frame_cache']}
+    rows = download(catalog, tmp_path / 'images', **kwargs)
+
+    assert rows and not any(row['error'] for row in rows)
+    assert all(row['found'] == 'True' for row in rows)
+    if 'cutout' in kwargs:
+        # Frames read on from where they broke are whole
+        for band in 'gr':
+            expected = {bz2.decompress(frame) for frame in frames(stand_in, band)}
+            for row in rows:
+                assert (tmp_path / 'images' / row['dir_name'] / f'{band}.fits').read_bytes() in expected
+    if 'frame_cache' in kwargs:
+        expected = frames(stand_in, 'g') | frames(stand_in, 'r')
+        cached = list(kwargs['frame_cache'].glob('*.bz2'))
+        assert cached and all(path.read_bytes() in expected for path in cached)
@@ -0,0 +1,49 @@
+"""Importing gmag must stay fast and must not import its heavy dependencies
+
+Each module is imported in fresh interpreters, the fastest import is compared to the budget.
+"""
+
+import json
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+BUDGET = 0.5
+"""Maximum import time in seconds"""
+
+DEFERRED = {
+    'gmag': ('scipy', 'astropy', 'astropy.coordinates', 'requests', 'matplotlib', 'PIL', 'tqdm'),
+    'gmag.sdss': ('scipy', 'astropy', 'astropy.coordinates', 'matplotlib', 'PIL', 'tqdm'),
+    'gmag.galaxy': ('scipy', 'astropy', 'astropy.coordinates', 'requests', 'matplotlib', 'PIL', 'tqdm'),
+    'gmag.cache': ('scipy', 'astropy', 'astropy.coordinates', 'matplotlib', 'PIL', 'tqdm'),
+}
+"""Dependencies each module defers until the code path that needs them runs"""
+
+_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def _import(module):
+    root = str(pathlib.Path(__file__).resolve().parent.parent)
+    result = subprocess.run([sys.executable, '-c', _SCRIPT.format(root=root, module=module)], check=True,
+                            capture_output=True, text=True)
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize('module', sorted(DEFERRED))
+def test_import_defers_heavy_dependencies(module):
+    imported = set(_import(module)['modules'])
+    assert not imported & set(DEFERRED[module])
+
+
+@pytest.mark.parametrize('module', sorted(DEFERRED))
+def test_import_time_within_budget(module):
+    seconds = min(_import(module)['seconds'] for _ in range(3))
+    assert seconds < BUDGET
@@ -0,0 +1,21 @@
+from gmag import sdss
+
+
+def test_buffer_size_bounds_positions_taken(stand_in):
+    ra, dec = stand_in.make_catalog(12)
+    taken = []
+
+    def take(values):
+        for value in values:
+            taken.append(value)
+            yield value
+
+    yielded = 0
+    for row, galaxy in sdss.iter_galaxies(take(ra), dec, bands='gr', buffer_size=3, search_batch_size=50,
+                                          grid_size=16, num_workers=2):
+        assert len(taken) - yielded <= 3
+        yielded += 1
+        if galaxy is not None:
+            assert galaxy.data.shape == (2, 16, 16)
+
+    assert yielded == len(ra)
@@ -0,0 +1,55 @@
+import csv
+import hashlib
+
+import pytest
+
+from gmag import _manifest
+from gmag import sdss
+
+PARAMS = {'file': 'catalog.csv', 'num_rows': 10, 'bands': ['g', 'r'], 'ra_col': 'ra', 'dec_col': 'dec',
+          'name_col': None, 'max_search_radius': 8, 'cutout': True, 'output_format': 'files'}
+
+
+@pytest.mark.parametrize('change', [{'bands': ['u', 'g', 'r']}, {'ra_col': 'ra_2'}, {'dec_col': 'dec_2'},
+                                    {'name_col': 'name'}, {'cutout': False}])
+def test_resume_with_other_params_raises(tmp_path, change):
+    with _manifest.Manifest(tmp_path / _manifest.FILE_NAME) as manifest:
+        manifest.check_params(PARAMS)
+
+    with _manifest.Manifest(tmp_path / _manifest.FILE_NAME) as manifest:
+        manifest.check_params(PARAMS)
+        with pytest.raises(ValueError):
+            manifest.check_params({**PARAMS, **change})
+
+
+@pytest.mark.parametrize('offset', [None, 3])
+def test_file_changed_after_recorded_is_not_done(tmp_path, offset):
+    content = b'0123456789'
+    (tmp_path / 'g.fits').write_bytes(content)
+    record = {'path': 'g.fits', 'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()}
+    if offset is not None:
+        record = {**record, 'offset': offset, 'size': 4, 'sha256': hashlib.sha256(content[3:7]).hexdigest()}
+
+    with _manifest.Manifest(tmp_path / _manifest.FILE_NAME) as manifest:
+        manifest.add_file(0, 'g', record)
+        assert manifest.is_done(0, 'g', 'g.fits')
+
+        (tmp_path / 'g.fits').write_bytes(b'0123x56789')
+        assert not manifest.is_done(0, 'g', 'g.fits')
+
+
+def test_resume_redoes_changed_files(stand_in, tmp_path):
+    catalog = tmp_path / 'catalog.csv'
+    with open(catalog, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(*stand_in.make_catalog(4, found_fraction=1.)))
+    kwargs = dict(bands='g', output_dir=tmp_path / 'images', num_workers=2, progress_bar=False, verbose=False)
+    sdss.download_images(catalog, **kwargs)
+
+    path = next((tmp_path / 'images').glob('*/g.fits'))
+    content = path.read_bytes()
+    path.write_bytes(content[:-1] + bytes([content[-1] ^ 1]))
+
+    sdss.download_images(catalog, **kwargs)
+    assert path.read_bytes() == content
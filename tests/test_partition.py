@@ -0,0 +1,69 @@
+import csv
+
+import numpy as np
+import pytest
+
+from gmag import _manifest
+from gmag import sdss
+from gmag.galaxy import load_galaxies
+
+
+@pytest.fixture(scope='module')
+def catalog(stand_in, tmp_path_factory):
+    path = tmp_path_factory.mktemp('catalog') / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(*stand_in.make_catalog(16)))
+    return path
+
+
+@pytest.mark.parametrize('output_format', ['files', 'shards', 'tensor'])
+@pytest.mark.parametrize('partition_by', ['rows', 'sky'])
+def test_partitions_match_full_run(catalog, tmp_path, output_format, partition_by):
+    kwargs = dict(bands='gr', num_workers=4, output_format=output_format, progress_bar=False, verbose=False)
+    sdss.download_images(catalog, output_dir=tmp_path / 'full', **kwargs)
+    full = load_galaxies(tmp_path / 'full')
+
+    loaded = {}
+    for index in range(3):
+        part_dir = tmp_path / f'part{index}'
+        sdss.download_images(catalog, output_dir=part_dir, partition=(index, 3), partition_by=partition_by,
+                             **kwargs)
+        part = load_galaxies(part_dir)
+        assert not loaded.keys() & part.keys()
+        loaded.update(part)
+
+    assert sorted(loaded) == sorted(full)
+    for row, galaxy in loaded.items():
+        assert galaxy.objid == full[row].objid
+        np.testing.assert_array_equal(galaxy.g, full[row].g)
+        np.testing.assert_array_equal(galaxy.r, full[row].r)
+
+    sdss.merge_partitions([tmp_path / f'part{index}' for index in range(3)], tmp_path / 'merged', verbose=False)
+    merged = load_galaxies(tmp_path / 'merged')
+    assert sorted(merged) == sorted(full)
+    for row, galaxy in merged.items():
+        assert galaxy.objid == full[row].objid
+        np.testing.assert_array_equal(galaxy.data, full[row].data)
+
+
+@pytest.mark.parametrize('partition_by', ['rows', 'sky'])
+def test_partition_tensors_only_hold_their_rows(catalog, tmp_path, partition_by):
+    kwargs = dict(bands='gr', num_workers=4, output_format='tensor', grid_size=8, progress_bar=False, verbose=False)
+    sdss.download_images(catalog, output_dir=tmp_path / 'full', **kwargs)
+
+    sizes = []
+    for index in range(3):
+        sdss.download_images(catalog, output_dir=tmp_path / f'part{index}', partition=(index, 3),
+                             partition_by=partition_by, **kwargs)
+        sizes.append(len(np.load(tmp_path / f'part{index}' / 'cutouts.npy', mmap_mode='r')))
+    assert sum(sizes) == 16
+
+    sdss.merge_partitions([tmp_path / f'part{index}' for index in range(3)], tmp_path / 'merged', verbose=False)
+    np.testing.assert_array_equal(np.load(tmp_path / 'merged' / 'cutouts.npy'),
+                                  np.load(tmp_path / 'full' / 'cutouts.npy'))
+    # Grids recorded in the merged manifest are where the full run has them
+    full, merged = (_manifest.Manifest(tmp_path / name / _manifest.FILE_NAME) for name in ('full', 'merged'))
+    with full, merged:
+        assert merged.files == full.files
@@ -0,0 +1,44 @@
+import csv
+
+import pytest
+
+from gmag import sdss
+
+
+@pytest.fixture(scope='module')
+def catalog(stand_in, tmp_path_factory):
+    path = tmp_path_factory.mktemp('catalog') / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(*stand_in.make_catalog(60, found_fraction=1.)))
+    return path
+
+
+@pytest.mark.parametrize('cutout', [True, False])
+def test_pipeline_fetches_each_frame_once(stand_in, catalog, tmp_path, cutout):
+    reports = {}
+    for pipeline in (True, False):
+        # Small search batches, so galaxies on each frame are found by many searches
+        sdss.download_images(catalog, bands='r', cutout=cutout, output_dir=tmp_path / str(pipeline),
+                             pipeline=pipeline, search_batch_size=5, num_workers=4, progress_bar=False,
+                             verbose=False, report_callback=lambda report: reports.setdefault(pipeline, report))
+
+    num_fields = len(stand_in.centers)
+    for report in reports.values():
+        assert report['frames'] == num_fields
+        assert report['counters']['bytes_downloaded'] == sum(len(stand_in.frame(100 + k, 'r'))
+                                                             for k in range(num_fields))
+
+
+def test_iter_galaxies_fetches_each_frame_once(stand_in, monkeypatch):
+    requested = []
+    get_content = sdss._http.get_content
+    monkeypatch.setattr(sdss._http, 'get_content', lambda url, **kwargs: requested.append(url) or
+                        get_content(url, **kwargs))
+
+    ra, dec = stand_in.make_catalog(60, found_fraction=1.)
+    galaxies = list(sdss.iter_galaxies(ra, dec, bands='r', search_batch_size=5, num_workers=4))
+
+    assert len(galaxies) == 60
+    assert len(requested) == len(set(requested)) == len(stand_in.centers)
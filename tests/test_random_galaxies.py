@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import requests
+
+from gmag import sdss
+
+
+@pytest.fixture
+def requested(monkeypatch):
+    """Urls fetched whole, and rows drawn by SQL searches"""
+
+    requested = {'urls': [], 'rows': []}
+    get_content = sdss._http.get_content
+    sql_search = getattr(sdss, '__sql_search')
+    monkeypatch.setattr(sdss._http, 'get_content', lambda url, **kwargs: requested['urls'].append(url) or
+                        get_content(url, **kwargs))
+    monkeypatch.setattr(sdss, '__sql_search', lambda cmd: requested['rows'].extend(sql_search(cmd)) or
+                        requested['rows'])
+    return requested
+
+
+def field_of(stand_in, objid):
+    return int(stand_in.catalog['field'][np.searchsorted(stand_in.catalog['objid'], int(objid))])
+
+
+def test_random_galaxies_fetch_each_frame_once(stand_in, requested):
+    galaxies = sdss.get_random_galaxies(12, verbose=False, progress_bar=False, num_workers=4)
+
+    assert len(galaxies) == 12
+    assert len({gal.objid for gal in galaxies}) == 12
+    assert all(int(gal.objid) in stand_in.catalog['objid'] for gal in galaxies)
+    for gal in galaxies:
+        assert gal.jpg_data.ndim == 3
+        assert len({gal.u.shape, gal.g.shape, gal.r.shape, gal.i.shape, gal.z.shape}) == 1
+
+    frame_urls = [url for url in requested['urls'] if url.endswith('.fits.bz2')]
+    fields = {field_of(stand_in, gal.objid) for gal in galaxies}
+    assert len(frame_urls) == len(set(frame_urls)) == 5 * len(fields)
+
+
+def test_random_galaxies_match_their_downloads(stand_in):
+    galaxies = sdss.get_random_galaxies(4, verbose=False, progress_bar=False, num_workers=4)
+
+    downloads = sdss.iter_galaxies([gal.ra for gal in galaxies], [gal.dec for gal in galaxies], ordered=True,
+                                   num_workers=4)
+    for gal, (_, expected) in zip(galaxies, downloads):
+        assert expected.objid == gal.objid
+        for band in 'ugriz':
+            np.testing.assert_array_equal(getattr(gal, band), getattr(expected, band))
+
+
+def test_failed_frame_only_leaves_out_its_galaxies(stand_in, requested, monkeypatch):
+    get_content = sdss._http.get_content
+
+    def fail_first_field(url, **kwargs):
+        if url.endswith(f'-{100:04d}.fits.bz2') and '/frame-g-' in url:
+            raise requests.ConnectionError("Connection refused")
+        return get_content(url, **kwargs)
+
+    monkeypatch.setattr(sdss._http, 'get_content', fail_first_field)
+    galaxies = sdss.get_random_galaxies(30, verbose=False, progress_bar=False, num_workers=4)
+
+    drawn = {str(row['objid']): row['field'] for row in requested['rows']}
+    assert 100 in drawn.values()
+    assert sorted(gal.objid for gal in galaxies) == sorted(objid for objid, field in drawn.items() if field != 100)
@@ -0,0 +1,13 @@
+from astropy.table import Table
+
+from gmag import _reader
+
+
+def test_csv_blank_lines_are_not_rows(tmp_path):
+    path = tmp_path / 'catalog.csv'
+    path.write_text("ra,dec\n150.1,2.2\n\n150.2,2.3\n\n")
+
+    reader = _reader.CatalogReader(path, 'ra', 'dec', chunk_size=1)
+    assert len(reader) == len(Table.read(path, format='ascii.csv')) == 2
+    chunks = [(start, list(ra), list(dec)) for start, ra, dec, _ in reader.chunks()]
+    assert chunks == [(0, [150.1], [2.2]), (1, [150.2], [2.3])]
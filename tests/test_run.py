@@ -0,0 +1,148 @@
+import csv
+import io
+
+import numpy as np
+import pytest
+
+from gmag import _manifest
+from gmag import _reader
+from gmag import _run
+
+GALAXY = {'objid': 7, 'run': 756, 'camcol': 1, 'field': 100, 'ra': 150., 'dec': 0., 'petroRad_r': 5.}
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    with _manifest.Manifest(tmp_path / _manifest.FILE_NAME) as manifest:
+        yield manifest
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    path = tmp_path / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec', 'name'])
+        writer.writerows([[150. + k, 0., ['a', '', 'a'][k % 3]] for k in range(10)])
+    return path
+
+
+def make_rows(manifest, bands='gr'):
+    info = io.StringIO()
+    return _run.Rows(manifest, list(bands), True, csv.writer(info)), info
+
+
+def written_rows(info):
+    return [int(line.split(',')[0]) for line in info.getvalue().splitlines()]
+
+
+def test_rows_are_written_in_order(manifest):
+    rows, info = make_rows(manifest)
+    for i in range(4):
+        rows.read(i, 150., 0.)
+
+    rows.complete(2)
+    rows.skip(1)
+    assert written_rows(info) == []
+    rows.fail(0, 'search: ConnectionError')
+    rows.fail(0, 'search: Timeout')
+    rows.complete(0)
+    assert written_rows(info) == [0, 2]
+    rows.complete(3)
+
+    assert written_rows(info) == [0, 2, 3]
+    assert info.getvalue().splitlines()[0].endswith(',search: ConnectionError')
+    assert rows.counts['rows'] == 3 and rows.counts['failed'] == 1
+    assert rows.next_row == 4
+
+
+def test_row_is_completed_with_its_last_image(manifest):
+    rows, info = make_rows(manifest)
+    rows.read(0, 150., 0.)
+    manifest.add_search(0, GALAXY)
+    rows.expect(0)
+    rows.expect(0)
+
+    rows.image_done(0)
+    assert rows.is_expecting(0) and written_rows(info) == []
+    rows.image_done(0)
+
+    assert not rows.is_expecting(0) and written_rows(info) == [0]
+    assert rows.counts['found'] == 1
+    # Records of a written row are dropped from memory
+    assert 0 not in manifest.searches
+
+
+def test_repeated_names_are_replaced(manifest, capsys):
+    rows, _ = make_rows(manifest)
+    for i, name in enumerate(['a', None, 'b', 'a']):
+        rows.read(i, 150., 0., name)
+
+    assert [rows.name_of(i, GALAXY) for i in range(4)] == ['a', '1_7', 'b', '3_7']
+    assert rows.counts['duplicate_names'] == 1
+    assert 'not unique' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('partition_by', ['rows', 'sky'])
+def test_search_items_skip_other_partitions(manifest, catalog, partition_by):
+    reader = _reader.CatalogReader(catalog, 'ra', 'dec', chunk_size=3)
+    row_ids = []
+    for index in range(3):
+        rows, info = make_rows(manifest)
+        items = list(_run.search_items(reader, rows, 8, 2, (index, 3), partition_by))
+        row_ids += [i for item in items for i in item[0]]
+        assert all(item[1] for item in items) and all(len(item[0]) <= 2 for item in items)
+        assert written_rows(info) == []
+
+    assert sorted(row_ids) == list(range(10))
+
+
+def test_search_items_pass_resumed_rows_as_known(manifest, catalog):
+    manifest.add_search(1, GALAXY)
+    manifest.add_search(4, None)
+    rows, _ = make_rows(manifest)
+    items = list(_run.search_items(_reader.CatalogReader(catalog, 'ra', 'dec', 'name'), rows, 8, 50))
+
+    assert [(item[0], item[1]) for item in items] == [([1, 4], None), ([0, 2, 3, 5, 6, 7, 8, 9], True)]
+    assert items[0][2] == [GALAXY, None]
+    assert items[1][2][0] == (0, 150., 0.)
+    # Empty names are replaced with rowid_unknown, repeated names with rowid_objid
+    assert [rows.name_of(i, GALAXY) for i in range(4)] == ['a', '1_unknown', '2_7', '3_7']
+
+
+def test_plan_downloads_skips_images_done(manifest, tmp_path):
+    rows, info = make_rows(manifest)
+    store = _run.ImageStore(tmp_path, ['g', 'r'], 'files')
+    for i in range(3):
+        rows.read(i, 150., 0.)
+    manifest.add_search(0, GALAXY)
+    manifest.add_search(1, None)
+    manifest.add_search(2, {**GALAXY, 'objid': 8, 'field': 101})
+    (tmp_path / '0_7').mkdir()
+    (tmp_path / '0_7' / 'g.fits').write_bytes(b'g')
+    manifest.add_file(0, 'g', {'path': '0_7/g.fits', 'size': 1, 'shape': [1, 1]})
+
+    frame_groups = _run.plan_downloads(range(3), rows, store)
+
+    assert {key: [(i, band, rel_path) for i, band, rel_path, _ in group] for key, group in frame_groups.items()} == {
+        (756, 1, 100, 'r'): [(0, 'r', '0_7/r.fits')],
+        (756, 1, 101, 'g'): [(2, 'g', '2_8/g.fits')], (756, 1, 101, 'r'): [(2, 'r', '2_8/r.fits')]}
+    assert (tmp_path / '2_8').is_dir()
+    # The row not found is written, the others wait for their images
+    assert written_rows(info) == []
+    rows.image_done(0)
+    assert written_rows(info) == [0, 1]
+
+
+def test_tensor_of_a_partition_stores_its_rows_in_order(tmp_path):
+    from gmag import _metrics
+
+    tensor = _run.open_tensor(tmp_path / 'cutouts.npy', (2, 2, 4, 4), 'float32')
+    store = _run.ImageStore(tmp_path, ['g', 'r'], 'tensor', tensor=tensor, tensor_rows=np.array([3, 8]))
+    record = store.store(8, 'r', 'cutouts.npy', {'data': np.ones((4, 4)), 'shape': [4, 4]}, _metrics.Metrics())
+    tensor.flush()
+
+    assert tensor[1, 1].sum() == 16 and tensor.sum() == 16
+    assert record == {'path': 'cutouts.npy', 'offset': tensor.offset + 3 * 64, 'size': 64, 'shape': [4, 4]}
+    with pytest.raises(ValueError, match='shape'):
+        _run.open_tensor(tmp_path / 'cutouts.npy', (3, 2, 4, 4), 'float32')
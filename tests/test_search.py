@@ -0,0 +1,25 @@
+import math
+
+import pytest
+
+from gmag import sdss
+
+
+def test_batches_fit_in_query_string(stand_in):
+    # The stand-in answers 404 to query strings over 2048 bytes, as SkyServer does
+    ra, dec = stand_in.make_catalog(100, found_fraction=0.5)
+    batched = sdss.search_galaxies(ra, dec, search_batch_size=100, num_workers=2)
+    one_by_one = sdss.search_galaxies(ra, dec, search_batch_size=1, num_workers=2)
+
+    assert batched == one_by_one
+    assert sum(gal is not None for gal in batched) >= 40
+
+
+@pytest.mark.parametrize('search_batch_size', [1, 50])
+def test_positions_not_finite_are_not_found(stand_in, search_batch_size):
+    ra, dec = stand_in.make_catalog(6, found_fraction=1.)
+    ra[1], dec[3], ra[4] = math.nan, math.inf, -math.inf
+
+    galaxies = sdss.search_galaxies(ra, dec, search_batch_size=search_batch_size, num_workers=2)
+
+    assert [gal is None for gal in galaxies] == [False, True, False, True, True, False]
@@ -0,0 +1,76 @@
+import csv
+import json
+
+import pytest
+
+from gmag import sdss
+from gmag.cache import SearchCache
+
+
+@pytest.fixture
+def closes(monkeypatch):
+    """Number of search caches opened and closed"""
+
+    counts = {'open': 0, 'close': 0}
+    init, close = SearchCache.__init__, SearchCache.close
+
+    def counting_init(self, *args, **kwargs):
+        counts['open'] += 1
+        init(self, *args, **kwargs)
+
+    def counting_close(self):
+        counts['close'] += 1
+        close(self)
+
+    monkeypatch.setattr(SearchCache, '__init__', counting_init)
+    monkeypatch.setattr(SearchCache, 'close', counting_close)
+    return counts
+
+
+def test_search_cache_opened_from_path_is_closed(stand_in, tmp_path, closes):
+    ra, dec = stand_in.make_catalog(4)
+    path = tmp_path / 'searches.sqlite'
+
+    sdss.search_galaxies(ra, dec, search_cache=path, num_workers=2)
+    list(sdss.iter_galaxies(ra, dec, bands='r', grid_size=8, search_cache=path, num_workers=2))
+    # Stopped early
+    galaxies = sdss.iter_galaxies(ra, dec, bands='r', grid_size=8, search_cache=path, num_workers=2)
+    next(galaxies)
+    galaxies.close()
+
+    catalog = tmp_path / 'catalog.csv'
+    with open(catalog, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(ra, dec))
+    sdss.download_images(catalog, bands='r', output_dir=tmp_path / 'images', search_cache=path, num_workers=2,
+                         progress_bar=False, verbose=False)
+
+    assert closes == {'open': 4, 'close': 4}
+
+
+def test_search_cache_given_is_left_open(stand_in, tmp_path, closes):
+    ra, dec = stand_in.make_catalog(4)
+    with SearchCache(tmp_path / 'searches.sqlite') as search_cache:
+        sdss.search_galaxies(ra, dec, search_cache=search_cache, num_workers=2)
+        assert closes['close'] == 0
+
+
+def test_search_cache_hits_are_reported(stand_in, tmp_path):
+    ra, dec = stand_in.make_catalog(6)
+    catalog = tmp_path / 'catalog.csv'
+    with open(catalog, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(ra, dec))
+
+    reports = []
+    for k in range(2):
+        sdss.download_images(catalog, bands='r', output_dir=tmp_path / f'images{k}',
+                             search_cache=tmp_path / 'searches.sqlite', num_workers=2, progress_bar=False,
+                             verbose=False, report_callback=reports.append)
+
+    assert [(report['counters']['search_cache_hits'], report['counters']['search_cache_lookups'])
+            for report in reports] == [(0, 6), (6, 6)]
+    with open(tmp_path / 'images1' / 'report.json') as f:
+        assert json.load(f)['counters']['search_cache_hits'] == 6
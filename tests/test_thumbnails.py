@@ -0,0 +1,100 @@
+import csv
+
+import pytest
+import requests
+from PIL import Image
+
+from gmag import sdss
+
+
+@pytest.fixture(scope='module')
+def output_dir(stand_in, tmp_path_factory):
+    """Output directory of a run with 10 galaxies found out of 12 rows, and their thumbnails"""
+
+    tmp_path = tmp_path_factory.mktemp('thumbnails')
+    ra, dec = stand_in.make_catalog(12, found_fraction=0.8)
+    path = tmp_path / 'catalog.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ra', 'dec'])
+        writer.writerows(zip(ra, dec))
+    sdss.download_images(path, bands='r', output_dir=tmp_path / 'images', thumbnails=True, num_workers=4,
+                         progress_bar=False, verbose=False)
+    return tmp_path / 'images'
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    """Urls of the thumbnails fetched"""
+
+    fetched = []
+    get_content = sdss._http.get_content
+    monkeypatch.setattr(sdss._http, 'get_content', lambda url, **kwargs: fetched.append(url) or
+                        get_content(url, **kwargs))
+    return fetched
+
+
+def found_rows(output_dir):
+    with open(output_dir / 'info.csv', newline='') as f:
+        lines = [line for line in f if not line.startswith('#')]
+    return [row for row in csv.DictReader(lines[1:]) if row['found'] == 'True']
+
+
+def test_thumbnails_of_found_galaxies(output_dir):
+    rows = found_rows(output_dir)
+    paths = sorted((output_dir / 'thumbnails').glob('*_*.jpg'))
+
+    assert 0 < len(rows) < 12
+    assert [path.name for path in paths] == sorted(f"{row['row']}_{row['objid']}.jpg" for row in rows)
+    for path in paths:
+        with Image.open(path) as thumbnail:
+            assert thumbnail.size == (256, 256)
+
+
+def test_thumbnails_already_there_are_not_fetched(output_dir, fetched):
+    path = sorted((output_dir / 'thumbnails').glob('*_*.jpg'))[0]
+    path.unlink()
+
+    sdss.download_thumbnails(output_dir, num_workers=2, progress_bar=False, verbose=False)
+
+    assert len(fetched) == 1 and '/ImgCutout/getjpeg' in fetched[0]
+    assert path.exists()
+
+
+def test_failed_thumbnails_are_fetched_again(output_dir, fetched, monkeypatch):
+    paths = sorted((output_dir / 'thumbnails').glob('*_*.jpg'))[:3]
+    for path in paths:
+        path.unlink()
+
+    def refuse(url, **kwargs):
+        raise requests.ConnectionError("Connection refused")
+
+    get_content = sdss._http.get_content
+    monkeypatch.setattr(sdss._http, 'get_content', refuse)
+    sdss.download_thumbnails(output_dir, num_workers=2, progress_bar=False, verbose=False)
+    assert not any(path.exists() for path in paths)
+    assert not list((output_dir / 'thumbnails').glob('*.part'))
+
+    monkeypatch.setattr(sdss._http, 'get_content', get_content)
+    sdss.download_thumbnails(output_dir, num_workers=2, progress_bar=False, verbose=False)
+    assert all(path.exists() for path in paths)
+    assert len(fetched) == 3
+
+
+def test_mosaic_tiles_thumbnails_in_row_order(output_dir):
+    rows = found_rows(output_dir)
+    thumbnail_dir = sdss.download_thumbnails(output_dir, size=32, mosaic=True, mosaic_shape=(2, 3),
+                                             progress_bar=False, verbose=False)
+
+    sheets = sorted(thumbnail_dir.glob('mosaic-*.jpg'))
+    assert len(sheets) == -(-len(rows) // 6)
+    for sheet in sheets:
+        with Image.open(sheet) as image:
+            assert image.size == (3 * 32, 2 * 32)
+
+    with open(thumbnail_dir / 'mosaic.csv', newline='') as f:
+        index = list(csv.DictReader(f))
+    assert [(int(tile['row']), tile['objid']) for tile in index] == \
+        sorted((int(row['row']), row['objid']) for row in rows)
+    assert [(tile['sheet'], int(tile['tile_row']), int(tile['tile_col'])) for tile in index] == \
+        [(f"mosaic-{k // 6:05d}.jpg", k % 6 // 3, k % 3) for k in range(len(rows))]